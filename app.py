@@ -1,13 +1,52 @@
-from flask import Flask, request, jsonify, Response
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, g
 import sqlite3
 import os
 import hashlib
+import hmac
+import base64
+import json
+import csv
+import io
+import gzip
+import zlib
+import sys
 import secrets
+import threading
+import queue
+import atexit
+import math
+import random
+import re
+import heapq
+import cProfile
+import pstats
+import fcntl
+import socket
+import click
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.http import http_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
+# За балансировщиком реальный IP клиента берется из X-Forwarded-For
+TRUST_PROXY_HOPS = int(os.environ.get('TRUST_PROXY_HOPS', 0))
+if TRUST_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUST_PROXY_HOPS)
+
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'CHANGE_THIS_IN_PRODUCTION')
 
 if ADMIN_PASSWORD == 'CHANGE_THIS_IN_PRODUCTION':
@@ -29,176 +68,1691 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
-DB_PATH = '/tmp/activation_codes.db'
+DB_PATH = os.environ.get('DB_PATH', '/tmp/activation_codes.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# ========== МЕТРИКИ ==========
+
+METRICS_DIR = os.environ.get('METRICS_DIR', DB_PATH + '.metrics')
+METRICS_DUMP_INTERVAL = float(os.environ.get('METRICS_DUMP_INTERVAL', 2))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_HELP = {
+    'activation_http_requests_total': ('counter', 'HTTP requests by route, method and status'),
+    'activation_http_request_duration_seconds': ('histogram', 'HTTP request latency by route'),
+    'activation_kdf_duration_seconds': ('histogram', 'Time spent in the password KDF, including queue wait'),
+    'activation_kdf_queue_wait_seconds': ('histogram', 'Time waiting for a free KDF queue slot'),
+    'activation_db_pool_wait_seconds': ('histogram', 'Time waiting for a pooled SQLite connection'),
+    'activation_db_lock_wait_seconds': ('histogram', 'Time waiting for the SQLite write lock'),
+    'activation_db_query_seconds': ('histogram', 'Time executing SQLite queries by phase'),
+    'activation_outcomes_total': ('counter', 'Business outcomes of register and login'),
+    'activation_username_index_total': ('counter', 'Username lookups by how they were answered'),
+    'activation_code_index_total': ('counter', 'Activation code lookups by how they were answered'),
+    'activation_rate_limited_total': ('counter', 'Requests rejected by the rate limiter'),
+    'activation_password_rehash_total': ('counter', 'Background password rehashes by result'),
+    'activation_write_batches_total': ('counter', 'Committed group-commit write batches'),
+    'activation_write_ops_total': ('counter', 'Operations applied by the write pipeline by kind and result'),
+    'activation_write_queue_depth': ('gauge', 'Operations waiting for the write pipeline'),
+    'activation_expired_total': ('counter', 'Codes and subscriptions marked expired by the background sweeper'),
+    'activation_db_pool_in_use': ('gauge', 'Pooled SQLite connections currently checked out'),
+    'activation_kdf_in_flight': ('gauge', 'KDF jobs submitted and not yet finished'),
+    'activation_kdf_queue_depth': ('gauge', 'KDF jobs waiting for a pool process'),
+    'activation_admission_in_flight': ('gauge', 'Requests running per endpoint class'),
+    'activation_admission_queued': ('gauge', 'Requests waiting for admission per endpoint class'),
+    'activation_admission_rejected_total': ('counter', 'Requests shed with 503 per endpoint class'),
+    'activation_profiles_total': ('counter', 'Request profiles captured by kind and whether they made the top N'),
+}
+
+class Metrics:
+    """Счетчики и гистограммы воркера в стиле Prometheus.
+    
+    Каждый воркер периодически сохраняет снимок в METRICS_DIR/<pid>.json,
+    а /metrics суммирует снимки всех воркеров.
+    """
+
+    def __init__(self, directory, dump_interval):
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._pid = os.getpid()
+        self._last_dump = 0.0
+
+    def _check_fork(self):
+        # Данные мастера до fork не должны попасть в снимки каждого воркера
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._counters = {}
+            self._histograms = {}
+            self._last_dump = 0.0
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(LATENCY_BUCKETS)] += 1
+            hist[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, fn, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def snapshot(self):
+        with self._lock:
+            self._check_fork()
+            data = {
+                "pid": os.getpid(),
+                "counters": [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, dict(labels), hist] for (name, labels), hist in self._histograms.items()],
+            }
+        data["gauges"] = [[name, dict(labels), fn()] for (name, labels), fn in self._gauges.items()]
+        return data
+
+    def dump(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_dump < self.dump_interval:
+            return
+        self._last_dump = now
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """Суммирует снимки всех воркеров и отдает текст в формате Prometheus"""
+        self.dump(force=True)
+        counters, histograms, gauges = {}, {}, {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            
+            for name, labels, value in data["counters"]:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, hist in data["histograms"]:
+                key = (name, tuple(sorted(labels.items())))
+                merged = histograms.setdefault(key, [0] * len(hist))
+                for i, value in enumerate(hist):
+                    merged[i] += value
+            # Мгновенные значения учитываем только у живых процессов
+            if _pid_alive(data["pid"]):
+                for name, labels, value in data["gauges"]:
+                    key = (name, tuple(sorted(labels.items())))
+                    gauges[key] = gauges.get(key, 0) + value
+        
+        lines = []
+        for name in sorted({k[0] for k in counters} | {k[0] for k in histograms} | {k[0] for k in gauges}):
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(gauges.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (metric, labels), hist in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {hist[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def ensure_worker_thread(owner, name):
+    """Запускает owner._run в фоновом потоке, по одному на процесс.
+    
+    Потоки не переживают fork: в новом воркере owner._reset() сбрасывает унаследованное
+    состояние и поток стартует заново. Владелец хранит _lock, _pid и _thread.
+    """
+    if owner._pid == os.getpid():
+        return
+    with owner._lock:
+        if owner._pid != os.getpid():
+            owner._pid = os.getpid()
+            owner._reset()
+            owner._thread = threading.Thread(target=owner._run, name=name, daemon=True)
+            owner._thread.start()
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+metrics = Metrics(METRICS_DIR, METRICS_DUMP_INTERVAL)
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite (один на процесс-воркер)"""
+
+    def __init__(self, path, size, timeout):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # После fork соединения родителя использовать нельзя — начинаем с пустого пула
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        return conn
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        
+        start = time.perf_counter()
+        blocked = False
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                blocked = True
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("Connection pool exhausted")
+        
+        waited = time.perf_counter() - start
+        metrics.observe('activation_db_pool_wait_seconds', waited)
+        with self._lock:
+            self._acquired += 1
+            if blocked:
+                self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            # Незавершенная транзакция не должна достаться следующему запросу
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close_idle(self):
+        # Мастер gunicorn закрывает свои соединения до fork, чтобы воркеры их не унаследовали
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    @contextmanager
+    def connection(self, conn=None):
+        # Уже взятое соединение переиспользуем: повторный захват из пула может зависнуть
+        if conn is not None:
+            yield conn
+            return
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            idle = self._idle.qsize()
+            return {
+                "pid": self._pid,
+                "size": self.size,
+                "open": self._created,
+                "idle": idle,
+                "in_use": self._created - idle,
+                "acquisitions": self._acquired,
+                "waits": self._waits,
+                "wait_total_ms": round(self._wait_total * 1000, 3),
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+                "wait_avg_ms": round(self._wait_total * 1000 / self._acquired, 3) if self._acquired else 0.0
+            }
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+@contextmanager
+def stream_connection():
+    """Отдельное соединение только для чтения на время потоковой выдачи.
+    
+    Медленный клиент может читать ответ минутами — соединение пула, нужное записи, он не держит.
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    try:
+        conn.execute("PRAGMA query_only=ON")
+        yield conn
+    finally:
+        conn.close()
+
+def init_db(conn=None):
+    with db_pool.connection(conn) as conn:
+        c = conn.cursor()
+        
+        # Таблица кодов активации
+        c.execute('''CREATE TABLE IF NOT EXISTS codes
+                     (id INTEGER PRIMARY KEY,
+                      code TEXT UNIQUE NOT NULL,
+                      used INTEGER DEFAULT 0,
+                      code_type TEXT NOT NULL,
+                      created_at INTEGER,
+                      expires_at INTEGER)''')
+    
+        # Таблица пользователей
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (id INTEGER PRIMARY KEY,
+                      username TEXT UNIQUE NOT NULL,
+                      password_hash TEXT NOT NULL,
+                      created_at INTEGER,
+                      last_login INTEGER)''')
+    
+        # Таблица активаций (связь пользователь-код)
+        c.execute('''CREATE TABLE IF NOT EXISTS activations
+                     (id INTEGER PRIMARY KEY,
+                      user_id INTEGER NOT NULL,
+                      code_id INTEGER NOT NULL,
+                      activated_at INTEGER,
+                      expires_at INTEGER,
+                      FOREIGN KEY(user_id) REFERENCES users(id),
+                      FOREIGN KEY(code_id) REFERENCES codes(id))''')
+        
+        # Отозванные сессионные токены (храним до истечения токена)
+        c.execute('''CREATE TABLE IF NOT EXISTS revoked_sessions
+                     (jti TEXT PRIMARY KEY,
+                      expires_at INTEGER NOT NULL)''')
+    
+        conn.commit()
+        
+        run_migrations(conn)
+
+# ========== МИГРАЦИИ СХЕМЫ ==========
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# в своей транзакции вместе с повышением версии; новые миграции добавляются в конец.
+
+def _legacy_to_epoch(value):
+    # Старые строки вида 'YYYY-MM-DD HH:MM:SS[.ffffff]' (локальное время сервера)
+    if not isinstance(value, str):
+        return value
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            pass
+    return value
+
+def _migrate_epoch_timestamps(conn):
+    conn.create_function('legacy_epoch', 1, _legacy_to_epoch)
+    conn.execute("UPDATE codes SET created_at = legacy_epoch(created_at), expires_at = legacy_epoch(expires_at)")
+    conn.execute("UPDATE users SET created_at = legacy_epoch(created_at), last_login = legacy_epoch(last_login)")
+    conn.execute("UPDATE activations SET activated_at = legacy_epoch(activated_at), expires_at = legacy_epoch(expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_codes_expires_at ON codes(expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_activations_expires_at ON activations(expires_at)")
+
+# Поминутные ряды статистики храним неделю; срок зашит в триггер миграции 5
+STATS_MINUTE_RETENTION = 7 * 24 * 60
+STATS_EXPIRY_BUCKET = 3600
+
+# Пересчет производных таблиц по codes, users и activations — общий для миграций
+# и восстановления из экспорта
+SUBSCRIPTION_BACKFILL_SQL = '''INSERT OR REPLACE INTO user_subscription (user_id, code_type, activated_at, expires_at, is_forever)
+    SELECT a.user_id, c.code_type, a.activated_at, a.expires_at, a.expires_at IS NULL
+    FROM activations a JOIN codes c ON c.id = a.code_id
+    WHERE a.id = (SELECT id FROM activations WHERE user_id = a.user_id
+                  ORDER BY activated_at DESC, id DESC LIMIT 1)'''
+
+STATS_BACKFILL_SQL = [
+    '''INSERT OR REPLACE INTO code_counts (code_type, used, count)
+       SELECT code_type, COALESCE(used, 0), COUNT(*) FROM codes GROUP BY code_type, COALESCE(used, 0)''',
+    "INSERT OR REPLACE INTO stat_counters (name, value) SELECT 'users', COUNT(*) FROM users",
+    f'''INSERT OR REPLACE INTO subscription_expiry_counts (bucket, count)
+       SELECT expires_at / {STATS_EXPIRY_BUCKET}, COUNT(*) FROM user_subscription
+       WHERE expires_at IS NOT NULL GROUP BY expires_at / {STATS_EXPIRY_BUCKET}''',
+    f'''INSERT OR REPLACE INTO activity_minutes (event, minute, count)
+       SELECT 'register', created_at / 60, COUNT(*) FROM users
+       WHERE created_at >= CAST(strftime('%s', 'now') AS INTEGER) - {STATS_MINUTE_RETENTION * 60}
+       GROUP BY created_at / 60''',
+    '''INSERT OR REPLACE INTO activity_days (event, day, count)
+       SELECT 'register', created_at / 86400, COUNT(*) FROM users
+       WHERE created_at IS NOT NULL GROUP BY created_at / 86400''',
+]
+
+# Строки, истекшие до появления фонового обхода (или до восстановления), помечаем сразу
+EXPIRY_BACKFILL_SQL = [
+    "UPDATE codes SET expired = 1 WHERE expired = 0 AND expires_at < CAST(strftime('%s', 'now') AS INTEGER)",
+    "UPDATE user_subscription SET expired = 1 WHERE expired = 0 AND expires_at < CAST(strftime('%s', 'now') AS INTEGER)",
+]
+
+MIGRATIONS = [
+    (1, "epoch timestamps", _migrate_epoch_timestamps),
+    (2, "performance indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_activations_user_activated ON activations(user_id, activated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_codes_created_at ON codes(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+    ]),
+    (3, "user_subscription", [
+        # Текущая подписка пользователя = его последняя активация; поддерживается триггером
+        '''CREATE TABLE IF NOT EXISTS user_subscription
+           (user_id INTEGER PRIMARY KEY,
+            code_type TEXT NOT NULL,
+            activated_at INTEGER,
+            expires_at INTEGER,
+            is_forever INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(id))''',
+        "CREATE INDEX IF NOT EXISTS idx_user_subscription_expires_at ON user_subscription(expires_at)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_activations_subscription AFTER INSERT ON activations
+           BEGIN
+               INSERT INTO user_subscription (user_id, code_type, activated_at, expires_at, is_forever)
+               SELECT NEW.user_id, c.code_type, NEW.activated_at, NEW.expires_at, NEW.expires_at IS NULL
+               FROM codes c WHERE c.id = NEW.code_id
+               ON CONFLICT(user_id) DO UPDATE SET
+                   code_type = excluded.code_type,
+                   activated_at = excluded.activated_at,
+                   expires_at = excluded.expires_at,
+                   is_forever = excluded.is_forever
+               WHERE COALESCE(excluded.activated_at, 0) >= COALESCE(user_subscription.activated_at, 0);
+           END''',
+        SUBSCRIPTION_BACKFILL_SQL,
+    ]),
+    (4, "change tracking", [
+        # Глобальный счетчик версий данных; каждая изменившаяся строка получает новое значение
+        '''CREATE TABLE IF NOT EXISTS data_version
+           (id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL)''',
+        "INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)",
+        "ALTER TABLE codes ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_codes_row_version ON codes(row_version)",
+        "CREATE INDEX IF NOT EXISTS idx_users_row_version ON users(row_version)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_version_insert AFTER INSERT ON codes
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE codes SET row_version = (SELECT version FROM data_version) WHERE id = NEW.id;
+           END''',
+        # Только видимые в админке столбцы: обновление самого row_version триггер не вызывает
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_version_update
+           AFTER UPDATE OF code, used, code_type, expires_at ON codes
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE codes SET row_version = (SELECT version FROM data_version) WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_version_insert AFTER INSERT ON users
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE users SET row_version = (SELECT version FROM data_version) WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_version_update AFTER UPDATE OF username, last_login ON users
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE users SET row_version = (SELECT version FROM data_version) WHERE id = NEW.id;
+           END''',
+        # Подписка показывается в строке пользователя — ее изменение меняет версию пользователя
+        '''CREATE TRIGGER IF NOT EXISTS trg_subscription_version_insert AFTER INSERT ON user_subscription
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE users SET row_version = (SELECT version FROM data_version) WHERE id = NEW.user_id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_subscription_version_update AFTER UPDATE ON user_subscription
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE users SET row_version = (SELECT version FROM data_version) WHERE id = NEW.user_id;
+           END''',
+    ]),
+    (5, "aggregate counters", [
+        '''CREATE TABLE IF NOT EXISTS code_counts
+           (code_type TEXT NOT NULL,
+            used INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (code_type, used)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS stat_counters
+           (name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL) WITHOUT ROWID''',
+        # Подписки с конечным сроком по часу истечения — истекшие считаются без скана
+        '''CREATE TABLE IF NOT EXISTS subscription_expiry_counts
+           (bucket INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS activity_minutes
+           (event TEXT NOT NULL,
+            minute INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (event, minute)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS activity_days
+           (event TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (event, day)) WITHOUT ROWID''',
+        
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_count_insert AFTER INSERT ON codes
+           BEGIN
+               INSERT INTO code_counts (code_type, used, count) VALUES (NEW.code_type, COALESCE(NEW.used, 0), 1)
+               ON CONFLICT(code_type, used) DO UPDATE SET count = count + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_count_update AFTER UPDATE OF used, code_type ON codes
+           WHEN OLD.used IS NOT NEW.used OR OLD.code_type IS NOT NEW.code_type
+           BEGIN
+               UPDATE code_counts SET count = count - 1
+               WHERE code_type = OLD.code_type AND used = COALESCE(OLD.used, 0);
+               INSERT INTO code_counts (code_type, used, count) VALUES (NEW.code_type, COALESCE(NEW.used, 0), 1)
+               ON CONFLICT(code_type, used) DO UPDATE SET count = count + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_count_delete AFTER DELETE ON codes
+           BEGIN
+               UPDATE code_counts SET count = count - 1
+               WHERE code_type = OLD.code_type AND used = COALESCE(OLD.used, 0);
+           END''',
+        
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+           BEGIN
+               INSERT INTO stat_counters (name, value) VALUES ('users', 1)
+               ON CONFLICT(name) DO UPDATE SET value = value + 1;
+               INSERT INTO activity_minutes (event, minute, count)
+               VALUES ('register', COALESCE(NEW.created_at, CAST(strftime('%s', 'now') AS INTEGER)) / 60, 1)
+               ON CONFLICT(event, minute) DO UPDATE SET count = count + 1;
+               INSERT INTO activity_days (event, day, count)
+               VALUES ('register', COALESCE(NEW.created_at, CAST(strftime('%s', 'now') AS INTEGER)) / 86400, 1)
+               ON CONFLICT(event, day) DO UPDATE SET count = count + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+           BEGIN
+               UPDATE stat_counters SET value = value - 1 WHERE name = 'users';
+           END''',
+        
+        f'''CREATE TRIGGER IF NOT EXISTS trg_subscription_count_insert AFTER INSERT ON user_subscription
+           WHEN NEW.expires_at IS NOT NULL
+           BEGIN
+               INSERT INTO subscription_expiry_counts (bucket, count) VALUES (NEW.expires_at / {STATS_EXPIRY_BUCKET}, 1)
+               ON CONFLICT(bucket) DO UPDATE SET count = count + 1;
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_subscription_count_update AFTER UPDATE OF expires_at ON user_subscription
+           WHEN OLD.expires_at IS NOT NEW.expires_at
+           BEGIN
+               UPDATE subscription_expiry_counts SET count = count - 1
+               WHERE bucket = OLD.expires_at / {STATS_EXPIRY_BUCKET};
+               INSERT INTO subscription_expiry_counts (bucket, count)
+               SELECT NEW.expires_at / {STATS_EXPIRY_BUCKET}, 1 WHERE NEW.expires_at IS NOT NULL
+               ON CONFLICT(bucket) DO UPDATE SET count = count + 1;
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_subscription_count_delete AFTER DELETE ON user_subscription
+           BEGIN
+               UPDATE subscription_expiry_counts SET count = count - 1
+               WHERE bucket = OLD.expires_at / {STATS_EXPIRY_BUCKET};
+           END''',
+        
+        # Новая минута в ряду — повод удалить вышедшие за срок хранения
+        f'''CREATE TRIGGER IF NOT EXISTS trg_activity_minutes_retention AFTER INSERT ON activity_minutes
+           BEGIN
+               DELETE FROM activity_minutes
+               WHERE event = NEW.event AND minute < NEW.minute - {STATS_MINUTE_RETENTION};
+           END''',
+        
+        # Заполняем счетчики по уже существующим данным
+        *STATS_BACKFILL_SQL,
+    ]),
+    (6, "idempotency keys", [
+        # status и response пусты, пока первый запрос с ключом выполняется
+        '''CREATE TABLE IF NOT EXISTS idempotency_keys
+           (key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            status INTEGER,
+            response TEXT,
+            expires_at INTEGER NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)",
+    ]),
+    (7, "expiry status", [
+        "ALTER TABLE codes ADD COLUMN expired INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE user_subscription ADD COLUMN expired INTEGER NOT NULL DEFAULT 0",
+        # Очередь фонового обхода: только еще не помеченные строки со сроком
+        "CREATE INDEX IF NOT EXISTS idx_codes_expiry_pending ON codes(expires_at) WHERE expired = 0 AND expires_at IS NOT NULL",
+        """CREATE INDEX IF NOT EXISTS idx_user_subscription_expiry_pending ON user_subscription(expires_at)
+           WHERE expired = 0 AND expires_at IS NOT NULL""",
+        '''CREATE TABLE IF NOT EXISTS expiry_events
+           (id INTEGER PRIMARY KEY,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS idx_expiry_events_created_at ON expiry_events(created_at)",
+        # Аренды фоновых задач: задачу выполняет только владелец неистекшей записи
+        '''CREATE TABLE IF NOT EXISTS leases
+           (name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at INTEGER NOT NULL)''',
+        # Пометка истечения видна в админке — она тоже меняет версию строки
+        "DROP TRIGGER IF EXISTS trg_codes_version_update",
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_version_update
+           AFTER UPDATE OF code, used, code_type, expires_at, expired ON codes
+           BEGIN
+               UPDATE data_version SET version = version + 1;
+               UPDATE codes SET row_version = (SELECT version FROM data_version) WHERE id = NEW.id;
+           END''',
+        # Продленный срок снимает пометку, не дожидаясь обхода
+        '''CREATE TRIGGER IF NOT EXISTS trg_codes_expiry_reset AFTER UPDATE OF expires_at ON codes
+           WHEN NEW.expired = 1 AND (NEW.expires_at IS NULL OR NEW.expires_at >= CAST(strftime('%s', 'now') AS INTEGER))
+           BEGIN
+               UPDATE codes SET expired = 0 WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_subscription_expiry_reset AFTER UPDATE OF expires_at ON user_subscription
+           WHEN NEW.expired = 1 AND (NEW.expires_at IS NULL OR NEW.expires_at >= CAST(strftime('%s', 'now') AS INTEGER))
+           BEGIN
+               UPDATE user_subscription SET expired = 0 WHERE user_id = NEW.user_id;
+           END''',
+        *EXPIRY_BACKFILL_SQL,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn):
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if schema_version(conn) >= version:
+            continue
+        
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой воркер мог уже выполнить миграцию, пока мы ждали блокировку
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            if callable(migration):
+                migration(conn)
+            else:
+                for sql in migration:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((version, name))
+    return applied
+
+# Запросы горячих путей — для проверки планов командой `flask db-status`
+HOT_QUERIES = {
+    "code index: incremental load": (
+        "SELECT id, code, code_type, expires_at, used, row_version FROM codes WHERE row_version > ? ORDER BY row_version", (0,)),
+    "code index: rejection reason": (
+        "SELECT id, used, code_type, expires_at FROM codes WHERE code = ?", ("CODE",)),
+    "username index: version check": (
+        "SELECT COALESCE(MAX(id), 0) FROM users", ()),
+    "username index: confirm": (
+        "SELECT 1 FROM users WHERE username = ?", ("user",)),
+    "login: user and subscription": (
+        """SELECT u.id, u.password_hash, s.code_type, s.expires_at FROM users u
+           LEFT JOIN user_subscription s ON s.user_id = u.id WHERE u.username = ?""", ("user",)),
+    "session verify: subscription": (
+        "SELECT code_type, expires_at FROM user_subscription WHERE user_id = ?", (1,)),
+    "expiry sweep: codes": (
+        "SELECT id, expires_at FROM codes WHERE expired = 0 AND expires_at < ? ORDER BY expires_at LIMIT ?", (0, 500)),
+    "expiry sweep: subscriptions": (
+        """SELECT user_id, expires_at FROM user_subscription
+           WHERE expired = 0 AND expires_at < ? ORDER BY expires_at LIMIT ?""", (0, 500)),
+    "list_codes: next page": (
+        """SELECT id, created_at, code, code_type, expires_at, used, expired FROM codes
+           WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?""", (0, 0, 101)),
+    "list_users: next page": (
+        """SELECT u.id, u.created_at, u.username, u.last_login, s.code_type, s.expires_at, s.expired
+           FROM users u LEFT JOIN user_subscription s ON s.user_id = u.id
+           WHERE (u.created_at, u.id) < (?, ?) ORDER BY u.created_at DESC, u.id DESC LIMIT ?""", (0, 0, 101)),
+    "stats: subscriptions expiring in the current hour": (
+        "SELECT COUNT(*) FROM user_subscription WHERE expires_at >= ? AND expires_at < ?", (0, 0)),
+    "list_codes: etag version": (
+        "SELECT COALESCE(MAX(row_version), 0) FROM codes", ()),
+    "list_users: etag version": (
+        "SELECT COALESCE(MAX(row_version), 0) FROM users", ()),
+    "list_codes: changes since": (
+        """SELECT id, created_at, code, code_type, expires_at, used, expired, row_version FROM codes
+           WHERE row_version > ? ORDER BY row_version LIMIT ?""", (0, 1001)),
+    "list_users: changes since": (
+        """SELECT u.id, u.created_at, u.username, u.last_login, s.code_type, s.expires_at, s.expired, u.row_version
+           FROM users u LEFT JOIN user_subscription s ON s.user_id = u.id
+           WHERE u.row_version > ? ORDER BY u.row_version LIMIT ?""", (0, 1001)),
+}
+
+@app.cli.command('db-migrate')
+def db_migrate_command():
+    """Применить недостающие миграции схемы"""
+    init_db()
+    with db_pool.connection() as conn:
+        print(f"Schema version: {schema_version(conn)}")
+
+@app.cli.command('db-status')
+def db_status_command():
+    """Показать версию схемы и планы горячих запросов"""
+    with db_pool.connection() as conn:
+        version = schema_version(conn)
+        print(f"Database: {DB_PATH}")
+        print(f"Schema version: {version} (latest: {SCHEMA_VERSION})")
+        for v, name, _ in MIGRATIONS:
+            if v > version:
+                print(f"  pending: {v} {name}")
+        
+        for title, (sql, params) in HOT_QUERIES.items():
+            print(f"\n{title}")
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+                print(f"  {row[-1]}")
+
+# Политика хеширования паролей. Хеш хранится самоописывающей строкой
+# $<алгоритм>$v=<версия>$<параметры>$<соль>$<ключ>, поэтому параметры можно
+# менять без миграции: старые хеши проверяются со своими параметрами.
+PASSWORD_HASH_SCHEME = os.environ.get('PASSWORD_HASH_SCHEME', 'pbkdf2-sha256')
+PASSWORD_HASH_VERSION = 1
+PBKDF2_ITERATIONS = int(os.environ.get('PBKDF2_ITERATIONS', 100000))
+SCRYPT_N = int(os.environ.get('SCRYPT_N', 2 ** 15))
+SCRYPT_R = int(os.environ.get('SCRYPT_R', 8))
+SCRYPT_P = int(os.environ.get('SCRYPT_P', 1))
+PASSWORD_SALT_SIZE = 16
+PASSWORD_KEY_SIZE = 32
+# Старый формат: сырые salt(32) + key(32) на PBKDF2-SHA256 с 100000 итераций
+LEGACY_HASH_PARAMS = ('pbkdf2-sha256', 0, {'i': 100000})
+
+KDF_WORKERS = int(os.environ.get('KDF_WORKERS', 2))  # 0 — хешировать прямо в обработчике
+KDF_QUEUE_SIZE = int(os.environ.get('KDF_QUEUE_SIZE', 16))
+KDF_QUEUE_TIMEOUT = float(os.environ.get('KDF_QUEUE_TIMEOUT', 5))
+
+class KdfBusyError(Exception):
+    pass
+
+def _derive_key(scheme, password, salt, params):
+    if scheme == 'pbkdf2-sha256':
+        return hashlib.pbkdf2_hmac('sha256', password, salt, params['i'], PASSWORD_KEY_SIZE)
+    if scheme == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p + 1024 * 1024, dklen=PASSWORD_KEY_SIZE)
+    raise ValueError(f"Unknown password hash scheme: {scheme}")
+
+class KdfExecutor:
+    """Пул процессов для KDF с ограниченной очередью"""
+
+    def __init__(self, workers, queue_size, queue_timeout):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._inline = 0
+        self._wait_total = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _record(self, elapsed, waited=0.0, inline=False):
+        with self._lock:
+            self._completed += 1
+            if inline:
+                self._inline += 1
+            self._wait_total += waited
+            self._run_total += elapsed
+            self._run_max = max(self._run_max, elapsed)
+
+    def run(self, fn, *args):
+        if not self.enabled:
+            start = time.perf_counter()
+            result = fn(*args)
+            self._record(time.perf_counter() - start, inline=True)
+            return result
+        
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._rejected += 1
+            raise KdfBusyError("Password hashing queue is full")
+        waited = time.perf_counter() - start
+        metrics.observe('activation_kdf_queue_wait_seconds', waited)
+        
+        with self._lock:
+            self._pending += 1
+            self._submitted += 1
+        try:
+            try:
+                result = self._get_executor().submit(fn, *args).result()
+                inline = False
+            except BrokenProcessPool:
+                # Процесс пула упал — пересоздадим пул при следующем вызове, а сейчас посчитаем сами
+                with self._lock:
+                    self._executor = None
+                result = fn(*args)
+                inline = True
+            self._record(time.perf_counter() - start - waited, waited, inline)
+            return result
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "in_flight": self._pending,
+                "queue_depth": max(self._pending - self.workers, 0),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "inline": self._inline,
+                "wait_total_ms": round(self._wait_total * 1000, 3),
+                "run_total_ms": round(self._run_total * 1000, 3),
+                "run_max_ms": round(self._run_max * 1000, 3),
+                "run_avg_ms": round(self._run_total * 1000 / self._completed, 3) if self._completed else 0.0
+            }
+
+kdf_executor = KdfExecutor(KDF_WORKERS, KDF_QUEUE_SIZE, KDF_QUEUE_TIMEOUT)
+atexit.register(kdf_executor.shutdown)
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def password_policy():
+    """Текущие настройки хеширования: (алгоритм, версия, параметры)"""
+    if PASSWORD_HASH_SCHEME == 'scrypt':
+        return 'scrypt', PASSWORD_HASH_VERSION, {'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P}
+    return 'pbkdf2-sha256', PASSWORD_HASH_VERSION, {'i': PBKDF2_ITERATIONS}
+
+def encode_password_hash(scheme, version, params, salt, key):
+    encoded_params = ','.join(f"{name}={value}" for name, value in sorted(params.items()))
+    return '$'.join(['', scheme, f"v={version}", encoded_params,
+                     _b64encode(salt), _b64encode(key)])
+
+def decode_password_hash(stored_hash):
+    """Разбирает хеш в (алгоритм, версия, параметры, соль, ключ); понимает и старый формат"""
+    if isinstance(stored_hash, (bytes, memoryview)):
+        stored_hash = bytes(stored_hash)
+        # Новый формат хранится строкой и всегда длиннее; у старого соль может начинаться с '$'
+        if len(stored_hash) == 64:
+            scheme, version, params = LEGACY_HASH_PARAMS
+            return scheme, version, dict(params), stored_hash[:32], stored_hash[32:]
+        stored_hash = stored_hash.decode('ascii')
     
-    # Таблица кодов активации
-    c.execute('''CREATE TABLE IF NOT EXISTS codes
-                 (id INTEGER PRIMARY KEY,
-                  code TEXT UNIQUE NOT NULL,
-                  used INTEGER DEFAULT 0,
-                  code_type TEXT NOT NULL,
-                  created_at TIMESTAMP,
-                  expires_at TIMESTAMP)''')
-    
-    # Таблица пользователей
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY,
-                  username TEXT UNIQUE NOT NULL,
-                  password_hash TEXT NOT NULL,
-                  created_at TIMESTAMP,
-                  last_login TIMESTAMP)''')
-    
-    # Таблица активаций (связь пользователь-код)
-    c.execute('''CREATE TABLE IF NOT EXISTS activations
-                 (id INTEGER PRIMARY KEY,
-                  user_id INTEGER NOT NULL,
-                  code_id INTEGER NOT NULL,
-                  activated_at TIMESTAMP,
-                  expires_at TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(code_id) REFERENCES codes(id))''')
-    
-    conn.commit()
-    conn.close()
+    parts = stored_hash.split('$')
+    if len(parts) != 6 or parts[0] != '' or not parts[2].startswith('v='):
+        raise ValueError("Unrecognized password hash format")
+    _, scheme, version, encoded_params, salt, key = parts
+    params = {}
+    for item in encoded_params.split(','):
+        name, _, value = item.partition('=')
+        params[name] = int(value)
+    return scheme, int(version[2:]), params, _b64decode(salt), _b64decode(key)
+
+def needs_rehash(stored_hash):
+    scheme, version, params, _, _ = decode_password_hash(stored_hash)
+    return (scheme, version, params) != password_policy()
 
 def hash_password(password):
-    salt = os.urandom(32)
-    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
-    return salt + key
+    scheme, version, params = password_policy()
+    salt = os.urandom(PASSWORD_SALT_SIZE)
+    with metrics.timer('activation_kdf_duration_seconds', op='hash'):
+        key = kdf_executor.run(_derive_key, scheme, password.encode('utf-8'), salt, params)
+    return encode_password_hash(scheme, version, params, salt, key)
 
 def verify_password(stored_hash, password):
-    salt = stored_hash[:32]
-    stored_key = stored_hash[32:]
-    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
-    return key == stored_key
+    scheme, _, params, salt, stored_key = decode_password_hash(stored_hash)
+    with metrics.timer('activation_kdf_duration_seconds', op='verify'):
+        key = kdf_executor.run(_derive_key, scheme, password.encode('utf-8'), salt, params)
+    return secrets.compare_digest(key, stored_key)
+
+PASSWORD_REHASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_REHASH_QUEUE_SIZE', 100))
+
+class PasswordRehasher:
+    """Фоновый перевод хешей на текущую политику после успешного входа"""
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._rehashed = 0
+        self._dropped = 0
+        self._failed = 0
+
+    def _reset(self):
+        # Очередь своя в каждом воркере: после fork чужие задачи не нужны
+        self._queue = queue.Queue(maxsize=max(self.queue_size, 1))
+
+    def submit(self, user_id, old_hash, password):
+        """Ставит пересчет в очередь; при переполнении пропускаем — перехешируем при следующем входе"""
+        ensure_worker_thread(self, 'password-rehash')
+        try:
+            self._queue.put_nowait((user_id, old_hash, password))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            metrics.inc('activation_password_rehash_total', result='dropped')
+            return False
+
+    def _run(self):
+        while True:
+            user_id, old_hash, password = self._queue.get()
+            try:
+                self.rehash(user_id, old_hash, password)
+            except KdfBusyError:
+                with self._lock:
+                    self._dropped += 1
+                metrics.inc('activation_password_rehash_total', result='dropped')
+            except Exception as e:
+                with self._lock:
+                    self._failed += 1
+                metrics.inc('activation_password_rehash_total', result='failed')
+                print(f"Ошибка перехеширования пароля: {e}")
+
+    def rehash(self, user_id, old_hash, password):
+        new_hash = hash_password(password)
+        with db_pool.connection() as conn:
+            # Пароль могли сменить, пока мы считали — обновляем только исходный хеш
+            updated = conn.execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                                   (new_hash, user_id, old_hash)).rowcount
+            conn.commit()
+        result = 'rehashed' if updated else 'stale'
+        with self._lock:
+            if updated:
+                self._rehashed += 1
+        metrics.inc('activation_password_rehash_total', result=result)
+        return bool(updated)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+                "queue_size": self.queue_size,
+                "rehashed": self._rehashed,
+                "dropped": self._dropped,
+                "failed": self._failed
+            }
+
+password_rehasher = PasswordRehasher(PASSWORD_REHASH_QUEUE_SIZE)
+
+def _time_kdf(scheme, params, rounds=3):
+    """Медиана времени одного вычисления ключа в текущем процессе"""
+    salt = os.urandom(PASSWORD_SALT_SIZE)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        _derive_key(scheme, b'calibration-password', salt, params)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+@app.cli.command('calibrate-hash')
+@click.option('--target-ms', default=250.0, show_default=True, help='Desired verify time per password.')
+@click.option('--scheme', type=click.Choice(['pbkdf2-sha256', 'scrypt']), default=PASSWORD_HASH_SCHEME,
+              show_default=True, help='Hash algorithm to calibrate.')
+def calibrate_hash_command(target_ms, scheme):
+    """Подобрать параметры хеширования под целевое время проверки на этой машине"""
+    target = target_ms / 1000
+    if scheme == 'pbkdf2-sha256':
+        sample = 20000
+        per_iteration = _time_kdf(scheme, {'i': sample}) / sample
+        iterations = max(int(target / per_iteration) // 1000 * 1000, 10000)
+        params = {'i': iterations}
+        env = {'PBKDF2_ITERATIONS': iterations}
+    else:
+        # Время scrypt растет линейно по n — удваиваем, пока не перешагнем цель
+        params = {'n': 2 ** 12, 'r': SCRYPT_R, 'p': SCRYPT_P}
+        while params['n'] < 2 ** 20:
+            elapsed = _time_kdf(scheme, params, rounds=1)
+            if elapsed >= target or elapsed * 2 - target > target - elapsed:
+                break
+            params['n'] *= 2
+        env = {'SCRYPT_N': params['n'], 'SCRYPT_R': params['r'], 'SCRYPT_P': params['p']}
+    
+    elapsed = _time_kdf(scheme, params)
+    print(f"Scheme: {scheme}")
+    print(f"Parameters: {', '.join(f'{k}={v}' for k, v in sorted(params.items()))}")
+    print(f"Measured verify time: {elapsed * 1000:.1f} ms (target {target_ms:.0f} ms)")
+    print("\nSet in the environment:")
+    print(f"  PASSWORD_HASH_SCHEME={scheme}")
+    for name, value in env.items():
+        print(f"  {name}={value}")
+
+def now_ts():
+    return int(time.time())
+
+def format_ts(ts):
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+# Форматы ответов клиентскому API сохранены такими, какими они были при хранении datetime в базе:
+# регистрация отдавала datetime через jsonify (RFC 822), вход - строку из базы с микросекундами
+def format_http_ts(ts):
+    if ts is None:
+        return None
+    return http_date(datetime.fromtimestamp(ts))
+
+def format_db_ts(ts):
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f')
 
-def calculate_expiry(code_type):
+def calculate_expiry(code_type, start=None):
+    if start is None:
+        start = now_ts()
     if code_type == "forever":
         return None
     elif code_type == "month":
-        return datetime.now() + timedelta(days=30)
+        return start + int(timedelta(days=30).total_seconds())
     elif code_type == "week":
-        return datetime.now() + timedelta(days=7)
+        return start + int(timedelta(days=7).total_seconds())
     elif code_type == "day":
-        return datetime.now() + timedelta(days=1)
+        return start + int(timedelta(days=1).total_seconds())
     else:
-        return datetime.now() + timedelta(days=30)
+        return start + int(timedelta(days=30).total_seconds())
 
-def register_user(username, password, activation_code):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def is_expired(expires_at):
+    return expires_at is not None and now_ts() > expires_at
+
+# ========== ИНДЕКС ИМЕН ПОЛЬЗОВАТЕЛЕЙ ==========
+
+USERNAME_INDEX_REFRESH = float(os.environ.get('USERNAME_INDEX_REFRESH', 2))
+USERNAME_BLOOM_BITS = int(os.environ.get('USERNAME_BLOOM_BITS', 8 * 1024 * 1024))
+USERNAME_BLOOM_HASHES = int(os.environ.get('USERNAME_BLOOM_HASHES', 6))
+USERNAME_CACHE_SIZE = int(os.environ.get('USERNAME_CACHE_SIZE', 100000))
+
+class BloomFilter:
+    def __init__(self, size_bits, hashes):
+        self.size = size_bits
+        self.hashes = hashes
+        self._bits = bytearray((size_bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+class UsernameIndex:
+    """Индекс имен воркера: Bloom-фильтр по всем именам + LRU подтвержденных имен.
     
-    try:
-        conn.execute("BEGIN")
+    Отрицательный ответ фильтра окончателен (с точностью до интервала сверки),
+    положительный подтверждается по LRU или запросом в базу. Новые имена других
+    воркеров догружаются по users.id, когда меняется MAX(id).
+    """
+
+    def __init__(self, refresh_interval, bloom_bits, bloom_hashes, cache_size):
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self._bloom = BloomFilter(bloom_bits, bloom_hashes)
+        self._known = OrderedDict()
+        self._max_id = 0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _remember(self, username):
+        self._known[username] = True
+        self._known.move_to_end(username)
+        if len(self._known) > self.cache_size:
+            self._known.popitem(last=False)
+
+    def refresh(self, force=False, conn=None):
+        if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return
+            with db_pool.connection(conn) as conn:
+                max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+                if max_id > self._max_id:
+                    for user_id, username in conn.execute(
+                            "SELECT id, username FROM users WHERE id > ? ORDER BY id", (self._max_id,)):
+                        self._bloom.add(username)
+                        self._remember(username)
+                    self._max_id = max_id
+            self._last_refresh = time.monotonic()
+
+    def exists(self, username, conn=None):
+        self.refresh(conn=conn)
+        if username not in self._bloom:
+            metrics.inc('activation_username_index_total', result='bloom_negative')
+            return False
         
-        # 1. Проверяем код активации
-        c.execute("SELECT id, used, code_type, expires_at FROM codes WHERE code = ?", (activation_code,))
-        code_data = c.fetchone()
+        with self._lock:
+            if username in self._known:
+                self._known.move_to_end(username)
+                metrics.inc('activation_username_index_total', result='cache_hit')
+                return True
         
-        if not code_data:
-            return {"status": "error", "message": "Invalid activation code"}
+        metrics.inc('activation_username_index_total', result='db')
+        with db_pool.connection(conn) as conn:
+            found = conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+        if found:
+            with self._lock:
+                self._remember(username)
+        return found
+
+    def add(self, username):
+        with self._lock:
+            self._bloom.add(username)
+            self._remember(username)
+
+username_index = UsernameIndex(USERNAME_INDEX_REFRESH, USERNAME_BLOOM_BITS,
+                               USERNAME_BLOOM_HASHES, USERNAME_CACHE_SIZE)
+
+# ========== ИНДЕКС КОДОВ АКТИВАЦИИ ==========
+
+CODE_INDEX_REFRESH = float(os.environ.get('CODE_INDEX_REFRESH', 2))
+CODE_NEGATIVE_CACHE_SIZE = int(os.environ.get('CODE_NEGATIVE_CACHE_SIZE', 10000))
+CODE_NEGATIVE_CACHE_TTL = float(os.environ.get('CODE_NEGATIVE_CACHE_TTL', 300))
+
+class CodeIndex:
+    """Неиспользованные и неистекшие коды воркера + ограниченный кэш отказов.
+    
+    Индекс только отсеивает заведомо неверные коды: успешная активация все равно
+    подтверждается в базе атомарным UPDATE ... WHERE used = 0.
+    """
+
+    def __init__(self, refresh_interval, negative_size, negative_ttl):
+        self.refresh_interval = refresh_interval
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self._codes = {}
+        self._negative = OrderedDict()
+        self._max_version = -1  # строки, созданные до учета версий, имеют row_version = 0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False, conn=None):
+        if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return
+            now = now_ts()
+            # По row_version приходят и новые коды, и погашенные или продленные в других воркерах
+            with db_pool.connection(conn) as conn:
+                rows = conn.execute("""SELECT id, code, code_type, expires_at, used, row_version FROM codes
+                                       WHERE row_version > ? ORDER BY row_version""", (self._max_version,)).fetchall()
+            for code_id, code, code_type, expires_at, used, row_version in rows:
+                self._max_version = row_version
+                if not used and (expires_at is None or expires_at >= now):
+                    self._codes[code] = (code_id, code_type, expires_at)
+                    self._negative.pop(code, None)
+                else:
+                    # Причину отказа lookup уточнит в базе и запомнит в кэше отказов
+                    self._codes.pop(code, None)
+            self._last_refresh = time.monotonic()
+
+    def _reject(self, code, message):
+        with self._lock:
+            self._codes.pop(code, None)
+            self._negative[code] = (message, time.monotonic() + self.negative_ttl)
+            self._negative.move_to_end(code)
+            if len(self._negative) > self.negative_size:
+                self._negative.popitem(last=False)
+        return None, message
+
+    def lookup(self, code, conn=None):
+        """Возвращает ((id, code_type, expires_at), None) или (None, сообщение об ошибке)"""
+        self.refresh(conn=conn)
+        
+        entry = self._codes.get(code)
+        if entry is not None:
+            if is_expired(entry[2]):
+                return self._reject(code, "Code expired")
+            metrics.inc('activation_code_index_total', result='hit')
+            return entry, None
         
-        code_id, used, code_type, expires_at = code_data
+        with self._lock:
+            negative = self._negative.get(code)
+            if negative is not None and negative[1] > time.monotonic():
+                metrics.inc('activation_code_index_total', result='negative_hit')
+                return None, negative[0]
         
+        # Впервые видим код — уточняем причину отказа в базе и запоминаем ее
+        metrics.inc('activation_code_index_total', result='db')
+        with db_pool.connection(conn) as conn:
+            row = conn.execute("SELECT id, used, code_type, expires_at FROM codes WHERE code = ?",
+                               (code,)).fetchone()
+        if not row:
+            return self._reject(code, "Invalid activation code")
+        code_id, used, code_type, expires_at = row
         if used:
-            return {"status": "error", "message": "Code already used"}
+            return self._reject(code, "Code already used")
+        if is_expired(expires_at):
+            return self._reject(code, "Code expired")
         
-        if expires_at:
+        self.add(code_id, code, code_type, expires_at)
+        return (code_id, code_type, expires_at), None
+
+    def add(self, code_id, code, code_type, expires_at):
+        with self._lock:
+            self._codes[code] = (code_id, code_type, expires_at)
+            self._negative.pop(code, None)
+
+    def discard(self, code):
+        self._reject(code, "Code already used")
+
+    def __len__(self):
+        return len(self._codes)
+
+code_index = CodeIndex(CODE_INDEX_REFRESH, CODE_NEGATIVE_CACHE_SIZE, CODE_NEGATIVE_CACHE_TTL)
+
+
+# ========== ГРУППОВАЯ ЗАПИСЬ ==========
+
+# Регистрации и погашения кодов пишет один поток воркера: операции из очереди
+# применяются пачкой в одной транзакции, каждая под своим SAVEPOINT.
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 64))  # 1 — отдельная транзакция на операцию
+WRITE_BATCH_DELAY = float(os.environ.get('WRITE_BATCH_DELAY', 0.002))
+WRITE_QUEUE_SIZE = int(os.environ.get('WRITE_QUEUE_SIZE', 1000))
+
+class WriteQueueFullError(Exception):
+    pass
+
+class WriteOp:
+    def __init__(self, kind, fn, args):
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+
+class WritePipeline:
+    """Поток групповой записи: пачка операций — одна транзакция и один fsync"""
+
+    def __init__(self, max_batch, max_delay, queue_size):
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._batches = 0
+        self._ops = 0
+        self._failed_batches = 0
+        self._max_batch_seen = 0
+        self._commit_total = 0.0
+
+    def _reset(self):
+        # Очередь своя в каждом воркере
+        self._queue = queue.Queue(maxsize=max(self.queue_size, 1))
+
+    def execute(self, kind, fn, *args):
+        """Выполняет fn(cursor, *args) в пачке и ждет ее коммита.
+        
+        fn возвращает (result, on_commit): операция с result["status"] != "success"
+        откатывается до своего SAVEPOINT, on_commit вызывается после фиксации пачки.
+        """
+        op = WriteOp(kind, fn, args)
+        if self.max_batch == 1:
+            self._apply([op])
+        else:
+            ensure_worker_thread(self, 'write-pipeline')
             try:
-                expires_date = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S.%f')
-            except:
-                expires_date = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
-            
-            if datetime.now() > expires_date:
-                return {"status": "error", "message": "Code expired"}
+                self._queue.put_nowait(op)
+            except queue.Full:
+                raise WriteQueueFullError("Write queue is full")
+        return op.future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._apply(batch)
+
+    def _apply(self, batch):
+        outcomes = []
+        start = time.perf_counter()
+        try:
+            with db_pool.connection() as conn:
+                with metrics.timer('activation_db_lock_wait_seconds', op='write_batch'):
+                    conn.execute("BEGIN IMMEDIATE")
+                c = conn.cursor()
+                for op in batch:
+                    c.execute("SAVEPOINT write_op")
+                    try:
+                        result, on_commit = op.fn(c, *op.args)
+                    except Exception as e:
+                        c.execute("ROLLBACK TO write_op")
+                        c.execute("RELEASE write_op")
+                        outcomes.append((op, None, None, e))
+                        continue
+                    if result.get("status") != "success":
+                        c.execute("ROLLBACK TO write_op")
+                    c.execute("RELEASE write_op")
+                    outcomes.append((op, result, on_commit, None))
+                with metrics.timer('activation_db_query_seconds', phase='write_commit'):
+                    conn.commit()
+        except Exception as e:
+            # Пачка не записалась целиком — каждая операция получает ту же ошибку
+            with self._lock:
+                self._failed_batches += 1
+            for op in batch:
+                op.future.set_exception(e)
+            return
         
-        # 2. Проверяем не занят ли username
-        c.execute("SELECT id FROM users WHERE username = ?", (username,))
-        if c.fetchone():
-            return {"status": "error", "message": "Username already exists"}
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._batches += 1
+            self._ops += len(batch)
+            self._max_batch_seen = max(self._max_batch_seen, len(batch))
+            self._commit_total += elapsed
+        metrics.inc('activation_write_batches_total')
         
-        # 3. Создаем пользователя
-        password_hash = hash_password(password)
+        for op, result, on_commit, error in outcomes:
+            metrics.inc('activation_write_ops_total', kind=op.kind,
+                        result='exception' if error else result.get("status"))
+            if error is not None:
+                op.future.set_exception(error)
+                continue
+            if on_commit is not None:
+                try:
+                    on_commit()
+                except Exception as e:
+                    print(f"Ошибка обработчика после записи: {e}")
+            op.future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_delay_ms": round(self.max_delay * 1000, 3),
+                "queue_size": self.queue_size,
+                "queued": self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+                "batches": self._batches,
+                "ops": self._ops,
+                "failed_batches": self._failed_batches,
+                "max_batch_seen": self._max_batch_seen,
+                "avg_batch": round(self._ops / self._batches, 2) if self._batches else 0.0,
+                "avg_batch_ms": round(self._commit_total * 1000 / self._batches, 3) if self._batches else 0.0
+            }
+
+write_pipeline = WritePipeline(WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, WRITE_QUEUE_SIZE)
+
+def _register_op(c, username, password_hash, code_id, code_type, activation_code):
+    # Код помечается использованным и пользователь создается под одним SAVEPOINT
+    c.execute("UPDATE codes SET used = 1 WHERE id = ? AND used = 0", (code_id,))
+    if c.rowcount == 0:
+        return {"status": "error", "message": "Code already used"}, lambda: code_index.discard(activation_code)
+    
+    try:
         c.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
-                 (username, password_hash, datetime.now()))
-        user_id = c.lastrowid
-        
-        # 4. Помечаем код как использованный
-        c.execute("UPDATE codes SET used = 1 WHERE id = ?", (code_id,))
-        
-        # 5. Записываем активацию
-        activation_expiry = calculate_expiry(code_type)
-        c.execute("""INSERT INTO activations (user_id, code_id, activated_at, expires_at) 
-                     VALUES (?, ?, ?, ?)""",
-                 (user_id, code_id, datetime.now(), activation_expiry))
+                  (username, password_hash, now_ts()))
+    except sqlite3.IntegrityError:
+        return {"status": "error", "message": "Username already exists"}, None
+    user_id = c.lastrowid
+    
+    activation_expiry = calculate_expiry(code_type)
+    c.execute("""INSERT INTO activations (user_id, code_id, activated_at, expires_at) 
+                 VALUES (?, ?, ?, ?)""",
+              (user_id, code_id, now_ts(), activation_expiry))
+    
+    def on_commit():
+        username_index.add(username)
+        code_index.discard(activation_code)
+    
+    return {
+        "status": "success",
+        "message": "Registration successful",
+        "user_id": user_id,
+        "code_type": code_type,
+        "expires_at": format_http_ts(activation_expiry)
+    }, on_commit
+
+# Порядок типов подписки: при продлении тип не становится "короче"
+CODE_TYPE_RANK = {"day": 0, "week": 1, "month": 2, "forever": 3}
+
+def _redeem_op(c, user_id, code_id, code_type, activation_code):
+    c.execute("SELECT 1 FROM users WHERE id = ?", (user_id,))
+    if c.fetchone() is None:
+        return {"status": "error", "message": "User not found"}, None
+    
+    current = c.execute("SELECT code_type, expires_at, is_forever FROM user_subscription WHERE user_id = ?",
+                        (user_id,)).fetchone()
+    if current is not None and current[2]:
+        # Бессрочную подписку нечем продлить — код не тратим
+        return {"status": "error", "message": "Subscription is already forever"}, None
+    
+    c.execute("UPDATE codes SET used = 1 WHERE id = ? AND used = 0", (code_id,))
+    if c.rowcount == 0:
+        return {"status": "error", "message": "Code already used"}, lambda: code_index.discard(activation_code)
+    
+    # Новый код продлевает текущую подписку от ее окончания, а не заменяет ее
+    now = now_ts()
+    start = max(now, current[1]) if current is not None and current[1] is not None else now
+    activation_expiry = calculate_expiry(code_type, start)
+    c.execute("""INSERT INTO activations (user_id, code_id, activated_at, expires_at) 
+                 VALUES (?, ?, ?, ?)""",
+              (user_id, code_id, now, activation_expiry))
+    if current is not None and CODE_TYPE_RANK.get(current[0], 0) > CODE_TYPE_RANK.get(code_type, 0):
+        # Триггер записал тип погашенного кода; оставляем прежний, более длинный
+        code_type = current[0]
+        c.execute("UPDATE user_subscription SET code_type = ? WHERE user_id = ?", (code_type, user_id))
+    
+    def on_commit():
+        code_index.discard(activation_code)
+        subscription_cache.delete(user_id)
+    
+    return {
+        "status": "success",
+        "message": "Code redeemed",
+        "user_id": user_id,
+        "code_type": code_type,
+        "expires_at": format_http_ts(activation_expiry)
+    }, on_commit
+
+def register_user(username, password, activation_code):
+    conn = db_pool.acquire()
+    
+    try:
+        # 1. Проверяем код активации по индексу воркера
+        with metrics.timer('activation_db_query_seconds', phase='register_code_lookup'):
+            code_data, error = code_index.lookup(activation_code, conn)
         
-        conn.commit()
+        if error:
+            return {"status": "error", "message": error}
         
-        return {
-            "status": "success",
-            "message": "Registration successful",
-            "user_id": user_id,
-            "code_type": code_type,
-            "expires_at": activation_expiry
-        }
+        code_id, code_type, _ = code_data
         
+        # 2. Проверяем не занят ли username
+        # Уникальность окончательно проверяется ограничением UNIQUE при вставке
+        if username_index.exists(username, conn):
+            return {"status": "error", "message": "Username already exists"}
+    
     except Exception as e:
-        conn.rollback()
         return {"status": "error", "message": f"Registration failed: {str(e)}"}
     
     finally:
-        conn.close()
+        # Соединение не нужно ни на время хеширования, ни на время ожидания пачки
+        db_pool.release(conn)
+    
+    try:
+        # 3. Хешируем пароль до записи, чтобы не держать блокировку
+        password_hash = hash_password(password)
+        
+        # 4. Код, пользователь и активация пишутся атомарно в общей пачке
+        with metrics.timer('activation_db_query_seconds', phase='register_write'):
+            return write_pipeline.execute('register', _register_op, username, password_hash,
+                                          code_id, code_type, activation_code)
+    
+    except (KdfBusyError, WriteQueueFullError):
+        raise
+    
+    except Exception as e:
+        return {"status": "error", "message": f"Registration failed: {str(e)}"}
 
-def login_user(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def redeem_code(user_id, activation_code):
+    try:
+        with db_pool.connection() as conn:
+            code_data, error = code_index.lookup(activation_code, conn)
+        if error:
+            return {"status": "error", "message": error}
+        
+        code_id, code_type, _ = code_data
+        return write_pipeline.execute('redeem', _redeem_op, user_id, code_id, code_type, activation_code)
+    
+    except WriteQueueFullError:
+        raise
     
+    except Exception as e:
+        return {"status": "error", "message": f"Redeem failed: {str(e)}"}
+
+
+LAST_LOGIN_FLUSH_INTERVAL = float(os.environ.get('LAST_LOGIN_FLUSH_INTERVAL', 5))
+LAST_LOGIN_BUFFER_SIZE = int(os.environ.get('LAST_LOGIN_BUFFER_SIZE', 1000))
+
+class LastLoginBuffer:
+    """Отложенная запись last_login и поминутных счетчиков входов: копим в памяти воркера
+    и сбрасываем одной транзакцией"""
+
+    def __init__(self, interval, max_size):
+        self.interval = interval
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        self._logins = {}
+        self._thread = None
+        self._pid = None
+        self._flushes = 0
+        self._flushed_rows = 0
+        self._last_flush_ms = 0.0
+
+    def _reset(self):
+        # Накопленное родителем до fork запишет он сам
+        self._pending = {}
+        self._logins = {}
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Ошибка записи last_login: {e}")
+
+    def record(self, user_id, ts):
+        ensure_worker_thread(self, 'last-login-flush')
+        with self._lock:
+            self._pending[user_id] = max(ts, self._pending.get(user_id, 0))
+            self._logins[ts // 60] = self._logins.get(ts // 60, 0) + 1
+            full = len(self._pending) >= self.max_size
+        if full:
+            self._wake.set()
+
+    def get(self, user_id):
+        with self._lock:
+            return self._pending.get(user_id)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending or self._pid != os.getpid():
+                return 0
+            items, self._pending = self._pending, {}
+            logins, self._logins = self._logins, {}
+        
+        days = {}
+        for minute, count in logins.items():
+            days[minute * 60 // 86400] = days.get(minute * 60 // 86400, 0) + count
+        
+        start = time.perf_counter()
+        try:
+            with db_pool.connection() as conn:
+                with metrics.timer('activation_db_lock_wait_seconds', op='last_login_flush'):
+                    conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("""UPDATE users SET last_login = ?
+                                    WHERE id = ? AND (last_login IS NULL OR last_login < ?)""",
+                                 [(ts, user_id, ts) for user_id, ts in items.items()])
+                conn.executemany("""INSERT INTO activity_minutes (event, minute, count) VALUES ('login', ?, ?)
+                                    ON CONFLICT(event, minute) DO UPDATE SET count = count + excluded.count""",
+                                 list(logins.items()))
+                conn.executemany("""INSERT INTO activity_days (event, day, count) VALUES ('login', ?, ?)
+                                    ON CONFLICT(event, day) DO UPDATE SET count = count + excluded.count""",
+                                 list(days.items()))
+                conn.commit()
+        except Exception:
+            # Возвращаем неудачную пачку в буфер, не затирая более свежие значения
+            with self._lock:
+                for user_id, ts in items.items():
+                    self._pending[user_id] = max(ts, self._pending.get(user_id, 0))
+                for minute, count in logins.items():
+                    self._logins[minute] = self._logins.get(minute, 0) + count
+            raise
+        
+        with self._lock:
+            self._flushes += 1
+            self._flushed_rows += len(items)
+            self._last_flush_ms = (time.perf_counter() - start) * 1000
+        return len(items)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "max_size": self.max_size,
+                "flush_interval": self.interval,
+                "flushes": self._flushes,
+                "flushed_rows": self._flushed_rows,
+                "last_flush_ms": round(self._last_flush_ms, 3)
+            }
+
+last_login_buffer = LastLoginBuffer(LAST_LOGIN_FLUSH_INTERVAL, LAST_LOGIN_BUFFER_SIZE)
+atexit.register(last_login_buffer.flush)
+
+def login_user(username, password):
     try:
-        # Ищем пользователя
-        c.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
-        user_data = c.fetchone()
+        # Ищем пользователя вместе с его текущей подпиской
+        # Соединение возвращаем в пул до KDF: очередь и хеширование могут занять секунды
+        with db_pool.connection() as conn, metrics.timer('activation_db_query_seconds', phase='login_lookup'):
+            user_data = conn.execute("""SELECT u.id, u.password_hash, s.code_type, s.expires_at
+                                        FROM users u
+                                        LEFT JOIN user_subscription s ON s.user_id = u.id
+                                        WHERE u.username = ?""", (username,)).fetchone()
         
         if not user_data:
             return {"status": "error", "message": "Invalid username or password"}
         
-        user_id, stored_hash = user_data
+        user_id, stored_hash, code_type, expires_at = user_data
         
         # Проверяем пароль
         if not verify_password(stored_hash, password):
             return {"status": "error", "message": "Invalid username or password"}
         
-        # Обновляем время последнего входа
-        c.execute("UPDATE users SET last_login = ? WHERE id = ?", (datetime.now(), user_id))
+        # Хеш со старыми параметрами пересчитываем в фоне, ответ не ждет
+        if needs_rehash(stored_hash):
+            password_rehasher.submit(user_id, stored_hash, password)
         
-        # Получаем информацию об активации
-        c.execute("""SELECT a.expires_at, c.code_type 
-                     FROM activations a 
-                     JOIN codes c ON a.code_id = c.id 
-                     WHERE a.user_id = ? 
-                     ORDER BY a.activated_at DESC LIMIT 1""", (user_id,))
-        activation_data = c.fetchone()
+        # Время последнего входа пишется в базу пачками в фоне
+        last_login_buffer.record(user_id, now_ts())
         
-        expires_at = None
-        code_type = "forever"
-        if activation_data:
-            expires_at, code_type = activation_data
+        # Без активаций пользователь считается бессрочным
+        if code_type is None:
+            code_type = "forever"
         
         # Проверяем не истекла ли активация
-        is_active = True
-        if expires_at:
-            try:
-                expires_date = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S.%f')
-            except:
-                expires_date = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
-            
-            if datetime.now() > expires_date:
-                is_active = False
+        is_active = not is_expired(expires_at)
         
-        conn.commit()
+        subscription_cache.set(user_id, (code_type, expires_at))
+        token, token_expires_at = issue_session_token(user_id)
         
         return {
             "status": "success",
@@ -206,47 +1760,1462 @@ def login_user(username, password):
             "user_id": user_id,
             "is_active": is_active,
             "code_type": code_type,
-            "expires_at": expires_at
+            "expires_at": format_db_ts(expires_at),
+            "token": token,
+            "token_expires_at": token_expires_at
         }
         
+    except KdfBusyError:
+        raise
+    
     except Exception as e:
         return {"status": "error", "message": f"Login failed: {str(e)}"}
-    
-    finally:
-        conn.close()
 
 def add_code_with_type(code, code_type):
     expires_at = calculate_expiry(code_type)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_pool.acquire()
     c = conn.cursor()
     
     try:
         c.execute("""INSERT INTO codes (code, code_type, created_at, expires_at) 
                      VALUES (?, ?, ?, ?)""", 
-                 (code, code_type, datetime.now(), expires_at))
+                 (code, code_type, now_ts(), expires_at))
         conn.commit()
+        code_index.add(c.lastrowid, code, code_type, expires_at)
         return True
     except sqlite3.IntegrityError:
         return False
+    finally:
+        db_pool.release(conn)
+
+TEST_CODES = [
+    ("fG956kGo9", "forever"),
+    ("MONTH12345", "month"),
+    ("WEEK67890", "week"),
+    ("DAY54321", "day"),
+    ("TESTFOREVER", "forever")
+]
+
+def add_test_codes(conn=None):
+    # Одна транзакция; уже существующие коды пропускаются
+    with db_pool.connection(conn) as conn:
+        return len(insert_codes(conn, TEST_CODES))
+
+def test_codes_seeded(conn):
+    placeholders = ','.join('?' * len(TEST_CODES))
+    count = conn.execute(f"SELECT COUNT(*) FROM codes WHERE code IN ({placeholders})",
+                         [code for code, _ in TEST_CODES]).fetchone()[0]
+    return count == len(TEST_CODES)
+
+# ========== ИСТЕЧЕНИЕ СРОКОВ ==========
+# Фоновый обход помечает истекшие коды и подписки (столбец expired) и пишет
+# события в expiry_events. Поток есть в каждом воркере, но обходит базу только
+# владелец аренды в таблице leases — остальные раз в интервал пробуют ее взять.
+
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get('EXPIRY_SWEEP_INTERVAL', 10))  # 0 — обход выключен
+EXPIRY_SWEEP_BATCH = int(os.environ.get('EXPIRY_SWEEP_BATCH', 500))  # строк за транзакцию
+EXPIRY_EVENT_RETENTION = int(os.environ.get('EXPIRY_EVENT_RETENTION', 7 * 86400))
+
+# (событие, таблица, ключ) в порядке обхода
+EXPIRY_TARGETS = (
+    ('code', 'codes', 'id'),
+    ('subscription', 'user_subscription', 'user_id'),
+)
+
+class ExpirySweeper:
+    """Пометка истекших строк пачками в порядке индекса по expires_at"""
+
+    lease_name = 'expiry-sweeper'
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._is_owner = False
+        self._sweeps = 0
+        self._expired = {event: 0 for event, _, _ in EXPIRY_TARGETS}
+        self._last_sweep = None
+        self._last_sweep_ms = 0.0
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        # Поток свой в каждом воркере; аренда решает, кто из них работает
+        if self.interval > 0:
+            ensure_worker_thread(self, 'expiry-sweeper')
+
+    def _reset(self):
+        self._is_owner = False
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Ошибка обхода истекших сроков: {e}")
+            time.sleep(self.interval)
+
+    def _renew_lease(self, conn, now):
+        # Берем свободную или просроченную аренду либо продлеваем свою
+        c = conn.execute("""INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                            WHERE leases.owner = excluded.owner OR leases.expires_at < ?""",
+                         (self.lease_name, self.owner, now + max(int(self.interval * 3), 30), now))
+        return c.rowcount > 0
+
+    def sweep(self):
+        """Один проход; возвращает число помеченных строк по видам или None, если аренда у другого процесса"""
+        start = time.perf_counter()
+        counts = {}
+        with db_pool.connection() as conn:
+            # Чужую живую аренду видно обычным чтением — не ждем блокировку записи
+            lease = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (self.lease_name,)).fetchone()
+            if lease is not None and lease[0] != self.owner and lease[1] >= now_ts():
+                with self._lock:
+                    self._is_owner = False
+                return None
+            
+            for event, table, key in EXPIRY_TARGETS:
+                counts[event] = 0
+                while True:
+                    with metrics.timer('activation_db_lock_wait_seconds', op='expiry_sweep'):
+                        conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        now = now_ts()
+                        # Аренда продлевается в каждой пачке: потеряли — сразу останавливаемся
+                        if not self._renew_lease(conn, now):
+                            conn.rollback()
+                            with self._lock:
+                                self._is_owner = False
+                            return None
+                        rows = conn.execute(f"""SELECT {key}, expires_at FROM {table}
+                                                WHERE expired = 0 AND expires_at < ?
+                                                ORDER BY expires_at LIMIT ?""", (now, self.batch_size)).fetchall()
+                        conn.executemany(f"UPDATE {table} SET expired = 1 WHERE {key} = ?", [(row[0],) for row in rows])
+                        conn.executemany("""INSERT INTO expiry_events (entity, entity_id, expires_at, created_at)
+                                            VALUES (?, ?, ?, ?)""", [(event, row[0], row[1], now) for row in rows])
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    counts[event] += len(rows)
+                    if len(rows) < self.batch_size:
+                        break
+            
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM expiry_events WHERE created_at < ?", (now_ts() - EXPIRY_EVENT_RETENTION,))
+            conn.commit()
+        
+        for event, count in counts.items():
+            if count:
+                metrics.inc('activation_expired_total', count, entity=event)
+        with self._lock:
+            self._is_owner = True
+            self._sweeps += 1
+            for event, count in counts.items():
+                self._expired[event] += count
+            self._last_sweep = now_ts()
+            self._last_sweep_ms = round((time.perf_counter() - start) * 1000, 3)
+        return counts
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "batch_size": self.batch_size,
+                "running": self._pid == os.getpid(),
+                "lease_owner": self._is_owner,
+                "sweeps": self._sweeps,
+                "expired": dict(self._expired),
+                "last_sweep": format_ts(self._last_sweep),
+                "last_sweep_ms": self._last_sweep_ms
+            }
+
+expiry_sweeper = ExpirySweeper(EXPIRY_SWEEP_INTERVAL, EXPIRY_SWEEP_BATCH)
+
+@app.cli.command('sweep-expired')
+def sweep_expired_command():
+    """Пометить истекшие коды и подписки одним проходом"""
+    counts = expiry_sweeper.sweep()
+    if counts is None:
+        print("Another process holds the expiry sweeper lease")
+        return
+    for event, count in counts.items():
+        print(f"{event}: {count} expired")
+
+# ========== МАССОВЫЕ КОДЫ ==========
+
+CODE_TYPES = ['forever', 'month', 'week', 'day']
+CODE_ALPHABET = os.environ.get('CODE_ALPHABET', 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789')
+CODE_LENGTH = int(os.environ.get('CODE_LENGTH', 12))
+CODE_MAX_LENGTH = 64
+CODE_GENERATE_MAX = int(os.environ.get('CODE_GENERATE_MAX', 100000))
+CODE_GENERATE_ATTEMPTS = int(os.environ.get('CODE_GENERATE_ATTEMPTS', 5))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+def insert_codes(conn, rows):
+    """Вставляет пачку (code, code_type) одной транзакцией, пропуская существующие коды.
+    
+    Возвращает список вставленных строк (code, code_type, created_at, expires_at).
+    """
+    now = now_ts()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Под блокировкой на запись новые id идут строго после текущего максимума
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM codes").fetchone()[0]
+        conn.executemany("""INSERT OR IGNORE INTO codes (code, code_type, created_at, expires_at)
+                            VALUES (?, ?, ?, ?)""",
+                         [(code, code_type, now, calculate_expiry(code_type)) for code, code_type in rows])
+        inserted = conn.execute("""SELECT code, code_type, created_at, expires_at FROM codes
+                                   WHERE id > ? ORDER BY id""", (max_id,)).fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    code_index.refresh(force=True, conn=conn)
+    return inserted
+
+def generate_codes(count, code_type, length=CODE_LENGTH, alphabet=CODE_ALPHABET):
+    """Генерирует count уникальных кодов; при коллизиях догенерирует недостающие"""
+    created = []
+    attempts = 0
+    with db_pool.connection() as conn:
+        while len(created) < count:
+            chunk_size = min(count - len(created), BULK_CHUNK_SIZE)
+            candidates = {''.join(secrets.choice(alphabet) for _ in range(length))
+                          for _ in range(chunk_size)}
+            inserted = insert_codes(conn, [(code, code_type) for code in candidates])
+            created.extend(inserted)
+            
+            # Пачка целиком из коллизий — пространство кодов почти исчерпано
+            if not inserted:
+                attempts += 1
+                if attempts >= CODE_GENERATE_ATTEMPTS:
+                    break
+            else:
+                attempts = 0
+    return created
+
+class CodeImportError(ValueError):
+    """Некорректная строка импорта; все строки до нее уже записаны"""
+
+    def __init__(self, message, line, created, duplicates, invalid):
+        super().__init__(message)
+        self.line = line
+        self.created = created
+        self.duplicates = duplicates
+        self.invalid = invalid
+
+def import_codes(lines, fmt, default_type):
+    """Импортирует коды из потока байтовых строк CSV (code[,code_type]) или NDJSON пачками.
+    
+    На некорректной строке записывает все предыдущие и бросает CodeImportError с номером строки.
+    """
+    created, duplicates, invalid = [], 0, 0
+    batch = []
+    line = 0
+    
+    def flush():
+        nonlocal duplicates
+        with db_pool.connection() as conn:
+            inserted = insert_codes(conn, batch)
+        created.extend(inserted)
+        duplicates += len(batch) - len(inserted)
+        batch.clear()
+    
+    def decoded():
+        # Декодируем построчно, чтобы ошибка кодировки указывала на свою строку
+        nonlocal line
+        for raw in lines:
+            line += 1
+            yield raw.decode('utf-8')
+    
+    rows = csv.reader(decoded()) if fmt == 'csv' else decoded()
+    try:
+        for row in rows:
+            if fmt == 'csv':
+                if not row or row[0].strip().lower() == 'code':
+                    continue
+                code = row[0].strip()
+                code_type = row[1].strip() if len(row) > 1 and row[1].strip() else default_type
+            else:
+                if not row.strip():
+                    continue
+                row = json.loads(row)
+                code = str(row.get('code', '')).strip() if isinstance(row, dict) else ''
+                code_type = row.get('code_type') or default_type if isinstance(row, dict) else None
+            
+            if not code or len(code) > CODE_MAX_LENGTH or code_type not in CODE_TYPES:
+                invalid += 1
+                continue
+            
+            batch.append((code, code_type))
+            if len(batch) >= BULK_CHUNK_SIZE:
+                flush()
+    except (ValueError, csv.Error) as e:
+        # Дописываем строки до ошибки: клиент продолжает импорт с этой строки
+        if batch:
+            flush()
+        raise CodeImportError(f"line {line}: {e}", line, created, duplicates, invalid)
+    
+    if batch:
+        flush()
+    return created, duplicates, invalid
+
+def codes_csv_response(rows):
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(['code', 'code_type', 'created_at', 'expires_at'])
+        for i, (code, code_type, created_at, expires_at) in enumerate(rows, 1):
+            writer.writerow([code, code_type, format_ts(created_at), format_ts(expires_at) or ''])
+            if i % BULK_CHUNK_SIZE == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    
+    filename = f"codes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# ========== СЕССИОННЫЕ ТОКЕНЫ ==========
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 7 * 24 * 3600))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 60))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+SESSION_REVOCATION_REFRESH = float(os.environ.get('SESSION_REVOCATION_REFRESH', 5))
+
+class TTLCache:
+    """Потокобезопасный словарь с временем жизни записей и ограничением размера"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if time.monotonic() > expires:
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                # Вытесняем самую старую запись (dict сохраняет порядок вставки)
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+def _load_session_secret():
+    secret = os.environ.get('SESSION_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    
+    # Общий для всех воркеров ключ хранится рядом с базой
+    path = os.environ.get('SESSION_SECRET_PATH', DB_PATH + '.session_key')
+    if not os.path.exists(path):
+        # Ключ пишется во временный файл и появляется под своим именем уже целиком:
+        # параллельно стартующий процесс не прочитает пустой или недописанный файл
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secrets.token_bytes(32))
+                f.flush()
+                os.fsync(f.fileno())
+            # link, в отличие от replace, не затрет ключ, который другой процесс успел создать раньше
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) < 32:
+        raise RuntimeError(f"Session key file {path} is shorter than 32 bytes; remove it to generate a new key")
+    return key
+
+SESSION_SECRET = _load_session_secret()
+
+subscription_cache = TTLCache(SESSION_CACHE_TTL, SESSION_CACHE_SIZE)
+
+def _sign(payload):
+    return hmac.new(SESSION_SECRET, payload.encode('ascii'), hashlib.sha256).digest()
+
+def issue_session_token(user_id):
+    expires_at = int(time.time()) + SESSION_TTL
+    payload = _b64encode(json.dumps(
+        {"uid": user_id, "exp": expires_at, "jti": secrets.token_urlsafe(12)},
+        separators=(',', ':')).encode('utf-8'))
+    return f"{payload}.{_b64encode(_sign(payload))}", expires_at
+
+def decode_session_token(token):
+    """Возвращает полезную нагрузку токена или None, если токен невалиден"""
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(_b64decode(signature), _sign(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    
+    if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+        return None
+    if revocation_list.is_revoked(claims.get('jti')):
+        return None
+    return claims
+
+class RevocationList:
+    """Локальная копия revoked_sessions, догружаемая по rowid не чаще раза в несколько секунд"""
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._revoked = {}
+        self._last_rowid = 0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        with db_pool.connection() as conn:
+            rows = conn.execute("SELECT rowid, jti, expires_at FROM revoked_sessions WHERE rowid > ?",
+                                (self._last_rowid,)).fetchall()
+        now = time.time()
+        for rowid, jti, expires_at in rows:
+            self._revoked[jti] = expires_at
+            self._last_rowid = max(self._last_rowid, rowid)
+        for jti in [j for j, exp in self._revoked.items() if exp < now]:
+            del self._revoked[jti]
+        self._last_refresh = time.monotonic()
+
+    def is_revoked(self, jti):
+        if time.monotonic() - self._last_refresh > self.refresh_interval:
+            with self._lock:
+                if time.monotonic() - self._last_refresh > self.refresh_interval:
+                    self._refresh()
+        return jti in self._revoked
+
+    def revoke(self, jti, expires_at):
+        with db_pool.connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO revoked_sessions (jti, expires_at) VALUES (?, ?)",
+                         (jti, expires_at))
+            conn.execute("DELETE FROM revoked_sessions WHERE expires_at < ?", (int(time.time()),))
+            conn.commit()
+        with self._lock:
+            self._revoked[jti] = expires_at
+
+revocation_list = RevocationList(SESSION_REVOCATION_REFRESH)
+
+def get_subscription(user_id):
+    cached = subscription_cache.get(user_id)
+    if cached is not None:
+        return cached
+    
+    with db_pool.connection() as conn:
+        row = conn.execute("SELECT code_type, expires_at FROM user_subscription WHERE user_id = ?",
+                           (user_id,)).fetchone()
+    
+    subscription = ("forever", None)
+    if row:
+        subscription = (row[0], row[1])
+    subscription_cache.set(user_id, subscription)
+    return subscription
+
+def _request_token():
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        return auth[7:].strip()
+    data = request.get_json(silent=True) or {}
+    token = data.get('token')
+    return token.strip() if isinstance(token, str) else None
+
+# ========== РЕЗЕРВНЫЕ КОПИИ ==========
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR', DB_PATH + '.backups')
+BACKUP_PAGES = int(os.environ.get('BACKUP_PAGES', 256))  # страниц за шаг; 0 — все сразу
+BACKUP_SLEEP = float(os.environ.get('BACKUP_SLEEP', 0.01))  # пауза между шагами, сек
+
+# Столбцы экспорта; производные таблицы при восстановлении пересчитываются
+EXPORT_TABLES = {
+    'codes': ('id', 'code', 'used', 'code_type', 'created_at', 'expires_at'),
+    'users': ('id', 'username', 'password_hash', 'created_at', 'last_login'),
+    'activations': ('id', 'user_id', 'code_id', 'activated_at', 'expires_at'),
+    # Ключ сессий переживает восстановление — без списка отзывов отозванные токены снова стали бы валидны
+    'revoked_sessions': ('jti', 'expires_at'),
+}
+
+class BackupInProgressError(Exception):
+    pass
+
+def backup_database(dest=None, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP):
+    """Онлайн-копия базы через backup API: pages страниц за шаг, пауза sleep между шагами"""
+    if dest is None:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        dest = os.path.join(BACKUP_DIR, f"activation-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    tmp_path = dest + '.tmp'
+    
+    with open(DB_PATH + '.backup.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise BackupInProgressError("Another backup is already running")
+        
+        steps = 0
+        def progress(status, remaining, total):
+            nonlocal steps
+            steps += 1
+            if remaining and sleep > 0:
+                time.sleep(sleep)
+        
+        start = time.perf_counter()
+        src = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            # Открытая транзакция чтения фиксирует снимок WAL: без нее каждая запись
+            # другого соединения перезапускала бы копирование с первой страницы
+            src.execute("BEGIN")
+            src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            src.backup(dst, pages=pages, progress=progress)
+            src.rollback()
+        except Exception:
+            dst.close()
+            os.remove(tmp_path)
+            raise
+        finally:
+            src.close()
+        dst.close()
+        os.replace(tmp_path, dest)
+    
+    return {
+        "path": dest,
+        "size": os.path.getsize(dest),
+        "steps": steps,
+        "pages_per_step": pages,
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+
+def _export_value(value):
+    # Старые хеши паролей хранятся байтами
+    if isinstance(value, bytes):
+        return {"b64": base64.b64encode(value).decode('ascii')}
+    return value
+
+def _import_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["b64"])
+    return value
+
+def export_rows():
+    """Строки NDJSON с таблицами EXPORT_TABLES из одного снимка базы"""
+    # Снимок держит транзакцию чтения все время скачивания — не на соединении пула
+    with stream_connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            yield json.dumps({"type": "header", "schema_version": schema_version(conn),
+                              "data_version": data_version(conn), "exported_at": now_ts()}) + '\n'
+            for table, columns in EXPORT_TABLES.items():
+                c = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+                while True:
+                    rows = c.fetchmany(ADMIN_STREAM_BATCH)
+                    if not rows:
+                        break
+                    yield ''.join(json.dumps({"table": table, "row": dict(zip(columns, map(_export_value, row)))}) + '\n'
+                                  for row in rows)
+        finally:
+            conn.rollback()
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def open_export(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rt', encoding='utf-8') if compressed else open(path, encoding='utf-8')
+
+def restore_export(lines, target):
+    """Собирает новую базу из экспорта: сначала данные, потом индексы, производные таблицы и триггеры"""
+    tmp_path = target + '.restore'
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(tmp_path + suffix):
+            os.remove(tmp_path + suffix)
+    
+    start = time.perf_counter()
+    counts = {table: 0 for table in EXPORT_TABLES}
+    conn = sqlite3.connect(tmp_path)
+    try:
+        init_db(conn)
+        # Индексы и триггеры создадим после загрузки: так они строятся один раз, а не на каждую строку
+        deferred = conn.execute("""SELECT type, name, sql FROM sqlite_master
+                                   WHERE type IN ('index', 'trigger') AND sql IS NOT NULL""").fetchall()
+        for kind, name, _ in deferred:
+            conn.execute(f"DROP {kind.upper()} {name}")
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        
+        header = {}
+        batches = {table: [] for table in EXPORT_TABLES}
+        inserts = {table: f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+                   for table, columns in EXPORT_TABLES.items()}
+        
+        conn.execute("BEGIN")
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("type") == "header":
+                header = record
+                continue
+            table = record["table"]
+            if table not in EXPORT_TABLES:
+                raise ValueError(f"Unknown table in export: {table}")
+            row = record["row"]
+            batches[table].append([_import_value(row.get(column)) for column in EXPORT_TABLES[table]])
+            if len(batches[table]) >= BULK_CHUNK_SIZE:
+                conn.executemany(inserts[table], batches[table])
+                counts[table] += len(batches[table])
+                batches[table] = []
+        for table, batch in batches.items():
+            conn.executemany(inserts[table], batch)
+            counts[table] += len(batch)
+        
+        for kind, _, sql in deferred:
+            if kind == 'index':
+                conn.execute(sql)
+        conn.execute(SUBSCRIPTION_BACKFILL_SQL)
+        for sql in STATS_BACKFILL_SQL + EXPIRY_BACKFILL_SQL:
+            conn.execute(sql)
+        # Версия данных растет и после восстановления, чтобы старые ETag не совпали,
+        # а все строки получают ее как row_version: клиенты с ?since= перечитают их целиком
+        version = header.get("data_version", 0) + 1
+        conn.execute("UPDATE data_version SET version = ?", (version,))
+        conn.execute("UPDATE codes SET row_version = ?", (version,))
+        conn.execute("UPDATE users SET row_version = ?", (version,))
+        for kind, _, sql in deferred:
+            if kind == 'trigger':
+                conn.execute(sql)
+        conn.commit()
+        
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("ANALYZE")
     finally:
         conn.close()
+    
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(tmp_path, target)
+    return {"target": target, "rows": counts, "seconds": round(time.perf_counter() - start, 3)}
+
+@app.cli.command('backup')
+@click.option('--output', help='Destination file (default: a timestamped file in BACKUP_DIR).')
+@click.option('--pages', default=BACKUP_PAGES, show_default=True, help='Pages copied per step; 0 copies everything at once.')
+@click.option('--sleep', default=BACKUP_SLEEP, show_default=True, help='Seconds to pause between steps.')
+def backup_command(output, pages, sleep):
+    """Онлайн-копия базы без остановки записи"""
+    result = backup_database(output, pages, sleep)
+    print(f"Backup: {result['path']} ({result['size']} bytes, {result['steps']} steps, {result['seconds']} s)")
+
+@app.cli.command('export')
+@click.argument('output')
+def export_command(output):
+    """Выгрузить codes, users, activations и отозванные сессии в gzip NDJSON"""
+    with open(output, 'wb') as f:
+        for chunk in gzip_stream(export_rows()):
+            f.write(chunk)
+    print(f"Export: {output} ({os.path.getsize(output)} bytes)")
+
+@app.cli.command('restore')
+@click.argument('source')
+@click.option('--output', default=DB_PATH, show_default=True, help='Database file to create.')
+@click.option('--force', is_flag=True, help='Replace an existing database file. Stop the service first.')
+def restore_command(source, output, force):
+    """Восстановить базу из экспорта (gzip NDJSON или NDJSON, '-' — stdin)"""
+    if os.path.exists(output) and not force:
+        raise click.ClickException(f"{output} exists; stop the service and pass --force to replace it")
+    with open_export(source) as lines:
+        result = restore_export(lines, output)
+    print(f"Restored {result['target']} in {result['seconds']} s:")
+    for table, count in result["rows"].items():
+        print(f"  {table}: {count}")
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ==========
+
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', DB_PATH + '.ratelimit')
+RATE_LIMIT_IDLE_TTL = 3600
+
+# маршрут -> {ключ: (емкость корзины, пополнение токенов в секунду)}
+DEFAULT_RATE_LIMITS = {
+    'login': {'ip': (30, 0.5), 'username': (10, 10 / 60)},
+    'register': {'ip': (10, 10 / 60), 'username': (5, 5 / 60)},
+    # Перебор кодов с одного адреса или из одной сессии
+    'redeem': {'ip': (30, 0.5), 'uid': (10, 10 / 60)},
+}
+# Заданный в окружении RATE_LIMITS заменяет значения по умолчанию целиком: '{}' отключает лимиты
+RATE_LIMITS = {route: {key: tuple(limit) for key, limit in limits.items()}
+               for route, limits in json.loads(os.environ.get('RATE_LIMITS', json.dumps(DEFAULT_RATE_LIMITS))).items()}
+
+class TokenBucketStore:
+    """Token bucket в отдельном файле SQLite, общем для всех воркеров"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._last_cleanup = 0.0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                                   check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Состояние лимитов не критично — не платим за fsync
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets
+                            (key TEXT PRIMARY KEY,
+                             tokens REAL NOT NULL,
+                             updated REAL NOT NULL)""")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def consume(self, buckets, cost=1):
+        """Списывает токен из всех корзин сразу или ни из одной.
+        
+        buckets — список (key, capacity, refill_per_second). Возвращает (allowed, retry_after).
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                states = []
+                retry_after = 0.0
+                for key, capacity, rate in buckets:
+                    row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                    tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                    if tokens < cost:
+                        retry_after = max(retry_after, (cost - tokens) / rate)
+                    states.append((key, tokens))
+                
+                allowed = retry_after == 0.0
+                conn.executemany("""INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?)
+                                    ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens,
+                                                                   updated = excluded.updated""",
+                                 [(key, tokens - cost if allowed else tokens, now) for key, tokens in states])
+                
+                if now - self._last_cleanup > RATE_LIMIT_IDLE_TTL:
+                    conn.execute("DELETE FROM buckets WHERE updated < ?", (now - RATE_LIMIT_IDLE_TTL,))
+                    self._last_cleanup = now
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return allowed, retry_after
+
+rate_limiter = TokenBucketStore(RATE_LIMIT_DB)
+
+def rate_limited(route):
+    """Отклоняет запрос с 429 до любой работы с KDF и базой, если исчерпан лимит"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            limits = RATE_LIMITS.get(route)
+            if not limits:
+                return f(*args, **kwargs)
+            
+            buckets = []
+            if 'ip' in limits:
+                buckets.append((f"{route}:ip:{request.remote_addr}",) + limits['ip'])
+            data = request.get_json(silent=True)
+            username = data.get('username') if isinstance(data, dict) else None
+            if 'username' in limits and isinstance(username, str) and username.strip():
+                buckets.append((f"{route}:user:{username.strip().lower()}",) + limits['username'])
+            if 'uid' in limits:
+                # Проверка токена дешевая: подпись HMAC и локальная копия списка отзывов
+                token = _request_token()
+                claims = decode_session_token(token) if token else None
+                if claims:
+                    buckets.append((f"{route}:uid:{claims['uid']}",) + limits['uid'])
+            
+            try:
+                allowed, retry_after = rate_limiter.consume(buckets)
+            except sqlite3.Error as e:
+                # Сбой хранилища лимитов не должен класть вход и регистрацию
+                print(f"Ошибка rate limiter: {e}")
+                return f(*args, **kwargs)
+            
+            if not allowed:
+                metrics.inc('activation_rate_limited_total', route=route)
+                return (jsonify({"status": "error", "message": "Too many requests, try again later"}),
+                        429, {'Retry-After': str(math.ceil(retry_after))})
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+# ========== ИДЕМПОТЕНТНОСТЬ ==========
+# Ответ на запрос с заголовком Idempotency-Key сохраняется: повтор с тем же
+# ключом получает его без KDF и записи, а одновременный дубль ждет первый запрос.
 
-def add_test_codes():
-    test_codes = [
-        ("fG956kGo9", "forever"),
-        ("MONTH12345", "month"),
-        ("WEEK67890", "week"),
-        ("DAY54321", "day"),
-        ("TESTFOREVER", "forever")
-    ]
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))  # сколько хранится ответ в базе, с
+IDEMPOTENCY_CACHE_TTL = float(os.environ.get('IDEMPOTENCY_CACHE_TTL', 300))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 60))  # после стольких секунд зависший запрос можно повторить
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))  # ожидание одновременного дубля, с
+IDEMPOTENCY_MAX_KEY = 255
+IDEMPOTENCY_MAX_RESPONSE = 1024 * 1024
+IDEMPOTENCY_HEADERS = ('Content-Disposition',)
+
+def _idempotency_claim_op(c, key, fingerprint, now, purge):
+    if purge:
+        c.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+    row = c.execute("SELECT fingerprint, status, response, expires_at FROM idempotency_keys WHERE key = ?",
+                    (key,)).fetchone()
+    if row is not None and row[3] >= now:
+        if row[1] is None:
+            return {"status": "busy"}, None
+        return {"status": "done", "record": (row[0], row[1], row[2])}, None
     
-    for code, code_type in test_codes:
-        add_code_with_type(code, code_type)
+    # Ключа нет, он истек или первый запрос не дожил до ответа — выполняем сами
+    c.execute("""INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, status, response, expires_at)
+                 VALUES (?, ?, NULL, NULL, ?)""", (key, fingerprint, now + IDEMPOTENCY_LEASE))
+    return {"status": "success"}, None
+
+def _idempotency_store_op(c, key, status, response, expires_at):
+    c.execute("UPDATE idempotency_keys SET status = ?, response = ?, expires_at = ? WHERE key = ?",
+              (status, response, expires_at, key))
+    return {"status": "success"}, None
+
+def _idempotency_release_op(c, key):
+    c.execute("DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL", (key,))
+    return {"status": "success"}, None
+
+class IdempotencyStore:
+    """Ответы по ключам идемпотентности: таблица idempotency_keys и кеш воркера"""
+
+    def __init__(self, ttl, cache_ttl, cache_size, wait):
+        self.ttl = ttl
+        self.wait = wait
+        self._cache = TTLCache(cache_ttl, cache_size)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._last_purge = 0
+        self._replayed = 0
+        self._stored = 0
+        self._waited = 0
+
+    def _lookup(self, key):
+        record = self._cache.get(key)
+        if record is not None:
+            return record
+        with db_pool.connection() as conn:
+            row = conn.execute("""SELECT fingerprint, status, response FROM idempotency_keys
+                                  WHERE key = ? AND status IS NOT NULL AND expires_at >= ?""",
+                               (key, now_ts())).fetchone()
+        if row is None:
+            return None
+        record = tuple(row)
+        self._cache.set(key, record)
+        return record
+
+    def run(self, key, fingerprint, fn):
+        """Ответ fn() для первого запроса с ключом, сохраненный ответ для повторов"""
+        deadline = time.monotonic() + self.wait
+        while True:
+            record = self._lookup(key)
+            if record is not None:
+                return self._replay(record, fingerprint)
+            
+            with self._lock:
+                future = self._in_flight.get(key)
+                owner = future is None
+                if owner:
+                    future = self._in_flight[key] = Future()
+            
+            if not owner:
+                # Дубль в этом же воркере ждет результат первого запроса
+                with self._lock:
+                    self._waited += 1
+                try:
+                    record = future.result(timeout=max(deadline - time.monotonic(), 0))
+                except FutureTimeoutError:
+                    return self._in_progress_response()
+                if record is None:
+                    # Первый запрос ответ не сохранил (например, 503) — выполняем заново
+                    continue
+                return self._replay(record, fingerprint)
+            
+            record = None
+            try:
+                response, record = self._execute(key, fingerprint, fn, deadline)
+                return response
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                future.set_result(record)
+
+    def _execute(self, key, fingerprint, fn, deadline):
+        now = now_ts()
+        purge = now - self._last_purge > IDEMPOTENCY_LEASE
+        if purge:
+            self._last_purge = now
+        
+        while True:
+            claim = write_pipeline.execute('idempotency', _idempotency_claim_op, key, fingerprint, now, purge)
+            purge = False
+            if claim["status"] == "success":
+                break
+            if claim["status"] == "done":
+                record = claim["record"]
+                self._cache.set(key, record)
+                return self._replay(record, fingerprint), record
+            # Ключ выполняется в другом воркере — опрашиваем таблицу
+            if time.monotonic() >= deadline:
+                return self._in_progress_response(), None
+            time.sleep(0.05)
+            now = now_ts()
+        
+        try:
+            response = app.make_response(fn())
+        except BaseException:
+            write_pipeline.execute('idempotency', _idempotency_release_op, key)
+            raise
+        
+        # Ошибки сервера, перегрузку и лимиты не запоминаем: повтор должен выполниться заново
+        if response.status_code >= 500 or response.status_code == 429:
+            write_pipeline.execute('idempotency', _idempotency_release_op, key)
+            return response, None
+        
+        status = response.status_code
+        if len(response.get_data()) > IDEMPOTENCY_MAX_RESPONSE:
+            # Запрос уже выполнен, но ответ слишком велик для хранения: повтор получает 410,
+            # а не выполняет запрос второй раз
+            status = 410
+            stored = json.dumps({
+                "mimetype": "application/json",
+                "headers": {},
+                "body": json.dumps({"status": "error",
+                                    "message": "The request was completed, but its response was too large to store "
+                                               "for replay"})
+            })
+        else:
+            stored = json.dumps({
+                "mimetype": response.mimetype,
+                "headers": {name: response.headers[name] for name in IDEMPOTENCY_HEADERS if name in response.headers},
+                "body": response.get_data(as_text=True)
+            })
+        record = (fingerprint, status, stored)
+        write_pipeline.execute('idempotency', _idempotency_store_op, key, status, stored, now_ts() + self.ttl)
+        self._cache.set(key, record)
+        with self._lock:
+            self._stored += 1
+        return response, record
+
+    def _replay(self, record, fingerprint):
+        stored_fingerprint, status, stored = record
+        if not hmac.compare_digest(stored_fingerprint, fingerprint):
+            return jsonify({"status": "error",
+                            "message": "Idempotency-Key was already used with a different request"}), 422
+        with self._lock:
+            self._replayed += 1
+        stored = json.loads(stored)
+        return Response(stored["body"], status, mimetype=stored["mimetype"],
+                        headers=dict(stored["headers"], **{'Idempotent-Replayed': 'true'}))
+
+    def _in_progress_response(self):
+        return (jsonify({"status": "error", "message": "A request with this Idempotency-Key is still in progress"}),
+                409, {'Retry-After': '1'})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ttl": self.ttl,
+                "cached": len(self._cache),
+                "in_flight": len(self._in_flight),
+                "stored": self._stored,
+                "replayed": self._replayed,
+                "waited": self._waited
+            }
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_TTL, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_WAIT)
+
+def idempotent(scope):
+    """Повтор запроса с тем же Idempotency-Key получает сохраненный ответ первого"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if key is None:
+                return f(*args, **kwargs)
+            if not key or len(key) > IDEMPOTENCY_MAX_KEY:
+                return jsonify({"status": "error",
+                                "message": f"Idempotency-Key must be 1 to {IDEMPOTENCY_MAX_KEY} characters"}), 400
+            
+            # Ключи админов не пересекаются между учетными записями
+            owner = request.authorization.username if request.authorization else ''
+            # HMAC, а не простой хеш: в теле регистрации есть пароль
+            fingerprint = hmac.new(SESSION_SECRET, b'\n'.join([
+                request.method.encode(), request.full_path.encode(), request.get_data()
+            ]), hashlib.sha256).hexdigest()
+            return idempotency_store.run(f"{scope}:{owner}:{key}", fingerprint, lambda: f(*args, **kwargs))
+        return decorated
+    return decorator
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+# Часть запросов профилируется cProfile, а медленные запросы — сэмплером стеков.
+# Воркер хранит top-N самых медленных профилей в PROFILE_DIR, админ скачивает
+# их как pstats или collapsed stacks (flamegraph.pl, speedscope).
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', DB_PATH + '.profiles')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # доля запросов под cProfile
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))  # порог медленного запроса; 0 — сэмплер выключен
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))  # период сэмплера стеков, с
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 20))  # профилей на воркер
+PROFILE_SKIP_ENDPOINTS = ('list_profiles', 'download_profile')
+
+class StackSampler:
+    """Периодически снимает стеки потоков, которые обслуживают запросы"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _reset(self):
+        # Потоки родителя в воркере не выполняются
+        self._active = {}
+
+    def start(self):
+        ensure_worker_thread(self, 'stack-sampler')
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+        self._wakeup.set()
+
+    def stop(self):
+        """Снимает поток с наблюдения и возвращает его стеки: {стек: число сэмплов}"""
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            # Пока нет запросов, поток спит
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                idents = list(self._active)
+                if not idents:
+                    self._wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = _collapse_stack(frame)
+                with self._lock:
+                    samples = self._active.get(ident)
+                    if samples is not None:
+                        samples[stack] += 1
+
+def _collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class ProfileStore:
+    """Top-N самых медленных профилей воркера.
+    
+    Файлы лежат в PROFILE_DIR (<pid>-<n>.json с описанием и .pstats или
+    .collapsed с данными), поэтому список и скачивание работают в любом воркере.
+    """
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = 0
+        self._pid = os.getpid()
+
+    def offer(self, meta, extension, write):
+        """Сохраняет профиль, если он попадает в top-N; write(path) пишет данные"""
+        duration = meta["duration_ms"]
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._heap = []
+                self._prune_dead()
+            if len(self._heap) >= self.keep and duration <= self._heap[0][0]:
+                return None
+            
+            self._seq += 1
+            profile_id = f"{os.getpid()}-{self._seq}"
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, profile_id)
+            write(base + extension)
+            meta = dict(meta, id=profile_id, file=profile_id + extension)
+            with open(base + '.json.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(base + '.json.tmp', base + '.json')
+            
+            heapq.heappush(self._heap, (duration, profile_id, extension))
+            if len(self._heap) > self.keep:
+                _, evicted, evicted_extension = heapq.heappop(self._heap)
+                for suffix in ('.json', evicted_extension):
+                    try:
+                        os.remove(os.path.join(self.directory, evicted + suffix))
+                    except FileNotFoundError:
+                        pass
+            return profile_id
+
+    def _prune_dead(self):
+        """Удаляет профили завершившихся воркеров: их top-N больше никто не вытесняет"""
+        try:
+            filenames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        alive = {}
+        kept = []
+        for filename in filenames:
+            pid = filename.split('-', 1)[0]
+            if not pid.isdigit():
+                continue
+            pid = int(pid)
+            if pid not in alive:
+                alive[pid] = pid == os.getpid() or _pid_alive(pid)
+            if alive[pid]:
+                kept.append(filename)
+                continue
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+        return kept
+
+    def list(self):
+        profiles = []
+        for filename in self._prune_dead():
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        profiles.sort(key=lambda p: p["duration_ms"], reverse=True)
+        return profiles
+
+    def get(self, profile_id):
+        """Описание профиля и путь к данным; None, если его уже вытеснили"""
+        if not re.fullmatch(r'\d+-\d+', profile_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, profile_id + '.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta, os.path.join(self.directory, meta["file"])
+
+stack_sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_KEEP)
+# cProfile в каждый момент профилирует только один запрос воркера
+_cprofile_lock = threading.Lock()
+
+def start_profiling():
+    if request.endpoint in PROFILE_SKIP_ENDPOINTS:
+        return
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE and _cprofile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        g.cprofile = profiler
+        profiler.enable()
+    elif PROFILE_SLOW_MS > 0:
+        stack_sampler.start()
+        g.stack_sampled = True
+
+def finish_profiling(status):
+    """Останавливает профилирование запроса и отдает профиль в top-N"""
+    profiler = g.pop('cprofile', None)
+    samples = stack_sampler.stop() if g.pop('stack_sampled', False) else None
+    if profiler is None and samples is None:
+        return
+    if profiler is not None:
+        profiler.disable()
+        _cprofile_lock.release()
+    if status is None:
+        return
+    
+    duration_ms = (time.perf_counter() - g.request_start) * 1000
+    meta = {
+        "pid": os.getpid(),
+        "method": request.method,
+        "route": request.url_rule.rule if request.url_rule else 'unmatched',
+        "status": status,
+        "duration_ms": round(duration_ms, 3),
+        "started_at": int(time.time() - duration_ms / 1000),
+    }
+    if profiler is not None:
+        kept = profile_store.offer(dict(meta, kind='cprofile'), '.pstats',
+                                   lambda path: pstats.Stats(profiler).dump_stats(path))
+        metrics.inc('activation_profiles_total', kind='cprofile', result='kept' if kept else 'discarded')
+    elif duration_ms >= PROFILE_SLOW_MS and samples:
+        def write(path):
+            with open(path, 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        kept = profile_store.offer(dict(meta, kind='stacks', samples=sum(samples.values())), '.collapsed', write)
+        metrics.inc('activation_profiles_total', kind='stacks', result='kept' if kept else 'discarded')
+
+# ========== КОНТРОЛЬ НАГРУЗКИ ==========
+# Отдельный лимит одновременных запросов и очередь ожидания на каждый класс
+# эндпоинтов: дорогие KDF-запросы не могут занять потоки дешевых.
+
+# Ожидание в очереди занимает поток gunicorn так же, как сам запрос: дорогой класс вместе с очередью
+# не занимает больше WORKER_THREADS - ADMISSION_CHEAP_RESERVE потоков, а ждет недолго.
+WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS', 4))
+ADMISSION_CHEAP_RESERVE = int(os.environ.get('ADMISSION_CHEAP_RESERVE', 1))
+ADMISSION_OVERRIDES = {name: tuple(limit)
+                       for name, limit in json.loads(os.environ.get('ADMISSION_LIMITS', '{}')).items()}
+
+def admission_limits(threads):
+    """Лимиты классов для воркера с заданным числом потоков"""
+    available = max(threads - ADMISSION_CHEAP_RESERVE, 1)
+    admin = max(available // 3, 1)
+    kdf = max(min(available - admin, max(KDF_WORKERS, 1) * 2), 1)
+    limits = {
+        # класс: (одновременно, мест в очереди, ожидание в очереди / Retry-After, с)
+        'cheap': (64, 128, 0.5),
+        'kdf': (kdf, available - kdf, 1.0),
+        'admin': (admin, available - admin, 2.0),
+    }
+    limits.update(ADMISSION_OVERRIDES)
+    return limits
+
+ADMISSION_LIMITS = admission_limits(WORKER_THREADS)
+
+ENDPOINT_CLASSES = {
+    'status': 'cheap',
+    'check_user': 'cheap',
+    'session_verify': 'cheap',
+    'session_revoke': 'cheap',
+    'redeem': 'cheap',
+    'home': 'cheap',
+    'admin_panel': 'cheap',
+    'register': 'kdf',
+    'login': 'kdf',
+}
+
+class AdmissionGate:
+    def __init__(self, name, limit, queue_size, timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._queued = 0
+        self._rejected = 0
+
+    def acquire(self):
+        with self._cond:
+            if self._in_flight < self.limit:
+                self._in_flight += 1
+                return True
+            if self._queued >= self.queue_size:
+                self._rejected += 1
+                return False
+            
+            self._queued += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self._in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+                self._in_flight += 1
+                return True
+            finally:
+                self._queued -= 1
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def configure(self, limit, queue_size, timeout):
+        with self._cond:
+            self.limit = limit
+            self.queue_size = queue_size
+            self.timeout = timeout
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "queue_size": self.queue_size,
+                "queue_timeout": self.timeout,
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "rejected": self._rejected
+            }
+
+admission_gates = {name: AdmissionGate(name, *limit) for name, limit in ADMISSION_LIMITS.items()}
+
+for _name, _gate in admission_gates.items():
+    metrics.gauge('activation_admission_in_flight', lambda gate=_gate: gate.stats()["in_flight"], endpoint_class=_name)
+    metrics.gauge('activation_admission_queued', lambda gate=_gate: gate.stats()["queued"], endpoint_class=_name)
+
+def configure_admission(threads):
+    """Пересчитывает лимиты под реальное число потоков воркера (gunicorn --threads)"""
+    global ADMISSION_LIMITS
+    ADMISSION_LIMITS = admission_limits(threads)
+    for name, limit in ADMISSION_LIMITS.items():
+        if name in admission_gates:
+            admission_gates[name].configure(*limit)
+
+def endpoint_class():
+    if request.endpoint in ENDPOINT_CLASSES:
+        return ENDPOINT_CLASSES[request.endpoint]
+    if request.path.startswith(('/api/admin/', '/admin', '/metrics')):
+        # Запрос без пароля получит 401 от requires_auth и не должен занимать места админов
+        auth = request.authorization
+        if not auth or not check_admin_auth(auth.username, auth.password):
+            return None
+        return 'admin'
+    return None
 
 # ========== API ЭНДПОИНТЫ ==========
 
+OUTCOME_EVENTS = {
+    "Registration successful": "success",
+    "Login successful": "success",
+    "Invalid activation code": "invalid_code",
+    "Code already used": "code_used",
+    "Code expired": "code_expired",
+    "Username already exists": "username_exists",
+    "Invalid username or password": "bad_password",
+}
+
+def record_outcome(action, result):
+    event = OUTCOME_EVENTS.get(result.get("message"), "error")
+    metrics.inc('activation_outcomes_total', action=action, event=event)
+
+metrics.gauge('activation_db_pool_in_use', lambda: db_pool.stats()["in_use"])
+metrics.gauge('activation_kdf_in_flight', lambda: kdf_executor.stats()["in_flight"])
+metrics.gauge('activation_kdf_queue_depth', lambda: kdf_executor.stats()["queue_depth"])
+metrics.gauge('activation_write_queue_depth', lambda: write_pipeline.stats()["queued"])
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def ensure_background_tasks():
+    # Без gunicorn.conf.py (python app.py, голый gunicorn) обход запускается с первым запросом воркера
+    expiry_sweeper.start()
+
+@app.before_request
+def start_request_profiling():
+    if PROFILE_SAMPLE_RATE > 0 or PROFILE_SLOW_MS > 0:
+        start_profiling()
+
+@app.before_request
+def admit_request():
+    name = endpoint_class()
+    gate = admission_gates.get(name)
+    if gate is None:
+        return None
+    if not gate.acquire():
+        metrics.inc('activation_admission_rejected_total', endpoint_class=name)
+        return (jsonify({"status": "error", "message": "Server overloaded, try again later"}),
+                503, {'Retry-After': str(max(1, math.ceil(gate.timeout)))})
+    g.admission_gate = gate
+    return None
+
+@app.after_request
+def hold_admission_for_stream(response):
+    # Тело потокового ответа читается уже после teardown: место в классе освобождаем,
+    # только когда сервер дочитает или клиент оборвет поток
+    if response.is_streamed:
+        gate = g.pop('admission_gate', None)
+        if gate is not None:
+            response.call_on_close(gate.release)
+    return response
+
+@app.teardown_request
+def release_admission(exc):
+    gate = g.pop('admission_gate', None)
+    if gate is not None:
+        gate.release()
+
+@app.after_request
+def record_request_profile(response):
+    finish_profiling(response.status_code)
+    return response
+
+@app.teardown_request
+def stop_request_profiling(exc):
+    # Запрос оборвался до after_request — профиль не сохраняем, но профилировщик останавливаем
+    finish_profiling(None)
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('activation_http_request_duration_seconds', time.perf_counter() - start,
+                        route=route, method=request.method)
+        metrics.inc('activation_http_requests_total', route=route, method=request.method,
+                    status=response.status_code)
+        try:
+            metrics.dump()
+        except OSError as e:
+            print(f"Не удалось сохранить метрики: {e}")
+    return response
+
+def kdf_busy_response():
+    return jsonify({"status": "error", "message": "Server busy, try again later"}), 503, {'Retry-After': '1'}
+
 @app.route('/api/register', methods=['POST'])
+# Лимит проверяется первым: запрос сверх лимита не занимает ключ идемпотентности и не пишет в базу
+@rate_limited('register')
+@idempotent('register')
 def register():
     """Регистрация нового пользователя"""
     try:
@@ -265,25 +3234,111 @@ def register():
             return jsonify({"status": "error", "message": "Password too short (min 6 chars)"}), 400
         
         result = register_user(username, password, activation_code)
+        record_outcome('register', result)
+        return jsonify(result)
+    
+    except KdfBusyError:
+        metrics.inc('activation_outcomes_total', action='register', event='kdf_busy')
+        return kdf_busy_response()
+    
+    except WriteQueueFullError:
+        metrics.inc('activation_outcomes_total', action='register', event='write_busy')
+        return kdf_busy_response()
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/login', methods=['POST'])
+@rate_limited('login')
+def login():
+    """Вход существующего пользователя"""
+    try:
+        data = request.get_json()
+        if not data or 'username' not in data or 'password' not in data:
+            return jsonify({"status": "error", "message": "Missing username or password"}), 400
+        
+        username = data['username'].strip()
+        password = data['password'].strip()
+        
+        result = login_user(username, password)
+        record_outcome('login', result)
         return jsonify(result)
     
+    except KdfBusyError:
+        metrics.inc('activation_outcomes_total', action='login', event='kdf_busy')
+        return kdf_busy_response()
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/session/verify', methods=['POST'])
+def session_verify():
+    """Проверка сессионного токена без пароля"""
+    try:
+        token = _request_token()
+        if not token:
+            return jsonify({"status": "error", "message": "Missing token"}), 400
+        
+        claims = decode_session_token(token)
+        if not claims:
+            return jsonify({"status": "error", "message": "Invalid or expired token"}), 401
+        
+        code_type, expires_at = get_subscription(claims['uid'])
+        
+        return jsonify({
+            "status": "success",
+            "user_id": claims['uid'],
+            "is_active": not is_expired(expires_at),
+            "code_type": code_type,
+            "expires_at": format_db_ts(expires_at),
+            "token_expires_at": claims['exp']
+        })
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/session/revoke', methods=['POST'])
+def session_revoke():
+    """Отзыв сессионного токена (выход)"""
+    try:
+        token = _request_token()
+        if not token:
+            return jsonify({"status": "error", "message": "Missing token"}), 400
+        
+        claims = decode_session_token(token)
+        if not claims:
+            return jsonify({"status": "error", "message": "Invalid or expired token"}), 401
+        
+        revocation_list.revoke(claims['jti'], claims['exp'])
+        return jsonify({"status": "success", "message": "Session revoked"})
+    
     except Exception as e:
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
 
-@app.route('/api/login', methods=['POST'])
-def login():
-    """Вход существующего пользователя"""
+@app.route('/api/redeem', methods=['POST'])
+@rate_limited('redeem')
+def redeem():
+    """Активация нового кода для вошедшего пользователя"""
     try:
-        data = request.get_json()
-        if not data or 'username' not in data or 'password' not in data:
-            return jsonify({"status": "error", "message": "Missing username or password"}), 400
+        token = _request_token()
+        if not token:
+            return jsonify({"status": "error", "message": "Missing token"}), 400
         
-        username = data['username'].strip()
-        password = data['password'].strip()
+        claims = decode_session_token(token)
+        if not claims:
+            return jsonify({"status": "error", "message": "Invalid or expired token"}), 401
         
-        result = login_user(username, password)
+        data = request.get_json(silent=True) or {}
+        activation_code = data.get('activation_code')
+        if not isinstance(activation_code, str) or not activation_code.strip():
+            return jsonify({"status": "error", "message": "Missing activation_code"}), 400
+        
+        result = redeem_code(claims['uid'], activation_code.strip())
         return jsonify(result)
     
+    except WriteQueueFullError:
+        return kdf_busy_response()
+    
     except Exception as e:
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
 
@@ -297,11 +3352,7 @@ def check_user():
         
         username = data['username'].strip()
         
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT id FROM users WHERE username = ?", (username,))
-        exists = c.fetchone() is not None
-        conn.close()
+        exists = username_index.exists(username)
         
         return jsonify({
             "status": "success",
@@ -313,6 +3364,7 @@ def check_user():
 
 @app.route('/api/admin/add_code', methods=['POST'])
 @requires_auth
+@idempotent('add_code')
 def add_code():
     try:
         data = request.get_json()
@@ -322,7 +3374,7 @@ def add_code():
         new_code = data['code'].strip()
         code_type = data.get('code_type', 'forever')
         
-        if code_type not in ['forever', 'month', 'week', 'day']:
+        if code_type not in CODE_TYPES:
             return jsonify({"status": "error", "message": "Invalid code type"}), 400
         
         success = add_code_with_type(new_code, code_type)
@@ -338,27 +3390,303 @@ def add_code():
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
 
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 100))
+ADMIN_MAX_PAGE_SIZE = 1000
+ADMIN_STREAM_BATCH = 500
+
+def _parse_flag(value):
+    if value is None or value == '':
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+def _parse_cursor(value):
+    created_at, row_id = value.split(':')
+    return int(created_at), int(row_id)
+
+def _make_cursor(created_at, row_id):
+    return f"{created_at}:{row_id}"
+
+def data_version(conn=None):
+    with db_pool.connection(conn) as conn:
+        return conn.execute("SELECT version FROM data_version").fetchone()[0]
+
+def table_version(table, conn=None):
+    """Версия самой свежей строки таблицы — по индексу row_version, без сканирования"""
+    with db_pool.connection(conn) as conn:
+        return conn.execute(f"SELECT COALESCE(MAX(row_version), 0) FROM {table}").fetchone()[0]
+
+def keyset_listing(key, table, select_sql, where, params, order, row_to_item):
+    """Постраничная (keyset) выдача при limit/after, выдача изменений (?since=) или потоковая выдача всех строк.
+    
+    table — таблица, чьи строки перечисляются (ее row_version определяет ETag);
+    первые два столбца select_sql — id и поле сортировки, последний — версия строки;
+    order — имена id, поля сортировки и версии строки в SQL.
+    """
+    args = request.args
+    fmt = args.get('format', 'json')
+    stream = fmt == 'ndjson' or bool(_parse_flag(args.get('stream')))
+    limit = args.get('limit', type=int)
+    if limit is None and not args.get('after') and args.get('since') is None:
+        # Запрос без параметров страниц получает весь список, как до постраничной выдачи:
+        # старые клиенты считают по нему итоги. Отдаем потоком, не собирая ответ в памяти
+        stream = True
+    if not stream:
+        limit = min(max(limit or ADMIN_PAGE_SIZE, 1), ADMIN_MAX_PAGE_SIZE)
+    
+    since = args.get('since')
+    if since is not None and not stream:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid since"}), 400
+        return _delta_listing(key, select_sql, where, params, order, row_to_item, since, limit)
+    
+    where = list(where)
+    params = list(params)
+    id_col, sort_col, _ = order
+    after = args.get('after')
+    if after:
+        try:
+            sort_value, row_id = _parse_cursor(after)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+        where.append(f"({sort_col}, {id_col}) < (?, ?)")
+        params.extend([sort_value, row_id])
+    
+    sql = select_sql
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {sort_col} DESC, {id_col} DESC"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit if stream else limit + 1)
+    
+    if stream:
+        return Response(_stream_listing(key, sql, params, row_to_item, fmt),
+                        mimetype='application/x-ndjson' if fmt == 'ndjson' else 'application/json')
+    
+    with db_pool.connection() as conn:
+        # Версии читаем до строк: при гонке с записью ETag окажется старше данных, но не новее
+        version = data_version(conn)
+        # ETag зависит только от строк этой таблицы: входы и записи в другие таблицы его не сбрасывают.
+        # Истечение срока помечает фоновый обход, поэтому и фильтр expired меняется только с версией строк
+        query = hashlib.sha1(request.query_string).hexdigest()[:12]
+        etag = f"{key}-{table_version(table, conn)}-{query}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        rows = conn.execute(sql, params).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _make_cursor(rows[-1][1], rows[-1][0])
+    
+    response = jsonify({
+        "status": "success",
+        key: [row_to_item(row) for row in rows],
+        "next_cursor": next_cursor,
+        "version": version
+    })
+    response.set_etag(etag)
+    # Браузер каждый раз переспрашивает сервер, но при 304 берет ответ из своего кэша
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _delta_listing(key, select_sql, where, params, order, row_to_item, since, limit):
+    """Строки, изменившиеся после версии since.
+    
+    Изменившиеся строки, которые больше не подходят под фильтры, отдаются в removed.
+    Если изменений больше limit, version — последняя отданная версия и has_more = true.
+    """
+    id_col, _, version_col = order
+    with db_pool.connection() as conn:
+        # Один снимок WAL для версии и строк
+        conn.execute("BEGIN")
+        try:
+            version = data_version(conn)
+            rows = conn.execute(f"{select_sql} WHERE {version_col} > ? ORDER BY {version_col} LIMIT ?",
+                                (since, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            if has_more:
+                rows = rows[:limit]
+                version = rows[-1][-1]
+            
+            matching = None
+            if where:
+                matching = {row[0] for row in conn.execute(
+                    f"{select_sql} WHERE {version_col} > ? AND {version_col} <= ? AND " + " AND ".join(where),
+                    [since, version] + list(params))}
+        finally:
+            conn.rollback()
+    
+    return jsonify({
+        "status": "success",
+        key: [row_to_item(row) for row in rows if matching is None or row[0] in matching],
+        "removed": [row[0] for row in rows if matching is not None and row[0] not in matching],
+        "version": version,
+        "has_more": has_more
+    })
+
+def _stream_listing(key, sql, params, row_to_item, fmt):
+    with stream_connection() as conn:
+        c = conn.execute(sql, params)
+        if fmt != 'ndjson':
+            yield '{"status": "success", "%s": [' % key
+        first = True
+        while True:
+            rows = c.fetchmany(ADMIN_STREAM_BATCH)
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                item = json.dumps(row_to_item(row))
+                if fmt == 'ndjson':
+                    chunk.append(item + '\n')
+                else:
+                    chunk.append(item if first else ',' + item)
+                    first = False
+            yield ''.join(chunk)
+        if fmt != 'ndjson':
+            yield ']}'
+
+def _code_item(row):
+    return {
+        "id": row[0],
+        "code": row[2],
+        "type": row[3],
+        "created": format_ts(row[1]),
+        "expires": format_ts(row[4]),
+        "used": bool(row[5]),
+        "expired": bool(row[6])
+    }
+
+def _user_item(row):
+    # Учитываем входы, которые еще не сброшены в базу из буфера этого воркера
+    last_login = row[3]
+    pending_login = last_login_buffer.get(row[0])
+    if pending_login and (last_login is None or pending_login > last_login):
+        last_login = pending_login
+    
+    return {
+        "id": row[0],
+        "username": row[2],
+        "created": format_ts(row[1]),
+        "last_login": format_ts(last_login),
+        "code_type": row[4],
+        "expires_at": format_ts(row[5]),
+        "expired": bool(row[6])
+    }
+
+@app.route('/api/admin/generate_codes', methods=['POST'])
+@requires_auth
+@idempotent('generate_codes')
+def generate_codes_endpoint():
+    """Массовая генерация кодов: {"count": N, "code_type": "month", "length": 12, "alphabet": "..."}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        count = data.get('count')
+        code_type = data.get('code_type', 'forever')
+        length = data.get('length', CODE_LENGTH)
+        alphabet = data.get('alphabet', CODE_ALPHABET)
+        
+        if not isinstance(count, int) or not 1 <= count <= CODE_GENERATE_MAX:
+            return jsonify({"status": "error", "message": f"count must be between 1 and {CODE_GENERATE_MAX}"}), 400
+        
+        if code_type not in CODE_TYPES:
+            return jsonify({"status": "error", "message": "Invalid code type"}), 400
+        
+        if not isinstance(length, int) or not 4 <= length <= CODE_MAX_LENGTH:
+            return jsonify({"status": "error", "message": f"length must be between 4 and {CODE_MAX_LENGTH}"}), 400
+        
+        if not isinstance(alphabet, str) or len(set(alphabet)) < 2:
+            return jsonify({"status": "error", "message": "Invalid alphabet"}), 400
+        
+        alphabet = ''.join(sorted(set(alphabet)))
+        # Требуем запас пространства кодов, иначе коллизии сделают генерацию бесконечной
+        if len(alphabet) ** length < count * 100:
+            return jsonify({"status": "error", "message": "Code space too small for requested count"}), 400
+        
+        created = generate_codes(count, code_type, length, alphabet)
+        
+        if (request.args.get('format') or data.get('format')) == 'csv':
+            return codes_csv_response(created)
+        
+        return jsonify({
+            "status": "success" if len(created) == count else "partial",
+            "message": f"Generated {len(created)} of {count} codes (Type: {code_type})",
+            "codes": [row[0] for row in created]
+        })
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
+@app.route('/api/admin/import_codes', methods=['POST'])
+@requires_auth
+def import_codes_endpoint():
+    """Импорт кодов из CSV (code[,code_type]) или NDJSON; ?code_type= — тип по умолчанию"""
+    try:
+        default_type = request.args.get('code_type', 'forever')
+        if default_type not in CODE_TYPES:
+            return jsonify({"status": "error", "message": "Invalid code type"}), 400
+        
+        content_type = request.mimetype
+        fmt = 'ndjson' if content_type in ('application/x-ndjson', 'application/json') else 'csv'
+        try:
+            created, duplicates, invalid = import_codes(request.stream, fmt, default_type)
+        except CodeImportError as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Malformed upload at {str(e)}; rows before it were imported",
+                "line": e.line,
+                "created": len(e.created),
+                "duplicates": e.duplicates,
+                "invalid": e.invalid
+            }), 400
+        
+        if request.args.get('format') == 'csv':
+            return codes_csv_response(created)
+        
+        return jsonify({
+            "status": "success",
+            "message": f"Imported {len(created)} codes",
+            "created": len(created),
+            "duplicates": duplicates,
+            "invalid": invalid
+        })
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
 @app.route('/api/admin/list_codes', methods=['GET'])
 @requires_auth
 def list_codes():
+    """Список кодов: ?limit=&after=&since=&used=&code_type=&expired=&format=ndjson|stream=1"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT code, code_type, created_at, expires_at, used FROM codes ORDER BY created_at DESC")
-        codes = c.fetchall()
-        conn.close()
+        where, params = [], []
         
-        result = []
-        for row in codes:
-            result.append({
-                "code": row[0],
-                "type": row[1],
-                "created": row[2],
-                "expires": row[3],
-                "used": bool(row[4])
-            })
+        used = _parse_flag(request.args.get('used'))
+        if used is not None:
+            where.append("used = ?")
+            params.append(int(used))
+        
+        code_type = request.args.get('code_type')
+        if code_type:
+            where.append("code_type = ?")
+            params.append(code_type)
         
-        return jsonify({"status": "success", "codes": result})
+        # Пометку expired ставит фоновый обход (отставание — до EXPIRY_SWEEP_INTERVAL)
+        expired = _parse_flag(request.args.get('expired'))
+        if expired is not None:
+            where.append("expired = ?")
+            params.append(int(expired))
+        
+        return keyset_listing(
+            "codes", "codes",
+            "SELECT id, created_at, code, code_type, expires_at, used, expired, row_version FROM codes",
+            where, params, ("id", "created_at", "row_version"), _code_item)
     
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
@@ -366,34 +3694,226 @@ def list_codes():
 @app.route('/api/admin/list_users', methods=['GET'])
 @requires_auth
 def list_users():
+    """Список пользователей с последней активацией: ?limit=&after=&since=&code_type=&expired=&format=ndjson|stream=1"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("""SELECT u.id, u.username, u.created_at, u.last_login, 
-                            c.code_type, a.expires_at
-                     FROM users u
-                     LEFT JOIN activations a ON u.id = a.user_id
-                     LEFT JOIN codes c ON a.code_id = c.id
-                     ORDER BY u.created_at DESC""")
-        users = c.fetchall()
-        conn.close()
+        where, params = [], []
+        
+        code_type = request.args.get('code_type')
+        if code_type:
+            where.append("s.code_type = ?")
+            params.append(code_type)
+        
+        expired = _parse_flag(request.args.get('expired'))
+        if expired is not None:
+            where.append("s.expired = 1" if expired else "(s.expired IS NULL OR s.expired = 0)")
+        
+        return keyset_listing(
+            "users", "users",
+            """SELECT u.id, u.created_at, u.username, u.last_login, s.code_type, s.expires_at, s.expired, u.row_version
+               FROM users u
+               LEFT JOIN user_subscription s ON s.user_id = u.id""",
+            where, params, ("u.id", "u.created_at", "u.row_version"), _user_item)
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
+@app.route('/api/admin/db_stats', methods=['GET'])
+@requires_auth
+def db_stats():
+    return jsonify({
+        "status": "success",
+        "pool": db_pool.stats(),
+        "last_login_buffer": last_login_buffer.stats(),
+        "write_pipeline": write_pipeline.stats(),
+        "expiry_sweeper": expiry_sweeper.stats(),
+        "idempotency": idempotency_store.stats(),
+        "startup": STARTUP_TIMINGS
+    })
+
+@app.route('/api/admin/kdf_stats', methods=['GET'])
+@requires_auth
+def kdf_stats():
+    scheme, version, params = password_policy()
+    return jsonify({
+        "status": "success",
+        "kdf": kdf_executor.stats(),
+        "policy": {"scheme": scheme, "version": version, "params": params},
+        "rehash": password_rehasher.stats()
+    })
+
+@app.route('/api/admin/admission', methods=['GET'])
+@requires_auth
+def admission_stats():
+    return jsonify({"status": "success",
+                    "classes": {name: gate.stats() for name, gate in admission_gates.items()}})
+
+STATS_DEFAULT_MINUTES = 60
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366
+
+def _activity_series(conn, table, column, event, first, last):
+    counts = dict(conn.execute(f"""SELECT {column}, count FROM {table}
+                                   WHERE event = ? AND {column} BETWEEN ? AND ?""", (event, first, last)))
+    return [counts.get(bucket, 0) for bucket in range(first, last + 1)]
+
+def aggregate_stats(minutes=STATS_DEFAULT_MINUTES, days=STATS_DEFAULT_DAYS):
+    """Сводка из таблиц-счетчиков: время не зависит от размера codes, users и activations"""
+    now = now_ts()
+    with db_pool.connection() as conn:
+        # Один снимок для всех счетчиков
+        conn.execute("BEGIN")
+        try:
+            by_type = {code_type: {"used": 0, "unused": 0} for code_type in CODE_TYPES}
+            for code_type, used, count in conn.execute("SELECT code_type, used, count FROM code_counts"):
+                by_type.setdefault(code_type, {"used": 0, "unused": 0})["used" if used else "unused"] += count
+            
+            row = conn.execute("SELECT value FROM stat_counters WHERE name = 'users'").fetchone()
+            users_total = row[0] if row else 0
+            
+            # Целые часы в прошлом — из счетчиков, текущий неполный час — по индексу expires_at
+            hour_start = now // STATS_EXPIRY_BUCKET * STATS_EXPIRY_BUCKET
+            expired = conn.execute("""SELECT COALESCE(SUM(count), 0) FROM subscription_expiry_counts
+                                      WHERE bucket < ?""", (now // STATS_EXPIRY_BUCKET,)).fetchone()[0]
+            expired += conn.execute("""SELECT COUNT(*) FROM user_subscription
+                                       WHERE expires_at >= ? AND expires_at < ?""", (hour_start, now)).fetchone()[0]
+            
+            last_minute, last_day = now // 60, now // 86400
+            series = {}
+            for event in ('register', 'login'):
+                series[event] = {
+                    "per_minute": _activity_series(conn, 'activity_minutes', 'minute', event,
+                                                   last_minute - minutes + 1, last_minute),
+                    "per_day": _activity_series(conn, 'activity_days', 'day', event, last_day - days + 1, last_day)
+                }
+        finally:
+            conn.rollback()
+    
+    used = sum(counts["used"] for counts in by_type.values())
+    unused = sum(counts["unused"] for counts in by_type.values())
+    return {
+        "codes": {"total": used + unused, "used": used, "unused": unused, "by_type": by_type},
+        "users": {"total": users_total, "active": users_total - expired, "expired": expired},
+        "registrations": series['register'],
+        "logins": series['login'],
+        "per_minute_start": format_ts((last_minute - minutes + 1) * 60),
+        "per_day_start": datetime.utcfromtimestamp((last_day - days + 1) * 86400).strftime('%Y-%m-%d')
+    }
+
+@app.route('/api/admin/stats', methods=['GET'])
+@requires_auth
+def admin_stats():
+    """Счетчики кодов и пользователей и ряды регистраций/входов: ?minutes=60&days=30 (дни — UTC)"""
+    try:
+        minutes = min(max(request.args.get('minutes', STATS_DEFAULT_MINUTES, type=int), 1), STATS_MINUTE_RETENTION)
+        days = min(max(request.args.get('days', STATS_DEFAULT_DAYS, type=int), 1), STATS_MAX_DAYS)
+        return jsonify(dict(status="success", **aggregate_stats(minutes, days)))
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
+@app.route('/api/admin/expiry_events', methods=['GET'])
+@requires_auth
+def expiry_events():
+    """События истечения из очереди: ?after=<id>&limit="""
+    try:
+        after = request.args.get('after', 0, type=int)
+        limit = min(max(request.args.get('limit', ADMIN_PAGE_SIZE, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+        with db_pool.connection() as conn:
+            rows = conn.execute("""SELECT id, entity, entity_id, expires_at, created_at FROM expiry_events
+                                   WHERE id > ? ORDER BY id LIMIT ?""", (after, limit)).fetchall()
         
-        result = []
-        for row in users:
-            result.append({
+        return jsonify({
+            "status": "success",
+            "events": [{
                 "id": row[0],
-                "username": row[1],
-                "created": row[2],
-                "last_login": row[3],
-                "code_type": row[4],
-                "expires_at": row[5]
-            })
+                "entity": row[1],
+                "entity_id": row[2],
+                "expires_at": format_ts(row[3]),
+                "expired_at": format_ts(row[4])
+            } for row in rows],
+            "next_after": rows[-1][0] if rows else after
+        })
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
+@app.route('/api/admin/backup', methods=['POST'])
+@requires_auth
+def backup_endpoint():
+    """Онлайн-копия базы в BACKUP_DIR: {"pages": 256, "sleep": 0.01}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        pages = data.get('pages', BACKUP_PAGES)
+        sleep = data.get('sleep', BACKUP_SLEEP)
+        if not isinstance(pages, int) or pages < 0:
+            return jsonify({"status": "error", "message": "pages must be a non-negative integer"}), 400
+        if not isinstance(sleep, (int, float)) or not 0 <= sleep <= 10:
+            return jsonify({"status": "error", "message": "sleep must be between 0 and 10 seconds"}), 400
+        
+        return jsonify(dict(status="success", **backup_database(pages=pages, sleep=sleep)))
+    
+    except BackupInProgressError as e:
+        return jsonify({"status": "error", "message": str(e)}), 409
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
+@app.route('/api/admin/export', methods=['GET'])
+@requires_auth
+def export_endpoint():
+    """Снимок codes, users, activations и отозванных сессий в gzip NDJSON (восстановление: flask restore)"""
+    filename = f"activation-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz"
+    return Response(gzip_stream(export_rows()), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@requires_auth
+def list_profiles():
+    """Сохраненные профили медленных запросов всех воркеров, самые медленные первыми"""
+    try:
+        return jsonify({
+            "status": "success",
+            "settings": {
+                "sample_rate": PROFILE_SAMPLE_RATE,
+                "slow_ms": PROFILE_SLOW_MS,
+                "sample_interval": PROFILE_SAMPLE_INTERVAL,
+                "keep_per_worker": PROFILE_KEEP
+            },
+            "profiles": profile_store.list()
+        })
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@requires_auth
+def download_profile(profile_id):
+    """Профиль как .pstats (cProfile) или .collapsed (стеки); ?format=text — сводка pstats"""
+    try:
+        found = profile_store.get(profile_id)
+        if found is None:
+            return jsonify({"status": "error", "message": "Profile not found"}), 404
+        meta, path = found
         
-        return jsonify({"status": "success", "users": result})
+        if meta["kind"] == 'cprofile' and request.args.get('format') == 'text':
+            out = io.StringIO()
+            pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(50)
+            return Response(out.getvalue(), mimetype='text/plain')
+        
+        with open(path, 'rb') as f:
+            data = f.read()
+        mimetype = 'text/plain' if meta["kind"] == 'stacks' else 'application/octet-stream'
+        return Response(data, mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={meta["file"]}'})
     
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error: {str(e)}"}), 500
 
+@app.route('/metrics', methods=['GET'])
+@requires_auth
+def metrics_endpoint():
+    return Response(metrics.collect(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/status', methods=['GET'])
 def status():
     return jsonify({
@@ -402,13 +3922,58 @@ def status():
         "endpoints": {
             "register": "/api/register",
             "login": "/api/login",
-            "check_user": "/api/check_user"
+            "check_user": "/api/check_user",
+            "session_verify": "/api/session/verify",
+            "session_revoke": "/api/session/revoke",
+            "redeem": "/api/redeem"
         }
     })
 
+# ========== СТРАНИЦЫ ==========
+
+# HTML страниц собирается один раз при импорте и хранится уже сжатым
+PAGE_MAX_AGE = int(os.environ.get('PAGE_MAX_AGE', 3600))
+PAGE_ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+class StaticPage:
+    """Готовое тело страницы в нескольких кодировках с сильным ETag на каждую"""
+
+    def __init__(self, html, max_age=PAGE_MAX_AGE):
+        body = html.encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        self.max_age = max_age
+        self.variants = {'identity': (body, digest)}
+        self.variants['gzip'] = (gzip.compress(body, 9, mtime=0), f"{digest}-gzip")
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body), f"{digest}-br")
+
+    def response(self):
+        encoding = request.accept_encodings.best_match(PAGE_ENCODINGS, default='identity')
+        body, etag = self.variants[encoding]
+        
+        headers = {
+            'Cache-Control': f'public, max-age={self.max_age}',
+            'Vary': 'Accept-Encoding'
+        }
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+        else:
+            response = Response(body, mimetype='text/html', headers=headers)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        return response
+
 @app.route('/admin')
-@requires_auth
 def admin_panel():
+    """Оболочка панели управления: публичная, данные берет из /api/admin/* под Basic-auth"""
+    return admin_page.response()
+
+@app.route('/')
+def home():
+    return home_page.response()
+
+def admin_panel_html():
     return '''
     <!DOCTYPE html>
     <html>
@@ -455,14 +4020,48 @@ def admin_panel():
                 <button onclick="addCode()">Добавить код</button>
                 <div id="addResult" class="result"></div>
                 
+                <h2>📦 Сгенерировать пачку кодов</h2>
+                <input type="number" id="batchCount" placeholder="Количество" min="1" value="100">
+                <select id="batchType">
+                    <option value="forever">Навсегда</option>
+                    <option value="month">На месяц</option>
+                    <option value="week">На неделю</option>
+                    <option value="day">На день</option>
+                </select>
+                <button onclick="generateCodes()">Сгенерировать и скачать CSV</button>
+                
                 <h2>📋 Все коды в системе</h2>
-                <button onclick="loadCodes()">Обновить список</button>
+                <select id="codesTypeFilter" onchange="loadCodes()">
+                    <option value="">Все типы</option>
+                    <option value="forever">Навсегда</option>
+                    <option value="month">На месяц</option>
+                    <option value="week">На неделю</option>
+                    <option value="day">На день</option>
+                </select>
+                <select id="codesUsedFilter" onchange="loadCodes()">
+                    <option value="">Все статусы</option>
+                    <option value="0">Активные</option>
+                    <option value="1">Использованные</option>
+                </select>
+                <select id="codesExpiredFilter" onchange="loadCodes()">
+                    <option value="">Любой срок</option>
+                    <option value="0">Не истекшие</option>
+                    <option value="1">Истекшие</option>
+                </select>
+                <button onclick="refreshCodes()">Обновить список</button>
+                <h3 id="codesSummary"></h3>
                 <div id="codesList" class="code-list"></div>
             </div>
             
             <div id="users" class="tabcontent">
                 <h2>👥 Зарегистрированные пользователи</h2>
-                <button onclick="loadUsers()">Обновить список</button>
+                <select id="usersExpiredFilter" onchange="loadUsers()">
+                    <option value="">Все подписки</option>
+                    <option value="0">Активные</option>
+                    <option value="1">Истекшие</option>
+                </select>
+                <button onclick="refreshUsers()">Обновить список</button>
+                <h3 id="usersSummary"></h3>
                 <div id="usersList" class="user-list"></div>
             </div>
         </div>
@@ -482,6 +4081,16 @@ def admin_panel():
                 evt.currentTarget.className += " active";
             }
             
+            // Сервер отклоняет админские запросы сверх лимита с 503 и Retry-After — повторяем
+            async function adminFetch(url, options, attempts = 3) {
+                for (let attempt = 1; ; attempt++) {
+                    const response = await fetch(url, options);
+                    if (response.status !== 503 || attempt >= attempts) return response;
+                    const delay = parseInt(response.headers.get('Retry-After'), 10) || 1;
+                    await new Promise(resolve => setTimeout(resolve, delay * 1000));
+                }
+            }
+            
             async function addCode() {
                 const code = document.getElementById('newCode').value.trim();
                 const type = document.getElementById('codeType').value;
@@ -492,7 +4101,7 @@ def admin_panel():
                 }
                 
                 try {
-                    const response = await fetch('/api/admin/add_code', {
+                    const response = await adminFetch('/api/admin/add_code', {
                         method: 'POST',
                         headers: {'Content-Type': 'application/json'},
                         credentials: 'include',
@@ -504,84 +4113,237 @@ def admin_panel():
                     
                     if (data.status === 'success') {
                         document.getElementById('newCode').value = '';
-                        loadCodes();
+                        refreshCodes();
                     }
                 } catch (error) {
                     showResult('Ошибка подключения', 'error');
                 }
             }
             
-            async function loadCodes() {
+            async function generateCodes() {
+                const count = parseInt(document.getElementById('batchCount').value, 10);
+                const type = document.getElementById('batchType').value;
+                
+                if (!count || count < 1) {
+                    showResult('Укажите количество!', 'error');
+                    return;
+                }
+                
                 try {
-                    const response = await fetch('/api/admin/list_codes', {
-                        credentials: 'include'
+                    const response = await adminFetch('/api/admin/generate_codes?format=csv', {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/json'},
+                        credentials: 'include',
+                        body: JSON.stringify({count: count, code_type: type})
                     });
-                    const data = await response.json();
                     
-                    if (data.status === 'success') {
-                        const codesList = document.getElementById('codesList');
-                        codesList.innerHTML = '<h3>Всего кодов: ' + data.codes.length + '</h3>';
-                        
-                        data.codes.forEach(code => {
-                            const div = document.createElement('div');
-                            div.style.padding = '10px';
-                            div.style.margin = '5px';
-                            div.style.background = code.used ? '#ffe6e6' : '#e6ffe6';
-                            div.style.border = '1px solid #ddd';
-                            
-                            div.innerHTML = `
-                                <strong>${code.code}</strong> | 
-                                Тип: ${code.type} | 
-                                Создан: ${new Date(code.created).toLocaleDateString()} |
-                                ${code.expires ? 'Истекает: ' + new Date(code.expires).toLocaleDateString() : 'Бессрочный'} |
-                                Статус: ${code.used ? 'Использован ❌' : 'Активен ✅'}
-                            `;
-                            
-                            codesList.appendChild(div);
-                        });
+                    if (!response.ok) {
+                        const data = await response.json();
+                        showResult(data.message, 'error');
+                        return;
                     }
+                    
+                    const blob = await response.blob();
+                    const link = document.createElement('a');
+                    link.href = URL.createObjectURL(blob);
+                    link.download = 'codes_' + type + '.csv';
+                    link.click();
+                    URL.revokeObjectURL(link.href);
+                    
+                    showResult('Коды сгенерированы', 'success');
+                    refreshCodes();
                 } catch (error) {
-                    console.error(error);
+                    showResult('Ошибка подключения', 'error');
                 }
             }
             
-            async function loadUsers() {
-                try {
-                    const response = await fetch('/api/admin/list_users', {
-                        credentials: 'include'
-                    });
-                    const data = await response.json();
+            const PAGE_SIZE = 100;
+            
+            // Бесконечная прокрутка: следующая страница грузится по курсору next_cursor.
+            // "Обновить список" запрашивает только изменения после version первой страницы.
+            function createPager(url, key, listId, summaryId, summaryText, filters, render) {
+                const state = {cursor: null, loading: false, done: false, count: 0, generation: 0,
+                               version: null, items: new Map()};
+                const list = document.getElementById(listId);
+                
+                function filterParams() {
+                    const params = new URLSearchParams();
+                    for (const [name, elementId] of Object.entries(filters)) {
+                        const value = document.getElementById(elementId).value;
+                        if (value) params.set(name, value);
+                    }
+                    return params;
+                }
+                
+                function updateSummary() {
+                    document.getElementById(summaryId).textContent =
+                        summaryText + state.count + (state.done ? '' : '+');
+                }
+                
+                function sortKey(item) {
+                    // created в формате YYYY-MM-DD HH:MM:SS сравнивается как строка
+                    return item.created + '|' + String(item.id).padStart(12, '0');
+                }
+                
+                function place(item) {
+                    const element = render(item);
+                    element.dataset.sortKey = sortKey(item);
+                    const existing = state.items.get(item.id);
+                    if (existing) {
+                        list.replaceChild(element, existing);
+                        state.items.set(item.id, element);
+                        return;
+                    }
+                    // Новая строка встает на свое место по убыванию даты создания
+                    const key = element.dataset.sortKey;
+                    const next = Array.from(list.children).find(child => child.dataset.sortKey < key);
+                    if (next) {
+                        list.insertBefore(element, next);
+                    } else if (state.done) {
+                        list.appendChild(element);
+                    } else {
+                        return;  // Ниже загруженных страниц — придет при прокрутке
+                    }
+                    state.items.set(item.id, element);
+                    state.count++;
+                }
+                
+                async function loadPage() {
+                    if (state.loading || state.done) return;
+                    state.loading = true;
+                    const generation = state.generation;
                     
-                    if (data.status === 'success') {
-                        const usersList = document.getElementById('usersList');
-                        usersList.innerHTML = '<h3>Всего пользователей: ' + data.users.length + '</h3>';
+                    const params = filterParams();
+                    params.set('limit', PAGE_SIZE);
+                    if (state.cursor) params.set('after', state.cursor);
+                    
+                    try {
+                        // При неизменных данных сервер ответит 304, и браузер возьмет страницу из кэша
+                        const response = await adminFetch(url + '?' + params, {credentials: 'include'});
+                        const data = await response.json();
+                        if (generation !== state.generation || data.status !== 'success') return;
                         
-                        data.users.forEach(user => {
-                            const div = document.createElement('div');
-                            div.style.padding = '10px';
-                            div.style.margin = '5px';
-                            div.style.background = '#e6f3ff';
-                            div.style.border = '1px solid #ddd';
-                            
-                            const lastLogin = user.last_login ? new Date(user.last_login).toLocaleString() : 'Никогда';
-                            const expires = user.expires_at ? new Date(user.expires_at).toLocaleDateString() : 'Бессрочно';
-                            
-                            div.innerHTML = `
-                                <strong>${user.username}</strong> (ID: ${user.id})<br>
-                                Зарегистрирован: ${new Date(user.created).toLocaleDateString()}<br>
-                                Последний вход: ${lastLogin}<br>
-                                Тип подписки: ${user.code_type || 'Нет'} |
-                                Истекает: ${expires}
-                            `;
-                            
-                            usersList.appendChild(div);
+                        if (state.version === null) state.version = data.version;
+                        data[key].forEach(item => {
+                            if (state.items.has(item.id)) return;
+                            const element = render(item);
+                            element.dataset.sortKey = sortKey(item);
+                            list.appendChild(element);
+                            state.items.set(item.id, element);
+                            state.count++;
                         });
+                        state.cursor = data.next_cursor;
+                        state.done = !data.next_cursor;
+                        updateSummary();
+                    } catch (error) {
+                        console.error(error);
+                    } finally {
+                        if (generation === state.generation) {
+                            state.loading = false;
+                            // Дозагружаем, пока список не заполнит область прокрутки
+                            if (!state.done && list.scrollHeight <= list.clientHeight) loadPage();
+                        }
+                    }
+                }
+                
+                list.addEventListener('scroll', () => {
+                    if (list.scrollTop + list.clientHeight >= list.scrollHeight - 100) loadPage();
+                });
+                
+                function reload() {
+                    state.generation++;
+                    state.cursor = null;
+                    state.loading = false;
+                    state.done = false;
+                    state.count = 0;
+                    state.version = null;
+                    state.items = new Map();
+                    list.innerHTML = '';
+                    loadPage();
+                }
+                
+                async function refresh() {
+                    const params = filterParams();
+                    if (state.version === null) return reload();
+                    const generation = state.generation;
+                    
+                    try {
+                        let hasMore = true;
+                        while (hasMore) {
+                            params.set('since', state.version);
+                            params.set('limit', 1000);
+                            const response = await adminFetch(url + '?' + params, {credentials: 'include'});
+                            const data = await response.json();
+                            if (generation !== state.generation || data.status !== 'success') return;
+                            
+                            data[key].forEach(place);
+                            data.removed.forEach(id => {
+                                const element = state.items.get(id);
+                                if (!element) return;
+                                element.remove();
+                                state.items.delete(id);
+                                state.count--;
+                            });
+                            state.version = data.version;
+                            hasMore = data.has_more;
+                        }
+                        updateSummary();
+                    } catch (error) {
+                        console.error(error);
                     }
-                } catch (error) {
-                    console.error(error);
                 }
+                
+                return {reload: reload, refresh: refresh};
             }
             
+            function renderCode(code) {
+                const div = document.createElement('div');
+                div.style.padding = '10px';
+                div.style.margin = '5px';
+                div.style.background = code.used ? '#ffe6e6' : code.expired ? '#f0f0f0' : '#e6ffe6';
+                div.style.border = '1px solid #ddd';
+                
+                div.innerHTML = `
+                    <strong>${code.code}</strong> | 
+                    Тип: ${code.type} | 
+                    Создан: ${new Date(code.created).toLocaleDateString()} |
+                    ${code.expires ? 'Истекает: ' + new Date(code.expires).toLocaleDateString() : 'Бессрочный'} |
+                    Статус: ${code.used ? 'Использован ❌' : code.expired ? 'Истек ⌛' : 'Активен ✅'}
+                `;
+                return div;
+            }
+            
+            function renderUser(user) {
+                const div = document.createElement('div');
+                div.style.padding = '10px';
+                div.style.margin = '5px';
+                div.style.background = '#e6f3ff';
+                div.style.border = '1px solid #ddd';
+                
+                const lastLogin = user.last_login ? new Date(user.last_login).toLocaleString() : 'Никогда';
+                const expires = user.expires_at ? new Date(user.expires_at).toLocaleDateString() : 'Бессрочно';
+                
+                div.innerHTML = `
+                    <strong>${user.username}</strong> (ID: ${user.id})<br>
+                    Зарегистрирован: ${new Date(user.created).toLocaleDateString()}<br>
+                    Последний вход: ${lastLogin}<br>
+                    Тип подписки: ${user.code_type || 'Нет'} |
+                    ${user.expired ? 'Истекла: ' : 'Истекает: '}${expires}
+                `;
+                return div;
+            }
+            
+            const codesPager = createPager('/api/admin/list_codes', 'codes', 'codesList', 'codesSummary', 'Загружено кодов: ',
+                {code_type: 'codesTypeFilter', used: 'codesUsedFilter', expired: 'codesExpiredFilter'}, renderCode);
+            const usersPager = createPager('/api/admin/list_users', 'users', 'usersList', 'usersSummary', 'Загружено пользователей: ',
+                {expired: 'usersExpiredFilter'}, renderUser);
+            
+            // Смена фильтра перечитывает список, кнопка "Обновить" догружает только изменения
+            const loadCodes = codesPager.reload;
+            const loadUsers = usersPager.reload;
+            const refreshCodes = codesPager.refresh;
+            const refreshUsers = usersPager.refresh;
+            
             function showResult(message, type) {
                 const resultDiv = document.getElementById('addResult');
                 resultDiv.textContent = message;
@@ -600,8 +4362,7 @@ def admin_panel():
     </html>
     '''
 
-@app.route('/')
-def home():
+def home_html():
     return '''
     <!DOCTYPE html>
     <html>
@@ -624,13 +4385,34 @@ def home():
             <div class="endpoint">
                 <h3>📝 Регистрация пользователя</h3>
                 <code>POST /api/register</code><br>
-                Body: <code>{"username": "user", "password": "pass", "activation_code": "CODE"}</code>
+                Body: <code>{"username": "user", "password": "pass", "activation_code": "CODE"}</code><br>
+                Заголовок <code>Idempotency-Key: UUID</code> делает повтор безопасным: вернется ответ первого запроса
             </div>
             
             <div class="endpoint">
                 <h3>🔐 Вход пользователя</h3>
                 <code>POST /api/login</code><br>
-                Body: <code>{"username": "user", "password": "pass"}</code>
+                Body: <code>{"username": "user", "password": "pass"}</code><br>
+                Ответ содержит <code>token</code> для проверки сессии без пароля
+            </div>
+            
+            <div class="endpoint">
+                <h3>🎫 Проверить сессию</h3>
+                <code>POST /api/session/verify</code><br>
+                Body: <code>{"token": "TOKEN"}</code> или заголовок <code>Authorization: Bearer TOKEN</code>
+            </div>
+            
+            <div class="endpoint">
+                <h3>🚪 Завершить сессию</h3>
+                <code>POST /api/session/revoke</code><br>
+                Body: <code>{"token": "TOKEN"}</code>
+            </div>
+            
+            <div class="endpoint">
+                <h3>🎟️ Активировать новый код</h3>
+                <code>POST /api/redeem</code><br>
+                Body: <code>{"token": "TOKEN", "activation_code": "CODE"}</code><br>
+                Продлевает подписку от ее текущего окончания; бессрочная подписка не меняется
             </div>
             
             <div class="endpoint">
@@ -643,8 +4425,90 @@ def home():
     </html>
     '''
 
-init_db()
-add_test_codes()
+admin_page = StaticPage(admin_panel_html())
+home_page = StaticPage(home_html())
+
+# ========== ЗАПУСК ==========
+
+# Схема и тестовые коды готовятся один раз на все процессы под файловой блокировкой.
+# Под gunicorn.conf.py это делает мастер до fork; BOOTSTRAP_ON_IMPORT=1 — для запуска
+# без него (python app.py, голый gunicorn): каждый процесс проверит готовность базы сам.
+# Команды flask, кроме flask run, базу при импорте не трогают: restore создает ее с нуля,
+# а backup и export не должны менять копируемый файл; схему готовят flask bootstrap и db-migrate.
+FLASK_CLI_COMMAND = click.get_current_context(silent=True) is not None and 'run' not in sys.argv[1:]
+BOOTSTRAP_ON_IMPORT = os.environ.get('BOOTSTRAP_ON_IMPORT', '1') == '1' and not FLASK_CLI_COMMAND
+BOOTSTRAP_LOCK_PATH = os.environ.get('BOOTSTRAP_LOCK_PATH', DB_PATH + '.bootstrap.lock')
+SEED_TEST_CODES = os.environ.get('SEED_TEST_CODES', '1') == '1'
+
+STARTUP_TIMINGS = {}
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def bootstrap(seed=SEED_TEST_CODES, force=False):
+    """Создает схему, применяет миграции и засевает тестовые коды. Возвращает True, если что-то делал"""
+    start = time.perf_counter()
+    with _file_lock(BOOTSTRAP_LOCK_PATH):
+        with db_pool.connection() as conn:
+            # Готовую базу узнаем по двум запросам, без DDL и вставок
+            ready = (schema_version(conn) >= SCHEMA_VERSION
+                     and (not seed or test_codes_seeded(conn)))
+        if force or not ready:
+            init_db()
+            if seed:
+                add_test_codes()
+    STARTUP_TIMINGS['bootstrap_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return force or not ready
+
+def warm_caches():
+    """Загружает индексы имен и кодов; в мастере — до fork, чтобы воркеры делили эти страницы памяти"""
+    start = time.perf_counter()
+    username_index.refresh(force=True)
+    code_index.refresh(force=True)
+    STARTUP_TIMINGS['warm_caches_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+def warm_worker():
+    """Открывает соединения пула воркера и прогоняет по ним горячие запросы"""
+    start = time.perf_counter()
+    # Каждое новое соединение разбирает схему при первом запросе — делаем это до трафика
+    conns = [db_pool.acquire() for _ in range(DB_POOL_SIZE)]
+    try:
+        for conn in conns:
+            for sql, params in HOT_QUERIES.values():
+                conn.execute(sql, params).fetchall()
+    finally:
+        for conn in conns:
+            db_pool.release(conn)
+    # Догружаем то, что появилось после загрузки индексов в мастере
+    username_index.refresh(force=True)
+    code_index.refresh(force=True)
+    expiry_sweeper.start()
+    STARTUP_TIMINGS['warm_worker_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+@app.cli.command('bootstrap')
+@click.option('--seed/--no-seed', default=SEED_TEST_CODES, show_default=True, help='Insert the test activation codes.')
+@click.option('--force', is_flag=True, help='Run schema setup even if the database looks ready.')
+def bootstrap_command(seed, force):
+    """Подготовить схему и тестовые коды один раз перед запуском воркеров"""
+    changed = bootstrap(seed=seed, force=force)
+    with db_pool.connection() as conn:
+        print(f"Database: {DB_PATH}")
+        print(f"Schema version: {schema_version(conn)} (latest: {SCHEMA_VERSION})")
+    print("Bootstrap: " + ("applied" if changed else "already up to date"))
+    for name, value in STARTUP_TIMINGS.items():
+        print(f"  {name}: {value}")
+
+STARTUP_TIMINGS['import_ms'] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 3)
+
+if BOOTSTRAP_ON_IMPORT:
+    bootstrap()
+    warm_caches()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,334 @@
+"""Нагрузочный бенчмарк Activation API.
+
+Заполняет отдельную базу SQLite, поднимает app под gunicorn и гоняет смешанную
+нагрузку из конкурентных клиентов. Результат — JSON по каждому эндпоинту: счетчики
+HTTP-статусов, доли ошибок и отклоненных (429/503) запросов, RPS и p50/p95/p99
+успешных ответов отдельно от отклоненных; его можно сохранить как baseline и сравнивать.
+
+    python bench.py --users 5000 --codes 20000 --workers 4 --clients 32 --duration 30
+    python bench.py --save-baseline baseline.json
+    python bench.py --baseline baseline.json --env KDF_WORKERS=0
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSWORD = 'benchpass'
+ADMIN_PASSWORD = 'bench-admin'
+DEFAULT_MIX = 'register=1,login=3,check_user=6,list_codes=1,list_users=1'
+# Все клиенты бенчмарка приходят с одного IP: лимиты запросов отключены, иначе меряются 429.
+# Вернуть их можно через --env RATE_LIMITS=...
+SERVER_ENV = {'RATE_LIMITS': '{}'}
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown operations: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def parse_env(values):
+    env = {}
+    for item in values:
+        key, _, value = item.partition('=')
+        env[key] = value
+    return env
+
+
+def seed_database(args, env):
+    """Создает схему через импорт app и массово заливает коды, пользователей и активации"""
+    # Схему и хеш пароля готовит само приложение, чтобы формат совпадал с боевым
+    script = ("import app, sys; sys.stdout.write(app.hash_password(%r))" % BENCH_PASSWORD)
+    out = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                         check=True, capture_output=True, text=True).stdout
+    password_hash = out.strip().splitlines()[-1]
+
+    types = ['forever', 'month', 'week', 'day']
+    periods = {'forever': None, 'month': 30 * 86400, 'week': 7 * 86400, 'day': 86400}
+    now = int(time.time())
+
+    def expiry(code_type, start):
+        return start + periods[code_type] if periods[code_type] else None
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO codes (code, code_type, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            ((f"BENCH-C-{i}", types[i % 4], now - i, expiry(types[i % 4], now))
+             for i in range(args.codes)))
+        conn.executemany(
+            "INSERT OR IGNORE INTO codes (code, code_type, used, created_at, expires_at) VALUES (?, ?, 1, ?, ?)",
+            ((f"BENCH-U-{i}", types[i % 4], now - i, expiry(types[i % 4], now))
+             for i in range(args.users * (1 + args.extra_activations))))
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+            ((f"bench_user_{i}", password_hash, now - i) for i in range(args.users)))
+        # Код BENCH-U-<j> активирован пользователем bench_user_<j % users>
+        conn.execute("""INSERT INTO activations (user_id, code_id, activated_at, expires_at)
+                        SELECT u.id, c.id, c.created_at, c.expires_at
+                        FROM codes c
+                        JOIN users u ON u.username = 'bench_user_' || (CAST(substr(c.code, 9) AS INTEGER) % ?)
+                        WHERE c.code LIKE 'BENCH-U-%'
+                          AND NOT EXISTS (SELECT 1 FROM activations a WHERE a.code_id = c.id)
+                        ORDER BY c.id""", (max(args.users, 1),))
+    conn.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, env):
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers), '--threads', str(args.threads),
+           '-b', f'127.0.0.1:{args.port}', '--log-level', 'warning', 'app:app']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=1)
+            conn.request('GET', '/api/status')
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not become ready in 60s")
+
+
+class Workload:
+    """Общее состояние клиентов: счетчики для уникальных имен и свободных кодов"""
+
+    def __init__(self, args):
+        self.args = args
+        self.run_id = f"{int(time.time()) % 100000}"
+        self._lock = threading.Lock()
+        self._next_code = 0
+        auth = base64.b64encode(f"admin:{ADMIN_PASSWORD}".encode()).decode()
+        self.admin_headers = {'Authorization': f'Basic {auth}'}
+
+    def _next(self, attr):
+        with self._lock:
+            value = getattr(self, attr)
+            setattr(self, attr, value + 1)
+            return value
+
+    def register(self):
+        i = self._next('_next_code')
+        body = {"username": f"bench_new_{self.run_id}_{i}", "password": BENCH_PASSWORD,
+                "activation_code": f"BENCH-C-{i % max(self.args.codes, 1)}"}
+        return 'POST', '/api/register', body, {}
+
+    def login(self):
+        i = random.randrange(max(self.args.users, 1))
+        return 'POST', '/api/login', {"username": f"bench_user_{i}", "password": BENCH_PASSWORD}, {}
+
+    def check_user(self):
+        i = random.randrange(max(self.args.users, 1) * 2)
+        return 'POST', '/api/check_user', {"username": f"bench_user_{i}"}, {}
+
+    def list_codes(self):
+        return 'GET', '/api/admin/list_codes?limit=100', None, self.admin_headers
+
+    def list_users(self):
+        return 'GET', '/api/admin/list_users?limit=100', None, self.admin_headers
+
+
+OPERATIONS = ['register', 'login', 'check_user', 'list_codes', 'list_users']
+
+
+def client_loop(args, workload, mix, stop_at, record_from, results):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=args.timeout)
+    while time.time() < stop_at:
+        name = random.choices(names, weights)[0]
+        method, path, body, headers = getattr(workload, name)()
+        payload = json.dumps(body) if body is not None else None
+        if payload is not None:
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+
+        start = time.perf_counter()
+        status = 'connection_error'
+        error = True
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            status = response.status
+            if response.status >= 400:
+                error = True
+            elif response.headers.get('Content-Type', '').startswith('application/json'):
+                error = json.loads(data).get('status') == 'error'
+            else:
+                error = False
+        except (OSError, http.client.HTTPException, ValueError):
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=args.timeout)
+        elapsed = time.perf_counter() - start
+
+        if time.time() >= record_from:
+            results.append((name, elapsed, status, error))
+    conn.close()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# Намеренный отказ сервера под нагрузкой (лимиты частоты, контроль нагрузки) — не ошибка
+SHED_STATUSES = (429, 503)
+
+
+def latency_stats(rows):
+    latencies = sorted(r[1] * 1000 for r in rows)
+    return {
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "p50_ms": round(percentile(latencies, 50), 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 3) if latencies else None,
+        "max_ms": round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def summarize(results, duration):
+    """Сводка по эндпоинтам: задержки успешных ответов отдельно от отклоненных 429/503"""
+    report = {}
+    for name in sorted({r[0] for r in results} | {'total'}):
+        rows = results if name == 'total' else [r for r in results if r[0] == name]
+        shed = [r for r in rows if r[2] in SHED_STATUSES]
+        errors = sum(1 for r in rows if r[3] and r[2] not in SHED_STATUSES)
+        ok = [r for r in rows if not r[3]]
+        statuses = {}
+        for r in rows:
+            statuses[str(r[2])] = statuses.get(str(r[2]), 0) + 1
+        report[name] = dict({
+            "requests": len(rows),
+            "ok": len(ok),
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "shed": len(shed),
+            "shed_rate": round(len(shed) / len(rows), 4) if rows else 0.0,
+            "statuses": dict(sorted(statuses.items())),
+            "rps": round(len(rows) / duration, 2),
+            "ok_rps": round(len(ok) / duration, 2),
+        }, **latency_stats(ok), shed_latency=latency_stats(shed))
+    return report
+
+
+def compare(report, baseline):
+    """Относительное изменение метрик против baseline (в процентах)"""
+    diff = {}
+    for name, stats in report.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        diff[name] = {}
+        for key in ('rps', 'ok_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'error_rate', 'shed_rate'):
+            if stats.get(key) is None or not base.get(key):
+                continue
+            diff[name][key] = round((stats[key] - base[key]) / base[key] * 100, 1)
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the activation API under gunicorn")
+    parser.add_argument('--db', help="SQLite file to seed (default: temporary file)")
+    parser.add_argument('--codes', type=int, default=10000, help="unused codes to seed")
+    parser.add_argument('--users', type=int, default=2000, help="users to seed, one activation each")
+    parser.add_argument('--extra-activations', type=int, default=0, help="additional activations per user")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--threads', type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument('--port', type=int, default=0, help="port for gunicorn (default: random)")
+    parser.add_argument('--clients', type=int, default=16, help="concurrent client threads")
+    parser.add_argument('--duration', type=float, default=20, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=3, help="unmeasured warmup seconds")
+    parser.add_argument('--timeout', type=float, default=30, help="per-request timeout")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="extra environment for the server, e.g. KDF_WORKERS=0")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--baseline', help="compare against a stored report")
+    parser.add_argument('--save-baseline', help="store this report as a baseline")
+    args = parser.parse_args()
+
+    tmpdir = None
+    if not args.db:
+        tmpdir = tempfile.mkdtemp(prefix='activation-bench-')
+        args.db = os.path.join(tmpdir, 'bench.db')
+    if not args.port:
+        args.port = free_port()
+
+    env = dict(os.environ, DB_PATH=args.db, ADMIN_PASSWORD=ADMIN_PASSWORD, **SERVER_ENV)
+    env.update(parse_env(args.env))
+
+    started = time.time()
+    seed_database(args, env)
+    seed_seconds = time.time() - started
+
+    server = start_server(args, env)
+    try:
+        workload = Workload(args)
+        results = []
+        record_from = time.time() + args.warmup
+        stop_at = record_from + args.duration
+        threads = [threading.Thread(target=client_loop,
+                                    args=(args, workload, args.mix, stop_at, record_from, results))
+                   for _ in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    report = {
+        "config": {
+            "codes": args.codes, "users": args.users, "extra_activations": args.extra_activations,
+            "workers": args.workers, "threads": args.threads, "clients": args.clients,
+            "duration": args.duration, "mix": args.mix, "env": dict(SERVER_ENV, **parse_env(args.env)),
+            "seed_seconds": round(seed_seconds, 2),
+        },
+        "endpoints": summarize(results, args.duration),
+    }
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["vs_baseline_pct"] = compare(report["endpoints"], json.load(f)["endpoints"])
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Настройки gunicorn для Activation API.
+
+Схему, миграции и тестовые коды мастер готовит один раз до запуска воркеров,
+индексы загружаются до fork, а каждый воркер прогревает свой пул соединений.
+
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import os
+
+# Мастер сам вызывает bootstrap в on_starting — при импорте приложения он не нужен
+os.environ.setdefault('BOOTSTRAP_ON_IMPORT', '0')
+
+bind = os.environ.get('BIND', '0.0.0.0:' + os.environ.get('PORT', '5000'))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+
+def on_starting(server):
+    import app
+
+    # Снимки метрик и профили процессов прошлого запуска больше не нужны
+    for directory in (app.METRICS_DIR, app.PROFILE_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            pid = filename.split('.')[0].split('-')[0]
+            if pid.isdigit() and not app._pid_alive(int(pid)):
+                os.remove(os.path.join(directory, filename))
+
+    changed = app.bootstrap()
+    app.warm_caches()
+    # Соединения мастера не должны достаться воркерам через fork
+    app.db_pool.close_idle()
+    server.log.info("Bootstrap %s: %s", "applied" if changed else "skipped, database ready",
+                    ", ".join(f"{name}={value}" for name, value in app.STARTUP_TIMINGS.items()))
+
+
+def post_fork(server, worker):
+    import app
+
+    # Лимиты классов запросов считаются от числа потоков, в том числе заданного через --threads
+    app.configure_admission(server.cfg.threads)
+    app.warm_worker()
+    server.log.info("Worker %s warmed up in %s ms", worker.pid, app.STARTUP_TIMINGS['warm_worker_ms'])
+
+
+def worker_exit(server, worker):
+    import app
+
+    # Не теряем накопленные last_login и последние значения метрик
+    try:
+        app.last_login_buffer.flush()
+    except Exception as e:
+        server.log.warning("last_login flush failed: %s", e)
+    app.metrics.dump(force=True)
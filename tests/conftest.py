@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from flask.testing import FlaskClient
+
+# Приложение читает настройки при импорте: отдельная база и отключенные лимиты частоты
+_tmpdir = tempfile.mkdtemp(prefix='activation-tests-')
+os.environ['DB_PATH'] = os.path.join(_tmpdir, 'test.db')
+os.environ.setdefault('RATE_LIMITS', '{}')
+os.environ.setdefault('ADMIN_PASSWORD', 'test-admin')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class BufferedClient(FlaskClient):
+    """Дочитывает и закрывает ответ, как WSGI-сервер: иначе не сработают call_on_close потоковых ответов"""
+
+    def open(self, *args, **kwargs):
+        kwargs.setdefault('buffered', True)
+        return super().open(*args, **kwargs)
+
+
+app.app.test_client_class = BufferedClient
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def admin_auth():
+    return ('admin', os.environ['ADMIN_PASSWORD'])
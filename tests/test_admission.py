@@ -0,0 +1,107 @@
+import threading
+import time
+
+import app
+
+
+def test_limits_leave_threads_for_cheap_requests():
+    for threads in (2, 4, 8, 16):
+        limits = app.admission_limits(threads)
+        available = max(threads - app.ADMISSION_CHEAP_RESERVE, 1)
+        for name in ('kdf', 'admin'):
+            limit, queue_size, timeout = limits[name]
+            # Ожидающие в очереди тоже занимают потоки: вместе с ними класс оставляет резерв дешевым
+            assert limit + queue_size <= available
+            assert timeout <= 2.0
+            if threads >= 4:
+                assert queue_size > 0
+        if threads > 2:
+            assert limits['kdf'][0] + limits['admin'][0] <= available
+
+
+def test_queued_request_waits_until_deadline():
+    gate = app.AdmissionGate('test', 1, 1, 0.2)
+    assert gate.acquire()
+
+    started = time.monotonic()
+    assert not gate.acquire()
+    assert 0.15 <= time.monotonic() - started < 1.0
+
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(gate.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    # Очередь полна — следующий отклоняется сразу
+    started = time.monotonic()
+    assert not gate.acquire()
+    assert time.monotonic() - started < 0.1
+    gate.release()
+    waiter.join(1)
+    assert admitted == [True]
+
+
+def test_status_stays_fast_while_kdf_gate_is_full(client, monkeypatch):
+    app.configure_admission(4)
+    gate = app.admission_gates['kdf']
+    limit, queue_size = gate.limit, gate.queue_size
+    release = threading.Event()
+    entered = threading.Semaphore(0)
+
+    def slow_login(username, password):
+        entered.release()
+        release.wait(10)
+        return {"status": "error", "message": "Invalid username or password"}
+
+    monkeypatch.setattr(app, 'login_user', slow_login)
+    monkeypatch.setattr(gate, 'timeout', 5.0)
+
+    statuses = []
+    def do_login():
+        response = app.app.test_client().post('/api/login', json={'username': 'u', 'password': 'p'})
+        statuses.append(response.status_code)
+
+    holders = [threading.Thread(target=do_login) for _ in range(limit)]
+    for t in holders:
+        t.start()
+    for _ in range(limit):
+        assert entered.acquire(timeout=5)
+    waiters = [threading.Thread(target=do_login) for _ in range(queue_size)]
+    for t in waiters:
+        t.start()
+    deadline = time.monotonic() + 5
+    while gate.stats()['queued'] < queue_size and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    try:
+        assert gate.stats()['queued'] == queue_size
+        # Очередь полна: следующий KDF-запрос сразу получает 503
+        started = time.monotonic()
+        response = client.post('/api/login', json={'username': 'u', 'password': 'p'})
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+        assert time.monotonic() - started < 0.5
+
+        started = time.monotonic()
+        assert client.get('/api/status').status_code == 200
+        assert time.monotonic() - started < 0.5
+    finally:
+        release.set()
+        for t in holders + waiters:
+            t.join(10)
+
+    # Ожидавшие в очереди дождались своей очереди
+    assert statuses == [200] * (limit + queue_size)
+    assert gate.stats()['in_flight'] == 0
+
+
+def test_unauthenticated_admin_requests_skip_admin_gate(client, admin_auth):
+    gate = app.admission_gates['admin']
+    acquired = [gate.acquire() for _ in range(gate.limit)]
+    try:
+        assert all(acquired)
+        assert client.get('/api/admin/list_codes').status_code == 401
+        assert client.get('/api/admin/list_codes', auth=admin_auth).status_code == 503
+    finally:
+        for _ in acquired:
+            gate.release()
+    assert client.get('/api/admin/list_codes', auth=admin_auth).status_code == 200
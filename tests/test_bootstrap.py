@@ -0,0 +1,46 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_ready_database_is_not_touched(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("schema setup on a ready database")
+    monkeypatch.setattr(app, 'init_db', fail)
+    monkeypatch.setattr(app, 'add_test_codes', fail)
+
+    assert app.bootstrap() is False
+
+
+def test_bootstrap_waits_for_lock():
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (app.bootstrap(), done.set()))
+    with app._file_lock(app.BOOTSTRAP_LOCK_PATH):
+        thread.start()
+        assert not done.wait(0.2)
+    thread.join(5)
+    assert done.is_set()
+
+
+def test_concurrent_processes_bootstrap_fresh_database_once(tmp_path):
+    env = dict(os.environ, DB_PATH=str(tmp_path / 'fresh.db'), BOOTSTRAP_ON_IMPORT='1')
+    procs = [subprocess.Popen([sys.executable, '-c', 'import app'], cwd=ROOT, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE) for _ in range(3)]
+    for proc in procs:
+        _, err = proc.communicate(timeout=60)
+        assert proc.returncode == 0, err.decode()
+
+    conn = sqlite3.connect(env['DB_PATH'])
+    try:
+        version = app.schema_version(conn)
+        seeded = conn.execute("SELECT COUNT(*) FROM codes").fetchone()[0]
+    finally:
+        conn.close()
+    assert version == app.SCHEMA_VERSION
+    assert seeded == len(app.TEST_CODES)
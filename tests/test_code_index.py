@@ -0,0 +1,84 @@
+import uuid
+
+import app
+
+
+def insert_code(expires_at=None):
+    code = uuid.uuid4().hex[:12].upper()
+    with app.db_pool.connection() as conn:
+        conn.execute("INSERT INTO codes (code, code_type, created_at, expires_at) VALUES (?, 'week', ?, ?)",
+                     (code, app.now_ts(), expires_at))
+        conn.commit()
+    return code
+
+
+def mark_used(code):
+    with app.db_pool.connection() as conn:
+        conn.execute("UPDATE codes SET used = 1 WHERE code = ?", (code,))
+        conn.commit()
+
+
+def fresh_index(refresh_interval=3600, negative_ttl=300):
+    index = app.CodeIndex(refresh_interval, 100, negative_ttl)
+    index.refresh(force=True)
+    return index
+
+
+def test_negative_cache_is_invalidated_by_new_code():
+    index = fresh_index()
+    code = uuid.uuid4().hex[:12].upper()
+    assert index.lookup(code) == (None, "Invalid activation code")
+    assert code in index._negative
+
+    with app.db_pool.connection() as conn:
+        conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, 'week', ?)", (code, app.now_ts()))
+        conn.commit()
+    # До сверки отказ берется из кэша
+    assert index.lookup(code) == (None, "Invalid activation code")
+
+    index.refresh(force=True)
+    entry, error = index.lookup(code)
+    assert error is None and entry[1] == 'week'
+    assert code not in index._negative
+
+
+def test_code_used_in_another_worker_is_dropped_on_refresh():
+    code = insert_code()
+    index = fresh_index(refresh_interval=0)
+    assert index.lookup(code)[1] is None
+
+    mark_used(code)
+
+    assert index.lookup(code) == (None, "Code already used")
+    assert code not in index._codes
+
+
+def test_expired_and_expiring_codes_are_rejected():
+    index = fresh_index()
+    past = insert_code(expires_at=app.now_ts() - 10)
+    assert index.lookup(past) == (None, "Code expired")
+
+    soon = insert_code(expires_at=app.now_ts() + 3600)
+    index.refresh(force=True)
+    assert index.lookup(soon)[1] is None
+    code_id, code_type, _ = index._codes[soon]
+    index.add(code_id, soon, code_type, app.now_ts() - 1)
+    assert index.lookup(soon) == (None, "Code expired")
+
+
+def test_negative_entries_expire_and_are_bounded():
+    index = app.CodeIndex(3600, 2, 0)
+    index.refresh(force=True)
+    codes = [uuid.uuid4().hex for _ in range(3)]
+    for code in codes:
+        index.lookup(code)
+    assert list(index._negative) == codes[1:]
+
+    code = insert_code()
+    mark_used(code)
+    assert index.lookup(code) == (None, "Code already used")
+    with app.db_pool.connection() as conn:
+        conn.execute("UPDATE codes SET used = 0 WHERE code = ?", (code,))
+        conn.commit()
+    # Нулевой TTL: отказ не переиспользуется, код снова проверяется в базе
+    assert index.lookup(code)[1] is None
@@ -0,0 +1,42 @@
+import json
+
+import app
+
+
+def test_export_restore_round_trip(client, tmp_path):
+    token, _ = app.issue_session_token(424242)
+    assert client.post('/api/session/revoke', json={'token': token}).status_code == 200
+
+    with app.db_pool.connection() as conn:
+        source_version = app.data_version(conn)
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in app.EXPORT_TABLES}
+    lines = ''.join(app.export_rows()).splitlines(keepends=True)
+
+    target = str(tmp_path / 'restored.db')
+    result = app.restore_export(lines, target)
+    assert result['rows'] == counts
+
+    pool = app.ConnectionPool(target, 1, 5)
+    with pool.connection() as conn:
+        jti = json.loads(app._b64decode(token.split('.')[0]))['jti']
+        assert conn.execute("SELECT 1 FROM revoked_sessions WHERE jti = ?", (jti,)).fetchone() is not None
+
+        # Каждая восстановленная строка новее любой версии, которую клиенты видели до восстановления
+        version = app.data_version(conn)
+        assert version == source_version + 1
+        for table in ('codes', 'users'):
+            assert conn.execute(f"SELECT COUNT(*) FROM {table} WHERE row_version != ?", (version,)).fetchone()[0] == 0
+            assert conn.execute(f"SELECT COUNT(*) FROM {table} WHERE row_version > ?",
+                                (source_version,)).fetchone()[0] == counts[table]
+
+
+def test_export_download_does_not_hold_pool_connection(client, admin_auth):
+    response = client.get('/api/admin/export', auth=admin_auth, buffered=False)
+    assert response.status_code == 200
+    body = iter(response.response)
+    next(body)
+
+    assert app.db_pool.stats()['in_use'] == 0
+    assert app.admission_gates['admin'].stats()['in_flight'] == 1
+    response.close()
+    assert app.admission_gates['admin'].stats()['in_flight'] == 0
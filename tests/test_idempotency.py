@@ -0,0 +1,99 @@
+import uuid
+
+import app
+
+
+def count_codes():
+    with app.db_pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM codes").fetchone()[0]
+
+
+def generate(client, admin_auth, key, count=5):
+    return client.post('/api/admin/generate_codes', json={'count': count, 'code_type': 'day'},
+                       headers={'Idempotency-Key': key}, auth=admin_auth)
+
+
+def test_oversized_response_is_not_executed_twice(client, admin_auth, monkeypatch):
+    monkeypatch.setattr(app, 'IDEMPOTENCY_MAX_RESPONSE', 100)
+    key = str(uuid.uuid4())
+    before = count_codes()
+
+    first = generate(client, admin_auth, key, count=20)
+    assert first.status_code == 200
+    assert len(first.get_json()['codes']) == 20
+
+    replay = generate(client, admin_auth, key, count=20)
+    assert replay.status_code == 410
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert count_codes() == before + 20
+
+
+def new_code():
+    code = uuid.uuid4().hex[:12].upper()
+    with app.db_pool.connection() as conn:
+        conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, 'month', ?)", (code, app.now_ts()))
+        conn.commit()
+    return code
+
+
+def register(client, key, username, code, addr='10.1.0.1'):
+    return client.post('/api/register', json={'username': username, 'password': 'secret', 'activation_code': code},
+                       headers={'Idempotency-Key': key}, environ_base={'REMOTE_ADDR': addr})
+
+
+def claimed(key):
+    with app.db_pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM idempotency_keys WHERE key LIKE ?", (f'%:{key}',)).fetchone()[0]
+
+
+def test_replay_returns_stored_response(client):
+    key = str(uuid.uuid4())
+    username = f'idem-{key[:8]}'
+    code = new_code()
+
+    first = register(client, key, username, code)
+    assert first.get_json()['status'] == 'success'
+    replay = register(client, key, username, code)
+    assert replay.status_code == first.status_code
+    assert replay.get_data() == first.get_data()
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    with app.db_pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE username = ?", (username,)).fetchone()[0] == 1
+
+
+def test_same_key_with_different_body_is_rejected(client):
+    key = str(uuid.uuid4())
+    code = new_code()
+    register(client, key, f'idem-{key[:8]}', code)
+    other = register(client, key, f'idem-other-{key[:8]}', code)
+    assert other.status_code == 422
+
+
+def test_key_in_progress_elsewhere_returns_409(client, admin_auth, monkeypatch):
+    monkeypatch.setattr(app.idempotency_store, 'wait', 0.2)
+    key = str(uuid.uuid4())
+    # Ключ занят запросом, который выполняется в другом воркере
+    with app.db_pool.connection() as conn:
+        conn.execute("""INSERT INTO idempotency_keys (key, fingerprint, status, response, expires_at)
+                        VALUES (?, 'other', NULL, NULL, ?)""", (f"add_code:{admin_auth[0]}:{key}", app.now_ts() + 60))
+        conn.commit()
+
+    response = client.post('/api/admin/add_code', json={'code': key[:12], 'code_type': 'day'},
+                           headers={'Idempotency-Key': key}, auth=admin_auth)
+    assert response.status_code == 409
+    assert response.headers['Retry-After']
+
+
+def test_rate_limit_checked_before_idempotency_claim(client, monkeypatch):
+    monkeypatch.setitem(app.RATE_LIMITS, 'register', {'ip': (1, 0.001)})
+    code = new_code()
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+
+    register(client, first, f'idem-{first[:8]}', code, addr='10.1.1.1')
+    writes = app.write_pipeline.stats()['ops']
+    limited = register(client, second, f'idem-{second[:8]}', code, addr='10.1.1.1')
+    assert limited.status_code == 429
+    # Отклоненный лимитом запрос не занимал и не освобождал ключ
+    assert app.write_pipeline.stats()['ops'] == writes
+    assert claimed(first) == 1
+    assert claimed(second) == 0
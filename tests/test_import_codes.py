@@ -0,0 +1,42 @@
+import json
+import uuid
+
+import app
+
+
+def code_exists(code):
+    with app.db_pool.connection() as conn:
+        return conn.execute("SELECT 1 FROM codes WHERE code = ?", (code,)).fetchone() is not None
+
+
+def test_malformed_line_reports_imported_counts(client, admin_auth, monkeypatch):
+    monkeypatch.setattr(app, 'BULK_CHUNK_SIZE', 2)
+    prefix = uuid.uuid4().hex[:8].upper()
+    codes = [f'{prefix}{i}' for i in range(5)]
+    lines = [json.dumps({'code': code}) for code in codes[:3]]
+    lines += [json.dumps({'code': ''}), '{not json', json.dumps({'code': codes[3]})]
+
+    response = client.post('/api/admin/import_codes', data='\n'.join(lines) + '\n',
+                           content_type='application/x-ndjson', auth=admin_auth)
+    result = response.get_json()
+
+    assert response.status_code == 400
+    assert result['line'] == 5
+    assert (result['created'], result['duplicates'], result['invalid']) == (3, 0, 1)
+    # Все строки до некорректной записаны, после нее — нет
+    assert all(code_exists(code) for code in codes[:3])
+    assert not code_exists(codes[3])
+
+
+def test_csv_undecodable_line_after_duplicates(client, admin_auth, monkeypatch):
+    monkeypatch.setattr(app, 'BULK_CHUNK_SIZE', 1)
+    code = uuid.uuid4().hex[:10].upper()
+    body = f'code,code_type\n{code},day\n{code},day\n'.encode() + b'\xff\xfe,day\n'
+
+    result = client.post('/api/admin/import_codes', data=body, content_type='text/csv',
+                         auth=admin_auth).get_json()
+
+    assert result['status'] == 'error'
+    assert result['line'] == 4
+    assert (result['created'], result['duplicates'], result['invalid']) == (1, 1, 0)
+    assert code_exists(code)
@@ -0,0 +1,48 @@
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import app
+
+
+class BrokenPool:
+    def submit(self, fn, *args):
+        raise BrokenProcessPool("worker died")
+
+
+def test_process_pool_runs_kdf():
+    executor = app.KdfExecutor(1, 2, 1.0)
+    try:
+        assert executor.run(pow, 2, 10) == 1024
+    finally:
+        executor.shutdown()
+    stats = executor.stats()
+    assert (stats['submitted'], stats['completed'], stats['inline'], stats['in_flight']) == (1, 1, 0, 0)
+
+
+def test_disabled_pool_runs_inline():
+    executor = app.KdfExecutor(0, 2, 1.0)
+    assert executor.run(pow, 3, 2) == 9
+    stats = executor.stats()
+    assert (stats['enabled'], stats['submitted'], stats['inline']) == (False, 0, 1)
+
+
+def test_broken_pool_falls_back_inline_and_is_recreated(monkeypatch):
+    executor = app.KdfExecutor(1, 2, 1.0)
+    monkeypatch.setattr(executor, '_get_executor', lambda: BrokenPool())
+
+    assert executor.run(pow, 2, 5) == 32
+    assert executor._executor is None
+    stats = executor.stats()
+    assert (stats['completed'], stats['inline'], stats['in_flight']) == (1, 1, 0)
+
+
+def test_full_queue_rejects_after_timeout():
+    executor = app.KdfExecutor(1, 1, 0.01)
+    executor._slots.acquire()
+    try:
+        with pytest.raises(app.KdfBusyError):
+            executor.run(pow, 2, 2)
+    finally:
+        executor._slots.release()
+    assert executor.stats()['rejected'] == 1
@@ -0,0 +1,67 @@
+import sqlite3
+import uuid
+
+import pytest
+
+import app
+
+
+class FailingPool:
+    def connection(self):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def new_user(last_login=None):
+    with app.db_pool.connection() as conn:
+        user_id = conn.execute("INSERT INTO users (username, password_hash, created_at, last_login) VALUES (?, 'x', ?, ?)",
+                               (f'login-{uuid.uuid4().hex[:8]}', app.now_ts(), last_login)).lastrowid
+        conn.commit()
+    return user_id
+
+
+def stored(user_id, minute):
+    with app.db_pool.connection() as conn:
+        last_login = conn.execute("SELECT last_login FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+        row = conn.execute("SELECT count FROM activity_minutes WHERE event = 'login' AND minute = ?",
+                           (minute,)).fetchone()
+    return last_login, row[0] if row else 0
+
+
+def base_ts():
+    # Своя минута на тест, чтобы счетчики других тестов не мешали
+    return (1_000_000_000 // 60 + uuid.uuid4().int % 1_000_000) * 60
+
+
+def test_flush_keeps_latest_login_and_counts_every_login():
+    ts = base_ts()
+    buffer = app.LastLoginBuffer(3600, 1000)
+    first, second = new_user(), new_user(last_login=ts + 50)
+
+    buffer.record(first, ts + 10)
+    buffer.record(first, ts + 5)
+    buffer.record(second, ts + 20)
+    assert buffer.get(first) == ts + 10
+
+    assert buffer.flush() == 2
+    assert stored(first, ts // 60) == (ts + 10, 3)
+    # Более свежее значение в базе не перезаписывается
+    assert stored(second, ts // 60) == (ts + 50, 3)
+    assert buffer.get(first) is None
+    assert buffer.stats()['flushed_rows'] == 2
+
+
+def test_failed_flush_merges_back_into_buffer(monkeypatch):
+    ts = base_ts()
+    buffer = app.LastLoginBuffer(3600, 1000)
+    user_id = new_user()
+    buffer.record(user_id, ts + 30)
+
+    with monkeypatch.context() as m:
+        m.setattr(app, 'db_pool', FailingPool())
+        with pytest.raises(sqlite3.OperationalError):
+            buffer.flush()
+    buffer.record(user_id, ts + 1)
+
+    assert buffer.get(user_id) == ts + 30
+    assert buffer.flush() == 1
+    assert stored(user_id, ts // 60) == (ts + 30, 2)
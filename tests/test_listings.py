@@ -0,0 +1,96 @@
+import uuid
+
+import app
+
+
+def new_code(code_type='month'):
+    code = uuid.uuid4().hex[:12].upper()
+    with app.db_pool.connection() as conn:
+        code_id = conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, ?, ?)",
+                               (code, code_type, app.now_ts())).lastrowid
+        conn.commit()
+    return code_id, code
+
+
+def registered_user(client):
+    username = f'list-{uuid.uuid4().hex[:8]}'
+    result = client.post('/api/register', json={'username': username, 'password': 'secret',
+                                                'activation_code': new_code()[1]}).get_json()
+    assert result['status'] == 'success'
+    return username
+
+
+def test_codes_etag_ignores_other_tables(client, admin_auth):
+    username = registered_user(client)
+    first = client.get('/api/admin/list_codes?limit=50', auth=admin_auth)
+    etag = first.headers['ETag']
+    users_etag = client.get('/api/admin/list_users?limit=50', auth=admin_auth).headers['ETag']
+
+    # Вход и сброс last_login меняют только users
+    assert client.post('/api/login', json={'username': username, 'password': 'secret'}).get_json()['status'] == 'success'
+    app.last_login_buffer.flush()
+
+    cached = client.get('/api/admin/list_codes?limit=50', auth=admin_auth, headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert client.get('/api/admin/list_users?limit=50', auth=admin_auth,
+                      headers={'If-None-Match': users_etag}).status_code == 200
+
+    new_code()
+    changed = client.get('/api/admin/list_codes?limit=50', auth=admin_auth, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_since_returns_changes_and_removed(client, admin_auth):
+    code_id, _ = new_code()
+    version = client.get('/api/admin/list_codes?limit=1', auth=admin_auth).get_json()['version']
+
+    with app.db_pool.connection() as conn:
+        conn.execute("UPDATE codes SET used = 1 WHERE id = ?", (code_id,))
+        conn.commit()
+
+    delta = client.get(f'/api/admin/list_codes?since={version}', auth=admin_auth).get_json()
+    assert [item['id'] for item in delta['codes']] == [code_id]
+    assert delta['codes'][0]['used'] is True
+    assert delta['removed'] == []
+    assert delta['version'] > version
+
+    # Код больше не подходит под фильтр used=0 — клиент должен убрать его из списка
+    filtered = client.get(f'/api/admin/list_codes?since={version}&used=0', auth=admin_auth).get_json()
+    assert filtered['codes'] == []
+    assert filtered['removed'] == [code_id]
+
+    assert client.get(f"/api/admin/list_codes?since={delta['version']}", auth=admin_auth).get_json()['codes'] == []
+
+
+def test_listing_without_paging_params_returns_every_row(client, admin_auth, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_PAGE_SIZE', 2)
+    for _ in range(3):
+        new_code()
+    with app.db_pool.connection() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM codes").fetchone()[0]
+        unused = conn.execute("SELECT COUNT(*) FROM codes WHERE used = 0").fetchone()[0]
+
+    everything = client.get('/api/admin/list_codes', auth=admin_auth).get_json()
+    assert everything['status'] == 'success'
+    assert len(everything['codes']) == total > 2
+    assert len(client.get('/api/admin/list_codes?used=0', auth=admin_auth).get_json()['codes']) == unused
+
+    page = client.get('/api/admin/list_codes?limit=2', auth=admin_auth).get_json()
+    assert len(page['codes']) == 2
+    assert page['next_cursor']
+
+
+def test_stream_keeps_admission_slot_but_not_pool_connection(client, admin_auth):
+    gate = app.admission_gates['admin']
+    response = client.get('/api/admin/list_codes?stream=1', auth=admin_auth, buffered=False)
+    body = iter(response.response)
+    assert next(body).startswith(b'{"status": "success"')
+    next(body)
+
+    # Посреди тела ответа: место админа занято, соединение пула свободно
+    assert gate.stats()['in_flight'] == 1
+    assert app.db_pool.stats()['in_use'] == 0
+
+    response.close()
+    assert gate.stats()['in_flight'] == 0
@@ -0,0 +1,49 @@
+import json
+import subprocess
+import sys
+
+import app
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def write_snapshot(directory, pid, counter, gauge, histogram):
+    with open(directory / f'{pid}.json', 'w') as f:
+        json.dump({"pid": pid,
+                   "counters": [['activation_http_requests_total', {'route': '/x'}, counter]],
+                   "histograms": [['activation_request_seconds', {'route': '/x'}, histogram]],
+                   "gauges": [['activation_db_pool_in_use', {}, gauge]]}, f)
+
+
+def test_collect_sums_workers_and_drops_gauges_of_dead_ones(tmp_path):
+    metrics = app.Metrics(str(tmp_path), 0)
+    metrics.inc('activation_http_requests_total', 2, route='/x')
+    metrics.observe('activation_request_seconds', 0.003, route='/x')
+    metrics.gauge('activation_db_pool_in_use', lambda: 1)
+    buckets = len(app.LATENCY_BUCKETS) + 1
+    dead = [0] * buckets + [20.0]
+    dead[buckets - 1] = 1
+    write_snapshot(tmp_path, dead_pid(), 5, 7, dead)
+
+    lines = metrics.collect().splitlines()
+
+    assert 'activation_http_requests_total{route="/x"} 7' in lines
+    assert 'activation_db_pool_in_use 1' in lines
+    assert 'activation_request_seconds_bucket{route="/x",le="0.001"} 0' in lines
+    assert 'activation_request_seconds_bucket{route="/x",le="0.005"} 1' in lines
+    assert 'activation_request_seconds_bucket{route="/x",le="10.0"} 1' in lines
+    assert 'activation_request_seconds_bucket{route="/x",le="+Inf"} 2' in lines
+    assert 'activation_request_seconds_count{route="/x"} 2' in lines
+    assert '# TYPE activation_http_requests_total counter' in lines
+
+
+def test_metrics_endpoint_requires_auth(client, admin_auth):
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', auth=admin_auth)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'activation_http_requests_total' in response.get_data(as_text=True)
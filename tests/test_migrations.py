@@ -0,0 +1,91 @@
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta
+
+import app
+
+# Схема исходной версии приложения: даты строками str(datetime)
+BASELINE_SCHEMA = [
+    '''CREATE TABLE codes
+       (id INTEGER PRIMARY KEY,
+        code TEXT UNIQUE NOT NULL,
+        used INTEGER DEFAULT 0,
+        code_type TEXT NOT NULL,
+        created_at TIMESTAMP,
+        expires_at TIMESTAMP)''',
+    '''CREATE TABLE users
+       (id INTEGER PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP,
+        last_login TIMESTAMP)''',
+    '''CREATE TABLE activations
+       (id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        code_id INTEGER NOT NULL,
+        activated_at TIMESTAMP,
+        expires_at TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(code_id) REFERENCES codes(id))''',
+]
+
+
+def make_baseline_db(path):
+    now = datetime.now().replace(microsecond=123456)
+    month = now + timedelta(days=30)
+    salt = b'$' + bytes(31)
+    password_hash = salt + hashlib.pbkdf2_hmac('sha256', b'secret', salt, 100000)
+
+    conn = sqlite3.connect(path)
+    for sql in BASELINE_SCHEMA:
+        conn.execute(sql)
+    conn.executemany("INSERT INTO codes (id, code, used, code_type, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(1, 'OLD-DAY', 1, 'day', str(now - timedelta(days=3)), str(now - timedelta(days=2))),
+                      (2, 'OLD-MONTH', 1, 'month', str(now), str(month)),
+                      (3, 'OLD-FREE', 0, 'forever', now.strftime('%Y-%m-%d %H:%M:%S'), None)])
+    conn.execute("INSERT INTO users (id, username, password_hash, created_at, last_login) VALUES (?, ?, ?, ?, ?)",
+                 (1, 'olduser', password_hash, str(now - timedelta(days=3)), str(now)))
+    conn.executemany("INSERT INTO activations (user_id, code_id, activated_at, expires_at) VALUES (?, ?, ?, ?)",
+                     [(1, 1, str(now - timedelta(days=3)), str(now - timedelta(days=2))),
+                      (1, 2, str(now), str(month))])
+    conn.commit()
+    conn.close()
+    return now, month
+
+
+def test_migrate_baseline_database(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    now, month = make_baseline_db(path)
+
+    pool = app.ConnectionPool(path, 1, 5)
+    with pool.connection() as conn:
+        app.init_db(conn)
+        assert app.schema_version(conn) == app.SCHEMA_VERSION
+
+        # Строки дат стали целыми секундами эпохи
+        created_at, expires_at = conn.execute("SELECT created_at, expires_at FROM codes WHERE id = 2").fetchone()
+        assert created_at == int(now.timestamp())
+        assert expires_at == int(month.timestamp())
+        assert conn.execute("SELECT created_at FROM codes WHERE id = 3").fetchone()[0] == int(now.replace(microsecond=0).timestamp())
+        assert conn.execute("""SELECT COUNT(*) FROM codes WHERE typeof(created_at) != 'integer'
+                               OR typeof(expires_at) NOT IN ('integer', 'null')""").fetchone()[0] == 0
+
+        # Подписка — последняя активация пользователя
+        assert conn.execute("SELECT code_type, expires_at FROM user_subscription WHERE user_id = 1").fetchone() == \
+            ('month', int(month.timestamp()))
+
+        # Старый хеш пароля остался читаемым
+        password_hash = conn.execute("SELECT password_hash FROM users WHERE id = 1").fetchone()[0]
+        assert app.verify_password(password_hash, 'secret')
+
+        # Повторный запуск миграций ничего не делает
+        assert app.run_migrations(conn) == []
+
+
+def test_migrations_on_fresh_database(tmp_path):
+    pool = app.ConnectionPool(str(tmp_path / 'fresh.db'), 1, 5)
+    with pool.connection() as conn:
+        app.init_db(conn)
+        assert app.schema_version(conn) == app.SCHEMA_VERSION
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        assert {'codes', 'users', 'activations', 'user_subscription', 'data_version'} <= tables
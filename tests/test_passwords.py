@@ -0,0 +1,26 @@
+import hashlib
+import os
+
+import app
+
+
+def legacy_hash(password, salt):
+    return salt + hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
+
+
+def test_legacy_hash_with_dollar_salt():
+    salt = b'$' + os.urandom(31)
+    stored = legacy_hash('secret', salt)
+    scheme, version, params, decoded_salt, _ = app.decode_password_hash(stored)
+    assert (scheme, version, params) == app.LEGACY_HASH_PARAMS
+    assert decoded_salt == salt
+    assert app.verify_password(stored, 'secret')
+    assert not app.verify_password(memoryview(stored), 'wrong')
+    assert app.needs_rehash(stored)
+
+
+def test_current_hash_round_trip():
+    stored = app.hash_password('secret')
+    assert app.verify_password(stored, 'secret')
+    assert not app.verify_password(stored.encode('ascii'), 'wrong')
+    assert not app.needs_rehash(stored)
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+import app
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def offer(store, duration_ms):
+    def write(path):
+        with open(path, 'w') as f:
+            f.write('main;handler 1\n')
+    return store.offer({'duration_ms': duration_ms, 'path': '/api/status'}, '.collapsed', write)
+
+
+def test_profiles_of_dead_workers_are_pruned(tmp_path):
+    pid = dead_pid()
+    for suffix in ('.json', '.collapsed'):
+        (tmp_path / f'{pid}-1{suffix}').write_text('{"duration_ms": 999, "id": "x", "file": "x"}')
+    store = app.ProfileStore(str(tmp_path), 5)
+
+    profile_id = offer(store, 10)
+
+    assert [p['id'] for p in store.list()] == [profile_id]
+    assert sorted(os.listdir(tmp_path)) == [f'{profile_id}.collapsed', f'{profile_id}.json']
+
+
+def test_store_keeps_slowest_profiles_and_removes_evicted_files(tmp_path):
+    store = app.ProfileStore(str(tmp_path), 2)
+    slow, fast = offer(store, 50), offer(store, 20)
+
+    assert offer(store, 10) is None
+    slowest = offer(store, 80)
+
+    assert [p['id'] for p in store.list()] == [slowest, slow]
+    assert not any(name.startswith(fast + '.') for name in os.listdir(tmp_path))
+    meta, path = store.get(slowest)
+    assert meta['duration_ms'] == 80 and os.path.exists(path)
+    assert store.get(fast) is None
+    assert store.get('../etc/passwd') is None
@@ -0,0 +1,49 @@
+import app
+
+
+def redeem(client, token, code='NO-SUCH-CODE', addr='10.0.0.1'):
+    return client.post('/api/redeem', json={'activation_code': code},
+                       headers={'Authorization': f'Bearer {token}'},
+                       environ_base={'REMOTE_ADDR': addr})
+
+
+def test_redeem_limited_per_session_user(client, monkeypatch):
+    monkeypatch.setitem(app.RATE_LIMITS, 'redeem', {'uid': (3, 0.001)})
+    token, _ = app.issue_session_token(910001)
+    other, _ = app.issue_session_token(910002)
+
+    # Каждый запрос приходит с нового адреса: лимит держится на uid из токена
+    statuses = [redeem(client, token, addr=f'10.0.1.{i}').status_code for i in range(4)]
+    assert statuses == [200, 200, 200, 429]
+    assert redeem(client, other, addr='10.0.1.9').status_code == 200
+
+
+def test_redeem_limited_per_ip(client, monkeypatch):
+    monkeypatch.setitem(app.RATE_LIMITS, 'redeem', {'ip': (2, 0.001)})
+    statuses = [redeem(client, app.issue_session_token(910100 + i)[0], addr='10.0.2.1').status_code
+                for i in range(3)]
+    assert statuses == [200, 200, 429]
+    # Без валидного токена запрос все равно учитывается по адресу
+    assert redeem(client, 'garbage', addr='10.0.2.1').status_code == 429
+
+
+def post(client, route, username, addr):
+    return client.post(f'/api/{route}', json={'username': username, 'password': 'secret'},
+                       environ_base={'REMOTE_ADDR': addr})
+
+
+def test_login_limited_per_username_across_addresses(client, monkeypatch):
+    monkeypatch.setitem(app.RATE_LIMITS, 'login', {'ip': (100, 1), 'username': (2, 0.001)})
+    statuses = [post(client, 'login', name, f'10.0.3.{i}').status_code
+                for i, name in enumerate(['victim-014', 'Victim-014', ' VICTIM-014 '])]
+    assert statuses == [200, 200, 429]
+    assert post(client, 'login', 'bystander-014', '10.0.3.9').status_code == 200
+
+
+def test_register_limited_per_ip_with_retry_after(client, monkeypatch):
+    monkeypatch.setitem(app.RATE_LIMITS, 'register', {'ip': (2, 0.5), 'username': (5, 1)})
+    responses = [post(client, 'register', f'spam-014-{i}', '10.0.4.1') for i in range(3)]
+    assert [r.status_code for r in responses] == [400, 400, 429]
+    assert responses[2].headers['Retry-After'] == '2'
+    assert responses[2].get_json()['message'] == 'Too many requests, try again later'
+    assert post(client, 'register', 'spam-014-x', '10.0.4.2').status_code == 400
@@ -0,0 +1,72 @@
+import uuid
+
+import app
+
+DAY = 86400
+
+
+def new_code(code_type):
+    code = uuid.uuid4().hex[:12].upper()
+    with app.db_pool.connection() as conn:
+        conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, ?, ?)",
+                     (code, code_type, app.now_ts()))
+        conn.commit()
+    return code
+
+
+def new_user(client, code_type):
+    username = f'redeem-{uuid.uuid4().hex[:8]}'
+    result = client.post('/api/register', json={'username': username, 'password': 'secret',
+                                                'activation_code': new_code(code_type)}).get_json()
+    assert result['status'] == 'success'
+    return result['user_id']
+
+
+def redeem(client, user_id, code_type):
+    token, _ = app.issue_session_token(user_id)
+    return client.post('/api/redeem', json={'token': token, 'activation_code': new_code(code_type)}).get_json()
+
+
+def subscription(user_id):
+    with app.db_pool.connection() as conn:
+        return conn.execute("SELECT code_type, expires_at, is_forever FROM user_subscription WHERE user_id = ?",
+                            (user_id,)).fetchone()
+
+
+def test_redeem_extends_from_current_expiry(client):
+    user_id = new_user(client, 'month')
+    _, expires_at, _ = subscription(user_id)
+
+    assert redeem(client, user_id, 'day')['status'] == 'success'
+    # Более короткий код не понижает тип, а добавляет свой срок к текущему
+    assert subscription(user_id) == ('month', expires_at + DAY, 0)
+
+
+def test_redeem_after_expiry_starts_from_now(client):
+    user_id = new_user(client, 'day')
+    with app.db_pool.connection() as conn:
+        conn.execute("UPDATE user_subscription SET expires_at = ? WHERE user_id = ?", (app.now_ts() - 10 * DAY, user_id))
+        conn.commit()
+
+    assert redeem(client, user_id, 'week')['status'] == 'success'
+    code_type, expires_at, _ = subscription(user_id)
+    assert code_type == 'week'
+    assert abs(expires_at - (app.now_ts() + 7 * DAY)) <= 2
+
+
+def test_forever_is_never_downgraded(client):
+    user_id = new_user(client, 'forever')
+    token, _ = app.issue_session_token(user_id)
+    code = new_code('day')
+
+    result = client.post('/api/redeem', json={'token': token, 'activation_code': code}).get_json()
+    assert result == {"status": "error", "message": "Subscription is already forever"}
+    assert subscription(user_id) == ('forever', None, 1)
+    with app.db_pool.connection() as conn:
+        assert conn.execute("SELECT used FROM codes WHERE code = ?", (code,)).fetchone()[0] == 0
+
+
+def test_redeem_forever_code_upgrades(client):
+    user_id = new_user(client, 'day')
+    assert redeem(client, user_id, 'forever')['status'] == 'success'
+    assert subscription(user_id) == ('forever', None, 1)
@@ -0,0 +1,59 @@
+import uuid
+
+import app
+
+
+def new_code(code_type):
+    code = uuid.uuid4().hex[:12].upper()
+    with app.db_pool.connection() as conn:
+        conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, ?, ?)",
+                     (code, code_type, app.now_ts()))
+        conn.commit()
+    return code
+
+
+def login_token(client):
+    username = f'session-{uuid.uuid4().hex[:8]}'
+    client.post('/api/register', json={'username': username, 'password': 'secret',
+                                       'activation_code': new_code('month')})
+    result = client.post('/api/login', json={'username': username, 'password': 'secret'}).get_json()
+    assert result['status'] == 'success'
+    return result['user_id'], result['token']
+
+
+def verify(client, token):
+    return client.post('/api/session/verify', headers={'Authorization': f'Bearer {token}'})
+
+
+def test_login_token_verifies_without_password(client):
+    user_id, token = login_token(client)
+
+    result = verify(client, token).get_json()
+
+    assert (result['status'], result['user_id'], result['code_type']) == ('success', user_id, 'month')
+    assert result['is_active'] is True
+
+
+def test_tampered_and_expired_tokens_are_rejected(client, monkeypatch):
+    _, token = login_token(client)
+    payload, signature = token.split('.')
+    forged = app._b64encode(app._b64decode(payload).replace(b'"uid":', b'"uid":1')) + '.' + signature
+    assert verify(client, forged).status_code == 401
+    assert verify(client, 'garbage').status_code == 401
+
+    monkeypatch.setattr(app, 'SESSION_TTL', -1)
+    expired, _ = app.issue_session_token(1)
+    assert verify(client, expired).status_code == 401
+
+
+def test_revoked_token_is_rejected_in_every_worker(client):
+    _, token = login_token(client)
+    jti = app.decode_session_token(token)['jti']
+
+    result = client.post('/api/session/revoke', json={'token': token}).get_json()
+
+    assert result['status'] == 'success'
+    assert verify(client, token).status_code == 401
+    # Другой воркер узнает об отзыве из revoked_sessions
+    other_worker = app.RevocationList(0)
+    assert other_worker.is_revoked(jti)
@@ -0,0 +1,32 @@
+import gzip
+
+import app
+
+
+def test_pages_negotiate_encoding(client):
+    plain = client.get('/', headers={'Accept-Encoding': 'identity'})
+    packed = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert packed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(packed.get_data()) == plain.get_data()
+    assert plain.headers['ETag'] != packed.headers['ETag']
+    for response in (plain, packed):
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert response.headers['Cache-Control'] == f'public, max-age={app.PAGE_MAX_AGE}'
+
+
+def test_matching_etag_returns_empty_304(client):
+    first = client.get('/admin', headers={'Accept-Encoding': 'gzip'})
+    etag = first.headers['ETag']
+
+    again = client.get('/admin', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert again.headers['ETag'] == etag
+
+    # ETag другой кодировки не подходит: клиенту нужно другое тело
+    other = client.get('/admin', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+    assert other.status_code == 200
+    assert b'<!DOCTYPE html>' in other.get_data()
+
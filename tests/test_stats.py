@@ -0,0 +1,70 @@
+import uuid
+
+import app
+
+DAY = 86400
+
+
+def scan_totals(conn):
+    """Те же числа полным сканом — эталон для счетчиков"""
+    by_type = {}
+    for code_type, used, count in conn.execute(
+            "SELECT code_type, COALESCE(used, 0), COUNT(*) FROM codes GROUP BY 1, 2"):
+        by_type.setdefault(code_type, {"used": 0, "unused": 0})["used" if used else "unused"] += count
+    users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    expired = conn.execute("SELECT COUNT(*) FROM user_subscription WHERE expires_at < ?", (app.now_ts(),)).fetchone()[0]
+    return by_type, users, expired
+
+
+def test_counters_follow_inserts_updates_and_deletes(client, admin_auth):
+    now = app.now_ts()
+    prefix = uuid.uuid4().hex[:8]
+    with app.db_pool.connection() as conn:
+        ids = [conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, ?, ?)",
+                            (f'{prefix}{i}', code_type, now)).lastrowid
+               for i, code_type in enumerate(['day', 'week', 'month', 'month'])]
+        conn.execute("UPDATE codes SET used = 1 WHERE id = ?", (ids[0],))
+        conn.execute("UPDATE codes SET code_type = 'forever' WHERE id = ?", (ids[1],))
+        conn.execute("DELETE FROM codes WHERE id = ?", (ids[2],))
+        user_ids = [conn.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, 'x', ?)",
+                                 (f'{prefix}-user{i}', now)).lastrowid for i in range(3)]
+        # Подписка истекла позавчера, другую продлили из прошлого в будущее, третью удалили
+        for user_id, expires_at in zip(user_ids, (now - 2 * DAY, now - DAY, now + DAY)):
+            conn.execute("""INSERT INTO user_subscription (user_id, code_type, activated_at, expires_at, is_forever)
+                            VALUES (?, 'day', ?, ?, 0)""", (user_id, now - 3 * DAY, expires_at))
+        conn.execute("UPDATE user_subscription SET expires_at = ? WHERE user_id = ?", (now + 7 * DAY, user_ids[1]))
+        conn.execute("DELETE FROM user_subscription WHERE user_id = ?", (user_ids[2],))
+        conn.execute("DELETE FROM users WHERE id = ?", (user_ids[2],))
+        conn.commit()
+        by_type, users, expired = scan_totals(conn)
+
+    stats = client.get('/api/admin/stats', auth=admin_auth).get_json()
+
+    assert {t: c for t, c in stats['codes']['by_type'].items() if c != {"used": 0, "unused": 0}} == by_type
+    assert stats['codes']['total'] == sum(c['used'] + c['unused'] for c in by_type.values())
+    assert stats['users']['total'] == users
+    assert stats['users']['expired'] == expired
+
+
+def activity(conn, ts):
+    minute = conn.execute("SELECT count FROM activity_minutes WHERE event = 'register' AND minute = ?",
+                          (ts // 60,)).fetchone()
+    day = conn.execute("SELECT count FROM activity_days WHERE event = 'register' AND day = ?",
+                       (ts // DAY,)).fetchone()
+    return (minute[0] if minute else 0), (day[0] if day else 0)
+
+
+def test_registration_series_counts_new_users(client, admin_auth):
+    ts = app.now_ts()
+    with app.db_pool.connection() as conn:
+        minute, day = activity(conn, ts)
+        conn.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, 'x', ?)",
+                     (f'series-{uuid.uuid4().hex[:8]}', ts))
+        conn.commit()
+        assert activity(conn, ts) == (minute + 1, day + 1)
+
+    stats = client.get('/api/admin/stats?minutes=5&days=2', auth=admin_auth).get_json()
+
+    assert len(stats['registrations']['per_minute']) == 5
+    assert len(stats['logins']['per_day']) == 2
+    assert stats['registrations']['per_minute'][-1] >= 1 or app.now_ts() // 60 != ts // 60
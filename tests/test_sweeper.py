@@ -0,0 +1,64 @@
+import sqlite3
+import time
+import uuid
+
+import app
+
+
+def set_lease(owner, expires_at):
+    with app.db_pool.connection() as conn:
+        conn.execute("DELETE FROM leases")
+        if owner is not None:
+            conn.execute("INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                         (app.ExpirySweeper.lease_name, owner, expires_at))
+        conn.commit()
+
+
+def new_code(expires_at):
+    with app.db_pool.connection() as conn:
+        code_id = conn.execute("INSERT INTO codes (code, code_type, created_at, expires_at) VALUES (?, 'day', ?, ?)",
+                               (uuid.uuid4().hex, app.now_ts(), expires_at)).lastrowid
+        conn.commit()
+    return code_id
+
+
+def code_state(code_id):
+    with app.db_pool.connection() as conn:
+        expired = conn.execute("SELECT expired FROM codes WHERE id = ?", (code_id,)).fetchone()[0]
+        events = conn.execute("SELECT COUNT(*) FROM expiry_events WHERE entity = 'code' AND entity_id = ?",
+                              (code_id,)).fetchone()[0]
+    return expired, events
+
+
+def test_foreign_lease_skips_without_write_lock():
+    set_lease('other-host:1', app.now_ts() + 60)
+    sweeper = app.ExpirySweeper(0, 10)
+    writer = sqlite3.connect(app.DB_PATH, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        start = time.perf_counter()
+        assert sweeper.sweep() is None
+        assert time.perf_counter() - start < 1
+    finally:
+        writer.rollback()
+        writer.close()
+    assert sweeper.stats()['lease_owner'] is False
+
+
+def test_expired_lease_is_taken_over_and_rows_flagged_in_batches():
+    set_lease('other-host:1', app.now_ts() - 1)
+    past = [new_code(app.now_ts() - 100 - i) for i in range(3)]
+    future = new_code(app.now_ts() + 3600)
+    sweeper = app.ExpirySweeper(0, 2)
+
+    counts = sweeper.sweep()
+
+    assert counts['code'] >= 3
+    assert all(code_state(code_id) == (1, 1) for code_id in past)
+    assert code_state(future) == (0, 0)
+    assert sweeper.stats()['lease_owner'] is True
+    with app.db_pool.connection() as conn:
+        owner, = conn.execute("SELECT owner FROM leases WHERE name = ?", (sweeper.lease_name,)).fetchone()
+    assert owner == sweeper.owner
+    # Повторный проход ничего не помечает повторно
+    assert sweeper.sweep()['code'] == 0
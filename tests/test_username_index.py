@@ -0,0 +1,57 @@
+import uuid
+
+import app
+
+
+def insert_user(username):
+    # Так пользователя видит воркер, который его не регистрировал
+    with app.db_pool.connection() as conn:
+        conn.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, 'x', ?)",
+                     (username, app.now_ts()))
+        conn.commit()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = app.BloomFilter(1 << 12, 4)
+    names = [f'user-{i}' for i in range(200)]
+    for name in names:
+        bloom.add(name)
+    assert all(name in bloom for name in names)
+    assert sum(f'other-{i}' in bloom for i in range(200)) < 20
+
+
+def test_index_picks_up_users_of_other_workers():
+    index = app.UsernameIndex(0, 1 << 16, 4, 100)
+    index.refresh(force=True)
+    username = f'idx-{uuid.uuid4().hex[:8]}'
+    assert not index.exists(username)
+
+    insert_user(username)
+
+    assert index.exists(username)
+    assert username in index._known
+
+
+def test_bloom_false_positive_is_confirmed_in_database():
+    # Фильтр из одного бита говорит "возможно есть" про любое имя
+    index = app.UsernameIndex(3600, 1, 1, 100)
+    index.add('someone')
+    username = f'idx-{uuid.uuid4().hex[:8]}'
+    assert username in index._bloom
+
+    assert not index.exists(username)
+    insert_user(username)
+    assert index.exists(username)
+
+
+def test_check_user_sees_fresh_registration(client):
+    username = f'idx-{uuid.uuid4().hex[:8]}'
+    assert client.post('/api/check_user', json={'username': username}).get_json()['exists'] is False
+
+    with app.db_pool.connection() as conn:
+        code = uuid.uuid4().hex[:12].upper()
+        conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, 'day', ?)", (code, app.now_ts()))
+        conn.commit()
+    client.post('/api/register', json={'username': username, 'password': 'secret', 'activation_code': code})
+
+    assert client.post('/api/check_user', json={'username': username}).get_json()['exists'] is True
@@ -0,0 +1,113 @@
+import secrets
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def pipeline():
+    # Длинная задержка сбора пачки: операции из разных потоков попадают в одну транзакцию
+    return app.WritePipeline(64, 0.3, 64)
+
+
+def new_code(code_type='month'):
+    code = secrets.token_hex(8).upper()
+    with app.db_pool.connection() as conn:
+        cur = conn.execute("INSERT INTO codes (code, code_type, created_at) VALUES (?, ?, ?)",
+                           (code, code_type, app.now_ts()))
+        conn.commit()
+        return cur.lastrowid, code
+
+
+def run_batch(pipeline, calls):
+    """Запускает execute() из отдельных потоков и возвращает результат или исключение каждого"""
+    outcomes = [None] * len(calls)
+    def worker(i, fn, args):
+        try:
+            outcomes[i] = pipeline.execute('test', fn, *args)
+        except Exception as e:
+            outcomes[i] = e
+    threads = [threading.Thread(target=worker, args=(i, fn, args)) for i, (fn, args) in enumerate(calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    stats = pipeline.stats()
+    assert stats['batches'] + stats['failed_batches'] == 1
+    return outcomes
+
+
+def register_call(username, code):
+    code_id, activation_code = code
+    return app._register_op, (username, 'hash', code_id, 'month', activation_code)
+
+
+def fetch_one(sql, params):
+    with app.db_pool.connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+
+def test_duplicate_username_in_one_batch(pipeline):
+    codes = [new_code(), new_code()]
+    outcomes = run_batch(pipeline, [register_call('batch-dup', code) for code in codes])
+
+    messages = sorted(result['message'] for result in outcomes)
+    assert messages == ["Registration successful", "Username already exists"]
+    # Код проигравшей операции откатан вместе с ее SAVEPOINT
+    used = sorted(fetch_one("SELECT used FROM codes WHERE id = ?", (code_id,))[0] for code_id, _ in codes)
+    assert used == [0, 1]
+    assert fetch_one("SELECT COUNT(*) FROM users WHERE username = 'batch-dup'", ())[0] == 1
+
+
+def test_same_code_twice_in_one_batch(pipeline):
+    code = new_code()
+    outcomes = run_batch(pipeline, [register_call('batch-code-a', code), register_call('batch-code-b', code)])
+
+    messages = sorted(result['message'] for result in outcomes)
+    assert messages == ["Code already used", "Registration successful"]
+    assert fetch_one("""SELECT COUNT(*) FROM users WHERE username IN ('batch-code-a', 'batch-code-b')""", ())[0] == 1
+    assert fetch_one("SELECT COUNT(*) FROM activations WHERE code_id = ?", (code[0],))[0] == 1
+
+
+def test_failing_op_rolls_back_only_itself(pipeline):
+    def broken_op(c):
+        c.execute("INSERT INTO users (username, password_hash, created_at) VALUES ('batch-broken', 'x', 0)")
+        raise RuntimeError("boom")
+
+    outcomes = run_batch(pipeline, [register_call('batch-ok', new_code()), (broken_op, ())])
+
+    assert outcomes[0]['status'] == 'success'
+    assert isinstance(outcomes[1], RuntimeError)
+    assert fetch_one("SELECT 1 FROM users WHERE username = 'batch-ok'", ()) is not None
+    assert fetch_one("SELECT 1 FROM users WHERE username = 'batch-broken'", ()) is None
+
+
+def test_failed_commit_reaches_every_future(pipeline, monkeypatch):
+    real_connection = app.db_pool.connection
+
+    class FailingCommit:
+        def __init__(self, conn):
+            self._conn = conn
+        def __getattr__(self, name):
+            return getattr(self._conn, name)
+        def commit(self):
+            self._conn.rollback()
+            raise sqlite3.OperationalError("disk I/O error")
+
+    @contextmanager
+    def failing_connection(conn=None):
+        with real_connection(conn) as conn:
+            yield FailingCommit(conn)
+
+    codes = [new_code(), new_code(), new_code()]
+    monkeypatch.setattr(app.db_pool, 'connection', failing_connection)
+    outcomes = run_batch(pipeline, [register_call(f'batch-lost-{i}', code) for i, code in enumerate(codes)])
+
+    assert all(isinstance(outcome, sqlite3.OperationalError) for outcome in outcomes)
+    assert pipeline.stats()['failed_batches'] == 1
+    monkeypatch.undo()
+    assert fetch_one("SELECT COUNT(*) FROM users WHERE username LIKE 'batch-lost-%'", ())[0] == 0